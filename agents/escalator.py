@@ -3,22 +3,30 @@ from typing import Literal
 from langchain_core.messages import AIMessage
 from langgraph.types import Command
 
-from tools import create_support_ticket
+from tickets import open_ticket
 from state import AgentState
 
 def escalate(state: AgentState) -> Command[Literal["__end__"]]:
     """
     Escalator Agent:
     Creates a support ticket and informs the user.
+    Only the ticket id is created here: the outbox row is written and the ticket
+    delivered to the ticketing system in the background, so the reply goes out
+    immediately. Repeats of an open issue reuse its ticket.
     """
     messages = state["messages"]
     last_user_msg = messages[-1]
     user_id = state.get("user_info", {}).get("user_id", "guest")
+    thread_id = state.get("config", {}).get("configurable", {}).get("thread_id", "default_thread")
     
     print(" [SYSTEM] Escalating to human agent...")
     
-    # Invoke the tool
-    ticket_result = create_support_ticket.invoke({"issue": last_user_msg.content, "user_id": user_id})
+    ticket_id, is_new = open_ticket(user_id, thread_id, last_user_msg.content)
+    if is_new:
+        ticket_result = f"Support ticket #{ticket_id} has been created for your issue."
+    else:
+        print(f" [SYSTEM] Reusing open ticket {ticket_id} for User {user_id}")
+        ticket_result = f"Your support ticket #{ticket_id} is already open."
     
     response_text = (
         f"I'm sorry I couldn't help with that. {ticket_result}\n"
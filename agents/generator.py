@@ -1,58 +1,206 @@
+import time
+import asyncio
 from typing import Literal
 from langchain_core.messages import AIMessage
 from langchain_core.prompts import ChatPromptTemplate
 from langgraph.types import Command
 
-from config import get_model
+from config import model_cascade, DEFAULT_MODEL, MODEL_CASCADE_ATTEMPTS
+import llm_gateway
 from state import AgentState
-from db import load_recent_messages
+from db import load_recent_messages, aload_recent_messages
+import vector_store
+from prompt_builder import assemble_prompt
+from metrics import span, observe, increment
+from deadline import (
+    call_with_timeout, acall_with_timeout, stream_with_deadline, remaining, expired, DeadlineExceeded, HISTORY_TIMEOUT
+)
+from response_cache import response_cache, context_fingerprint, depends_on_context, RESPONSE_CACHE_ENABLED
 
-def generate(state: AgentState) -> Command[Literal["__end__", "generator"]]:
+# Cheap local quality check: answers shorter than this are treated as failed generations
+MIN_ANSWER_CHARS = 5
+
+FALLBACK_ANSWER = (
+    "I'm sorry, I couldn't put together an answer right now. "
+    "Would you like me to escalate this to a human agent?"
+)
+
+def _build_generation_messages(state: AgentState, past_history):
+    model_name = state.get("config", {}).get("configurable", {}).get("model", "")
+    # System prompt + current graph messages, deduplicated and fitted to the model's token budget
+    return assemble_prompt(
+        state["messages"],
+        state.get("summary", ""),
+        past_history,
+        state.get("retrieved_docs", []),
+        model_name
+    )
+
+def _cache_key(state: AgentState, past_history):
+    """
+    Returns (query_vector, model, context_fp) for the response cache, or None if it
+    can't be used, e.g. for a follow-up that only makes sense with the earlier turns.
+    """
+    if not RESPONSE_CACHE_ENABLED or not vector_store.embeddings_enabled():
+        return None
+    query = state["messages"][-1].content
+    # The persisted history already holds the current question (queued before the graph ran)
+    earlier = state["messages"][:-1] or [m for m in past_history or [] if m.get("content") != query]
+    if depends_on_context(query, earlier or state.get("summary")):
+        return None
+    config, user_id, _ = _thread_context(state)
+    model_name = config.get("configurable", {}).get("model", "")
+    context_fp = context_fingerprint(user_id, state.get("retrieved_docs", []))
+    return vector_store.embed_text(query), model_name, context_fp
+
+def _cached_answer(cache_key):
+    if cache_key is None:
+        return None
+    answer = response_cache.lookup(*cache_key)
+    if answer is not None:
+        print(" [SYSTEM] Semantic response cache hit -> Skipping LLM call")
+    return answer
+
+def _answer_ok(answer):
+    return len(answer.strip()) >= MIN_ANSWER_CHARS and any(c.isalnum() for c in answer)
+
+def _finish(answer, cache_key=None) -> Command[Literal["__end__"]]:
+    if answer is None:
+        print(" [SYSTEM] Model cascade exhausted -> Returning fallback answer")
+        answer = FALLBACK_ANSWER
+    elif cache_key is not None:
+        response_cache.store(*cache_key, answer)
+
+    return Command(
+        update={"messages": [AIMessage(content=answer)]},
+        goto="__end__"
+    )
+
+def _tiers(config):
+    """Yields (tier config, model name, attempt) for every attempt the cascade allows."""
+    configurable = config.get("configurable", {})
+    models = model_cascade(configurable.get("model", DEFAULT_MODEL))
+    for tier, model_name in enumerate(models):
+        if tier:
+            print(f" [SYSTEM] {models[tier - 1]} failed the answer check -> Escalating to {model_name}")
+            increment(f"cascade.escalations.{models[tier - 1]}")
+        tier_config = {**config, "configurable": {**configurable, "model": model_name}}
+        for attempt in range(MODEL_CASCADE_ATTEMPTS):
+            yield tier_config, model_name, attempt
+
+def _record_attempt(model_name, start, status):
+    # Per-tier latency, split by outcome (ok / rejected / error)
+    observe(f"cascade.{model_name}", time.perf_counter() - start, status)
+    increment(f"cascade.attempts.{model_name}.{status}")
+
+def _out_of_time():
+    """Ends a turn whose deadline passed before an answer completed, with the fallback answer."""
+    increment("timeouts.generator")
+    print(" [SYSTEM] Turn deadline reached -> Returning fallback answer")
+    return Command(update={"messages": [AIMessage(content=FALLBACK_ANSWER)]}, goto="__end__")
+
+def _thread_context(state: AgentState):
+    config = state.get("config", {})
+    user_id = state.get("user_info", {}).get("user_id", "default_user")
+    thread_id = config.get("configurable", {}).get("thread_id", "default_thread")
+    return config, user_id, thread_id
+
+def generate(state: AgentState) -> Command[Literal["__end__"]]:
     """
     Generator Agent:
     Synthesizes an answer combining:
     1. Short-term memory (LangGraph state)
     2. Long-term persistent memory (PostgreSQL)
     3. Semantic Memory (Pinecone retrieved docs)
+    Answers come from the model cascade (see config.MODEL_CASCADE): a tier
+    whose answer fails the quality check hands over to the next, stronger one.
+    The turn's deadline bounds every tier, including the wait for its first token.
     """
-    messages = state["messages"]
-    docs = state.get("retrieved_docs", [])
-    config = state.get("config", {})
-    user_id = state.get("user_info", {}).get("user_id", "default_user")
-    thread_id = config.get("configurable", {}).get("thread_id", "default_thread")
-    
-    # Load past history from Postgres
-    past_history = load_recent_messages(user_id, thread_id, limit=5)
-    history_str = "\n".join([f"{msg['role'].capitalize()}: {msg['content']}" for msg in past_history])
-    if not history_str:
-        history_str = "No recent history."
-    
-    # 1. Generate Answer
-    model = get_model(config)
-    
-    context_str = "\n\n".join(docs) if docs else "No relevant semantic context found."
-    
-    system_prompt = (
-        "You are a MakTek support agent. Use the provided context to answer the user's question.\n"
-        f"--- Semantic Context (from Pinecone) ---\n{context_str}\n\n"
-        f"--- Recent Persistent History (from PostgreSQL) ---\n{history_str}\n\n"
-        "If the answer is not in the context, say 'I don't know' or ask to escalate."
-    )
-    
-    # We construct a temporary message list for generation that includes the system prompt + current graph messages
-    generation_messages = [("system", system_prompt)] + messages
-    
-    response = model.invoke(generation_messages)
-    answer = response.content
-    
-    # 2. Hallucination/Consistency Check
-    if len(answer.strip()) < 5:
-        print(" [SYSTEM] Hallucination Check Failed (Too short) -> Retrying Generator")
-        return Command(
-            goto="generator",
-        )
+    config, user_id, thread_id = _thread_context(state)
 
-    return Command(
-        update={"messages": [AIMessage(content=answer)]},
-        goto="__end__"
-    )
+    # Past history from Postgres, normally loaded by the parallel history_loader branch
+    past_history = state.get("history")
+    if past_history is None:
+        past_history = call_with_timeout("history_loader", remaining(state, HISTORY_TIMEOUT), [],
+                                         load_recent_messages, user_id, thread_id, limit=5)
+
+    # Near-duplicate questions by the same user over the same docs are answered from the cache
+    cache_key = _cache_key(state, past_history)
+    cached = _cached_answer(cache_key)
+    if cached is not None:
+        return _finish(cached)
+
+    prompt = _build_generation_messages(state, past_history)
+
+    # 1. Generate Answer, 2. Hallucination/Consistency Check
+    # Streamed so graph consumers using stream_mode="messages" receive tokens as they arrive
+    for tier_config, model_name, attempt in _tiers(config):
+        if expired(state):
+            return _out_of_time()
+        start = time.perf_counter()
+        answer = ""
+        try:
+            with span("llm.stream", model=model_name, attempt=attempt):
+                for chunk in stream_with_deadline(state, llm_gateway.stream, tier_config, prompt):
+                    if not answer and chunk.content:
+                        observe("llm.first_token", time.perf_counter() - start)
+                    answer += chunk.content
+        except DeadlineExceeded:
+            _record_attempt(model_name, start, "timeout")
+            return _out_of_time()
+        except Exception as e:
+            print(f" [ERROR] Error generating answer with {model_name}: {e}")
+            _record_attempt(model_name, start, "error")
+            continue
+        if _answer_ok(answer):
+            _record_attempt(model_name, start, "ok")
+            return _finish(answer, cache_key)
+        _record_attempt(model_name, start, "rejected")
+
+    return _finish(None)
+
+async def agenerate(state: AgentState) -> Command[Literal["__end__"]]:
+    """Async Generator Agent: same as generate, without blocking the event loop."""
+    config, user_id, thread_id = _thread_context(state)
+
+    past_history = state.get("history")
+    if past_history is None:
+        past_history = await acall_with_timeout("history_loader", remaining(state, HISTORY_TIMEOUT), [],
+                                                aload_recent_messages(user_id, thread_id, limit=5))
+
+    cache_key = await asyncio.to_thread(_cache_key, state, past_history)
+    cached = _cached_answer(cache_key)
+    if cached is not None:
+        return _finish(cached)
+
+    prompt = _build_generation_messages(state, past_history)
+
+    for tier_config, model_name, attempt in _tiers(config):
+        if expired(state):
+            return _out_of_time()
+        start = time.perf_counter()
+        chunks = []
+
+        async def consume():
+            async for chunk in llm_gateway.astream(tier_config, prompt):
+                if not chunks and chunk.content:
+                    observe("llm.first_token", time.perf_counter() - start)
+                chunks.append(chunk.content)
+
+        try:
+            with span("llm.stream", model=model_name, attempt=attempt):
+                await asyncio.wait_for(consume(), remaining(state))
+        except asyncio.TimeoutError:
+            _record_attempt(model_name, start, "timeout")
+            return _out_of_time()
+        except Exception as e:
+            print(f" [ERROR] Error generating answer with {model_name}: {e}")
+            _record_attempt(model_name, start, "error")
+            continue
+        answer = "".join(chunks)
+        if _answer_ok(answer):
+            _record_attempt(model_name, start, "ok")
+            return _finish(answer, cache_key)
+        _record_attempt(model_name, start, "rejected")
+
+    return _finish(None)
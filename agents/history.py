@@ -0,0 +1,29 @@
+
+from state import AgentState
+from db import load_recent_messages, aload_recent_messages
+from deadline import call_with_timeout, acall_with_timeout, remaining, HISTORY_TIMEOUT
+
+# Number of persisted messages handed to the generator
+HISTORY_LIMIT = 5
+
+def _thread_key(state: AgentState):
+    user_id = state.get("user_info", {}).get("user_id", "default_user")
+    thread_id = state.get("config", {}).get("configurable", {}).get("thread_id", "default_thread")
+    return user_id, thread_id
+
+def load_history(state: AgentState):
+    """
+    History Loader:
+    Loads recent persisted messages for the thread from PostgreSQL (or its ring buffer).
+    Runs in parallel with the retriever so the two I/O waits overlap.
+    Bounded by HISTORY_TIMEOUT and the turn's deadline: a slow database leaves the turn without history.
+    """
+    user_id, thread_id = _thread_key(state)
+    return {"history": call_with_timeout("history_loader", remaining(state, HISTORY_TIMEOUT), [],
+                                         load_recent_messages, user_id, thread_id, limit=HISTORY_LIMIT)}
+
+async def aload_history(state: AgentState):
+    """Async History Loader: same as load_history, without blocking the event loop."""
+    user_id, thread_id = _thread_key(state)
+    return {"history": await acall_with_timeout("history_loader", remaining(state, HISTORY_TIMEOUT), [],
+                                                aload_recent_messages(user_id, thread_id, limit=HISTORY_LIMIT))}
@@ -1,8 +1,28 @@
 
+import re
 from typing import Literal
 from langgraph.types import Command
 from langchain_core.messages import AIMessage
 from state import AgentState
+from agents.keywords import compile_keywords
+from agents.intent_classifier import classify_intent
+
+ABUSIVE_KEYWORDS = [
+    "stupid", "idiot", "dumb", "hate you", "shut up", "useless", "fuck", "shit", "bitch", "asshole"
+]
+GREETING_KEYWORDS = ["hi", "hello", "hey", "greetings", "good morning", "good afternoon", "good evening"]
+
+# Compiled once at import. Abusive keywords are stems matched from the start of a word,
+# so inflections ("idiots", "shitty") are caught
+ABUSIVE_PATTERN = compile_keywords(ABUSIVE_KEYWORDS)
+# A pure greeting is the whole message (full words only, so "hi" never fires inside "this"),
+# optionally followed by punctuation
+GREETING_PATTERN = re.compile(
+    "(?:" + "|".join(re.escape(k) for k in sorted(GREETING_KEYWORDS, key=len, reverse=True)) + r")[\s!.,?]*"
+)
+
+# The local classifier only answers greetings outright for short messages
+MAX_CLASSIFIED_GREETING_WORDS = 4
 
 def intent_detector(state: AgentState) -> Command[Literal["summarizer", "__end__"]]:
     """
@@ -19,11 +39,13 @@ def intent_detector(state: AgentState) -> Command[Literal["summarizer", "__end__
     last_msg = messages[-1]
     user_input = last_msg.content.lower().strip()
     
+    # Optional local embedding classifier, consulted only when the keyword patterns don't match
+    def classified_as(label):
+        predicted, _ = classify_intent(user_input)
+        return predicted == label
+
     # 1. Check for Abusive/Harsh Language
-    abusive_keywords = [
-        "stupid", "idiot", "dumb", "hate you", "shut up", "useless", "fuck", "shit", "bitch", "asshole"
-    ]
-    if any(word in user_input for word in abusive_keywords):
+    if ABUSIVE_PATTERN.search(user_input) or classified_as("abusive"):
         fallback_response = (
             "I'm here to help you, but I expect respectful communication. "
             "Please refrain from using offensive language so we can solve your issue constructively."
@@ -34,13 +56,14 @@ def intent_detector(state: AgentState) -> Command[Literal["summarizer", "__end__
         )
         
     # 2. Check for Greetings
-    greeting_keywords = ["hi", "hello", "hey", "greetings", "good morning", "good afternoon", "good evening"]
     # Exact match or starts with greeting (to avoid triggering on "hi there, my phone is broken")
     # But for "smarter" feel, we might want to catch just "hi" separately.
     # If the user says "Hi, I have a problem", we should probably handle the problem (Pass through).
     # If the user JUST says "Hi", we greet back.
     
-    is_pure_greeting = user_input in greeting_keywords
+    is_pure_greeting = bool(GREETING_PATTERN.fullmatch(user_input)) or (
+        len(user_input.split()) <= MAX_CLASSIFIED_GREETING_WORDS and classified_as("greeting")
+    )
     
     if is_pure_greeting:
         greeting_response = "Hello! How can I assist you with MakTek support today?"
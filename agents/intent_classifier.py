@@ -0,0 +1,63 @@
+
+import os
+import threading
+import numpy as np
+
+import vector_store
+
+# Off by default: enable with INTENT_CLASSIFIER=1 (needs the embedding model from init_pinecone)
+INTENT_CLASSIFIER_ENABLED = os.getenv("INTENT_CLASSIFIER", "0") == "1"
+INTENT_CLASSIFIER_THRESHOLD = float(os.getenv("INTENT_CLASSIFIER_THRESHOLD", "0.75"))
+
+# Example phrases per intent; each intent is represented by the centroid of their embeddings
+INTENT_EXAMPLES = {
+    "greeting": [
+        "hi", "hello there", "hey, how are you", "good morning", "hiya", "howdy", "greetings to you",
+    ],
+    "abusive": [
+        "you are useless", "this bot is garbage", "you are so stupid", "what a worthless assistant",
+        "you are an idiot",
+    ],
+    "escalation": [
+        "i want to talk to a person", "let me speak to a real person", "connect me with customer service",
+        "i need a representative", "can someone from your team call me",
+    ],
+}
+
+_labels = None
+_centroids = None
+_centroids_lock = threading.Lock()
+
+def _load_centroids():
+    global _labels, _centroids
+    with _centroids_lock:
+        if _centroids is None:
+            labels, rows = [], []
+            for label, examples in INTENT_EXAMPLES.items():
+                vectors = np.asarray([vector_store.embed_text(e) for e in examples], dtype=np.float32)
+                vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+                centroid = vectors.mean(axis=0)
+                labels.append(label)
+                rows.append(centroid / np.linalg.norm(centroid))
+            _labels, _centroids = labels, np.stack(rows)
+    return _labels, _centroids
+
+def classify_intent(text):
+    """
+    Scores a message against the precomputed intent centroids (cosine similarity,
+    one matrix-vector product). Returns (label, score), or (None, score) when the
+    best score is below INTENT_CLASSIFIER_THRESHOLD or the classifier is unavailable.
+    """
+    if not INTENT_CLASSIFIER_ENABLED or not vector_store.embeddings_enabled() or not text:
+        return None, 0.0
+
+    try:
+        labels, centroids = _load_centroids()
+        vector = np.asarray(vector_store.embed_text(text), dtype=np.float32)
+        scores = centroids @ (vector / np.linalg.norm(vector))
+        best = int(np.argmax(scores))
+        score = float(scores[best])
+        return (labels[best] if score >= INTENT_CLASSIFIER_THRESHOLD else None), score
+    except Exception as e:
+        print(f" [ERROR] Error classifying intent: {e}")
+        return None, 0.0
@@ -0,0 +1,11 @@
+import re
+
+def compile_keywords(keywords):
+    """
+    Compiles a keyword list into one regex, built once at import.
+    Keywords are stems: a match has to start at a word boundary but may carry
+    a word suffix ("idiots", "escalated", "fucking"). Longer phrases are tried
+    first, so "shut up" wins over "shut".
+    """
+    alternatives = "|".join(re.escape(k) for k in sorted(keywords, key=len, reverse=True))
+    return re.compile(rf"\b(?:{alternatives})\w*")
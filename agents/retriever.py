@@ -2,30 +2,47 @@ from typing import Literal
 from langchain_core.messages import SystemMessage, HumanMessage
 from langgraph.types import Command
 from state import AgentState
-from vector_store import retrieve_similar_context
+from vector_store import retrieve_similar_context, aretrieve_similar_context
+from deadline import call_with_timeout, acall_with_timeout, remaining, RETRIEVAL_TIMEOUT
 
-def retrieve(state: AgentState) -> Command[Literal["generator", "escalator"]]:
+def retrieve(state: AgentState):
     """
     Retriever Agent:
     Retrieves semantic documents from Pinecone based on the latest user query.
+    Runs in parallel with the history loader; route_context joins both branches.
+    Bounded by RETRIEVAL_TIMEOUT and the turn's deadline: a slow index leaves the turn without docs.
     """
     latest_message = state["messages"][-1]
     query = latest_message.content
     
     user_id = state.get("user_info", {}).get("user_id", "default_user")
     
-    docs = retrieve_similar_context(user_id, query)
-    
+    docs = call_with_timeout("retriever", remaining(state, RETRIEVAL_TIMEOUT), [],
+                             retrieve_similar_context, user_id, query)
+    print(f" [SYSTEM] Retrieved {len(docs)} documents from Pinecone Semantic Memory.")
+    return {"retrieved_docs": docs}
+
+async def aretrieve(state: AgentState):
+    """Async Retriever Agent: same as retrieve, without blocking the event loop."""
+    query = state["messages"][-1].content
+    user_id = state.get("user_info", {}).get("user_id", "default_user")
+
+    docs = await acall_with_timeout("retriever", remaining(state, RETRIEVAL_TIMEOUT), [],
+                                    aretrieve_similar_context(user_id, query))
+    print(f" [SYSTEM] Retrieved {len(docs)} documents from Pinecone Semantic Memory.")
+    return {"retrieved_docs": docs}
+
+def route_context(state: AgentState) -> Command[Literal["generator", "escalator"]]:
+    """
+    Join point after retrieval and history loading:
+    sends the turn to the Generator, or to the Escalator if retrieval found nothing relevant.
+    """
+    query = state["messages"][-1].content
+    docs = state.get("retrieved_docs", [])
+
     # Simple Relevance Check
     if not docs and "weather" in query.lower():
         print(" [SYSTEM] Relevance Check Failed -> Escalating")
-        return Command(
-            update={"retrieved_docs": []},
-            goto="escalator"
-        )
+        return Command(goto="escalator")
 
-    print(f" [SYSTEM] Retrieved {len(docs)} documents from Pinecone Semantic Memory.")
-    return Command(
-        update={"retrieved_docs": docs},
-        goto="generator"
-    )
+    return Command(goto="generator")
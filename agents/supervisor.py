@@ -2,11 +2,18 @@
 from typing import Literal
 from langgraph.types import Command
 from state import AgentState
+from agents.keywords import compile_keywords
+from agents.intent_classifier import classify_intent
 
-def supervisor(state: AgentState) -> Command[Literal["retriever", "escalator", "generator"]]:
+# Direct escalation requests, compiled once at import; stems, so "agents" and "escalated" match too
+ESCALATION_KEYWORDS = ["human", "agent", "support ticket", "escalat"]
+ESCALATION_PATTERN = compile_keywords(ESCALATION_KEYWORDS)
+
+def supervisor(state: AgentState) -> Command[Literal["retriever", "history_loader", "escalator", "generator"]]:
     """
     Supervisor Agent:
-    Orchestrates the flow. It decides whether to call the Retriever, Generator, or Escalator.
+    Orchestrates the flow. It decides whether to call the Retriever (fanned out in
+    parallel with the History Loader), Generator, or Escalator.
     It considers user intent based on the latest message.
     """
     messages = state["messages"]
@@ -18,13 +25,13 @@ def supervisor(state: AgentState) -> Command[Literal["retriever", "escalator", "
     
     # 1. Intent Classification
     # Check for direct escalation requests
-    escalation_keywords = ["human", "agent", "support ticket", "escalate"]
-    if any(keyword in user_input for keyword in escalation_keywords):
+    if ESCALATION_PATTERN.search(user_input) or classify_intent(user_input)[0] == "escalation":
         return Command(goto="escalator")
 
     # Check for greetings (skip retrieval, go straight to generator or handle directly?)
     # For a RAG system seeking to be helpful, let's just retrieve anyway in case "Hi" is followed by a question in the same turn,
     # or just let the generator handle it if retrieval yields nothing.
     # However, to be robust, we'll try retrieval first for everything else.
+    # Semantic retrieval and history loading are independent, so they run concurrently.
     
-    return Command(goto="retriever")
+    return Command(goto=["retriever", "history_loader"])
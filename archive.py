@@ -0,0 +1,267 @@
+"""
+Retention and archival for the messages table.
+
+Monthly partitions of messages that ended more than MESSAGE_RETENTION_DAYS ago are
+streamed to a compressed file in ARCHIVE_DIR (gzip JSONL, or Parquet with pyarrow),
+their vectors are deleted from the users' namespaces in batches, and the partition
+is detached and dropped. Expired rows of messages_default get the same treatment and
+are deleted. Run it periodically (e.g. daily from cron); each run also creates the
+upcoming partitions, which the chatbot processes also do on their own (see
+start_partition_maintenance). With the local vector index, the running chatbot
+picks up the vector deletes from the shared LOCAL_VECTOR_DIR before its next query.
+
+    python archive.py --retention-days 365 --dry-run
+    python archive.py --migrate      # one-off: partition an existing messages table
+"""
+import os
+import sys
+import gzip
+import json
+import argparse
+import threading
+from datetime import datetime, timedelta
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from db import (
+    get_connection, release_connection, ensure_message_partitions, list_message_partitions,
+    drop_message_partition, delete_default_messages, migrate_messages_table
+)
+import vector_store
+from metrics import span
+
+# Messages are kept this many days; a partition is archived once its whole month is older
+MESSAGE_RETENTION_DAYS = int(os.getenv("MESSAGE_RETENTION_DAYS", "365"))
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "archive")
+# "jsonl" (gzip-compressed) or "parquet" (zstd-compressed, needs pyarrow)
+ARCHIVE_FORMAT = os.getenv("ARCHIVE_FORMAT", "jsonl").lower()
+# Rows fetched per round trip from the server-side cursor, and written per Parquet row group
+ARCHIVE_BATCH_SIZE = int(os.getenv("ARCHIVE_BATCH_SIZE", "5000"))
+# The chatbot processes create upcoming partitions this often (seconds; 0 disables)
+MESSAGE_PARTITION_INTERVAL = float(os.getenv("MESSAGE_PARTITION_INTERVAL", "3600"))
+
+DEFAULT_PARTITION = "messages_default"
+
+_COLUMNS = ("message_id", "thread_id", "user_id", "role", "content", "timestamp")
+
+def _stream_rows(partition, columns, before=None):
+    """
+    Yields lists of up to ARCHIVE_BATCH_SIZE row tuples from a partition (only rows
+    older than `before`, if given) through a server-side cursor.
+    """
+    conn = get_connection()
+    try:
+        with conn.cursor(name=f"archive_{partition}") as cur:
+            cur.itersize = ARCHIVE_BATCH_SIZE
+            if before is None:
+                cur.execute(f"SELECT {', '.join(columns)} FROM {partition};")
+            else:
+                cur.execute(f"SELECT {', '.join(columns)} FROM {partition} WHERE timestamp < %s;", (before,))
+            while True:
+                rows = cur.fetchmany(ARCHIVE_BATCH_SIZE)
+                if not rows:
+                    break
+                yield rows
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        release_connection(conn)
+
+def _write_jsonl(partition, path, before=None):
+    count = 0
+    with gzip.open(path, "wt", encoding="utf-8") as f:
+        for rows in _stream_rows(partition, _COLUMNS, before):
+            for row in rows:
+                f.write(json.dumps(dict(zip(_COLUMNS, row)), default=str) + "\n")
+            count += len(rows)
+    return count
+
+def _write_parquet(partition, path, before=None):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = pa.schema([
+        ("message_id", pa.string()), ("thread_id", pa.string()), ("user_id", pa.string()),
+        ("role", pa.string()), ("content", pa.string()), ("timestamp", pa.timestamp("us")),
+    ])
+    count = 0
+    with pq.ParquetWriter(path, schema, compression="zstd") as writer:
+        for rows in _stream_rows(partition, _COLUMNS, before):
+            columns = list(zip(*rows))
+            writer.write_table(pa.Table.from_arrays([pa.array(c, type=t.type) for c, t in zip(columns, schema)], schema=schema))
+            count += len(rows)
+    return count
+
+def export_partition(partition, archive_dir=ARCHIVE_DIR, archive_format=ARCHIVE_FORMAT, before=None):
+    """
+    Streams a partition to <archive_dir>/<partition>.jsonl.gz (or .parquet); with
+    `before`, only its older rows, to <partition>_<before>.jsonl.gz.
+    The file is written under a temporary name and renamed once complete.
+    Returns (path, row count).
+    """
+    if archive_format == "parquet":
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            print(" [WARNING] pyarrow is not installed; archiving as gzip JSONL instead.")
+            archive_format = "jsonl"
+    writer, extension = (_write_parquet, ".parquet") if archive_format == "parquet" else (_write_jsonl, ".jsonl.gz")
+
+    os.makedirs(archive_dir, exist_ok=True)
+    name = partition if before is None else f"{partition}_{before:%Y%m%d%H%M%S}"
+    path = os.path.join(archive_dir, name + extension)
+    tmp_path = path + ".tmp"
+    with span("archive.export", partition=partition):
+        count = writer(partition, tmp_path, before)
+    os.replace(tmp_path, path)
+    return path, count
+
+def prune_partition_vectors(partition, before=None):
+    """
+    Deletes the vectors of every message in the partition (older than `before`, if given),
+    in per-namespace batches. Returns how many ids were sent.
+    """
+    pending = {}
+    pending_count = 0
+    deleted = 0
+    for rows in _stream_rows(partition, ("user_id", "message_id"), before):
+        for user_id, message_id in rows:
+            ids = pending.setdefault(user_id, [])
+            ids.append(message_id)
+            pending_count += 1
+            if len(ids) >= vector_store.VECTOR_DELETE_BATCH_SIZE:
+                deleted += vector_store.delete_vectors(user_id, pending.pop(user_id))
+                pending_count -= len(ids)
+        # Bound memory when the ids are spread over many users
+        if pending_count >= ARCHIVE_BATCH_SIZE:
+            for user_id, ids in pending.items():
+                deleted += vector_store.delete_vectors(user_id, ids)
+            pending, pending_count = {}, 0
+    for user_id, ids in pending.items():
+        deleted += vector_store.delete_vectors(user_id, ids)
+    return deleted
+
+def expired_partitions(retention_days=MESSAGE_RETENTION_DAYS, now=None):
+    """Monthly partitions whose newest possible message is older than the retention period."""
+    cutoff = (now or datetime.now()) - timedelta(days=retention_days)
+    return [p for p in list_message_partitions() if p[2] <= cutoff]
+
+def archive_default_partition(retention_days=MESSAGE_RETENTION_DAYS, archive_dir=ARCHIVE_DIR,
+                              archive_format=ARCHIVE_FORMAT, dry_run=False, now=None):
+    """
+    Archives the rows of messages_default older than the retention period
+    (e.g. late writes for a month whose partition was already dropped):
+    export, prune vectors, then delete them. Returns a summary dict.
+    """
+    cutoff = (now or datetime.now()) - timedelta(days=retention_days)
+    if dry_run:
+        print(f" [SYSTEM] Would archive {DEFAULT_PARTITION} rows older than {cutoff:%Y-%m-%d}")
+        return {"partition": DEFAULT_PARTITION, "dry_run": True}
+    try:
+        path, rows = export_partition(DEFAULT_PARTITION, archive_dir, archive_format, before=cutoff)
+        if not rows:
+            os.remove(path)
+            return {"partition": DEFAULT_PARTITION, "rows": 0}
+        print(f" [SYSTEM] Archived {rows} messages from {DEFAULT_PARTITION} to {path}")
+        with span("archive.prune_vectors", partition=DEFAULT_PARTITION):
+            vectors = prune_partition_vectors(DEFAULT_PARTITION, before=cutoff)
+        print(f" [SYSTEM] Deleted {vectors} vectors for {DEFAULT_PARTITION}")
+    except Exception as e:
+        print(f" [ERROR] Error archiving {DEFAULT_PARTITION}: {e}")
+        return {"partition": DEFAULT_PARTITION, "error": str(e)}
+    deleted = delete_default_messages(cutoff)
+    if deleted is None:
+        return {"partition": DEFAULT_PARTITION, "error": "delete failed"}
+    return {"partition": DEFAULT_PARTITION, "file": path, "rows": rows, "vectors": vectors, "deleted": deleted}
+
+def run_archival(retention_days=MESSAGE_RETENTION_DAYS, archive_dir=ARCHIVE_DIR,
+                 archive_format=ARCHIVE_FORMAT, dry_run=False):
+    """
+    Archives every expired partition: export, prune vectors, then drop; then the
+    expired rows of messages_default. A partition is only dropped (and rows only
+    deleted) after both earlier steps succeeded, so a failed run can simply be
+    repeated. Returns a summary dict per partition.
+    """
+    ensure_message_partitions()
+    results = []
+    for partition, month, _ in expired_partitions(retention_days):
+        if dry_run:
+            print(f" [SYSTEM] Would archive {partition} ({month:%Y-%m})")
+            results.append({"partition": partition, "dry_run": True})
+            continue
+        try:
+            path, rows = export_partition(partition, archive_dir, archive_format)
+            print(f" [SYSTEM] Archived {rows} messages from {partition} to {path}")
+            with span("archive.prune_vectors", partition=partition):
+                vectors = prune_partition_vectors(partition)
+            print(f" [SYSTEM] Deleted {vectors} vectors for {partition}")
+        except Exception as e:
+            print(f" [ERROR] Error archiving {partition}: {e}")
+            results.append({"partition": partition, "error": str(e)})
+            continue
+        dropped = drop_message_partition(partition)
+        results.append({"partition": partition, "file": path, "rows": rows, "vectors": vectors, "dropped": dropped})
+    results.append(archive_default_partition(retention_days, archive_dir, archive_format, dry_run))
+    return results
+
+class PartitionMaintainer:
+    """Background thread that creates upcoming message partitions every `interval` seconds."""
+    def __init__(self, interval=MESSAGE_PARTITION_INTERVAL):
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stop.clear()
+                self._thread = threading.Thread(target=self._run, name="message-partitions", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        # init_db has just created them; the first check is one interval later
+        while not self._stop.wait(self.interval):
+            try:
+                ensure_message_partitions()
+            except Exception as e:
+                print(f" [ERROR] Error maintaining message partitions: {e}")
+
+    def stop(self, timeout=5.0):
+        with self._lock:
+            thread = self._thread
+            self._thread = None
+        self._stop.set()
+        if thread is not None and thread.is_alive():
+            thread.join(timeout)
+
+partition_maintainer = PartitionMaintainer()
+
+def start_partition_maintenance():
+    """Keeps upcoming message partitions created (unless MESSAGE_PARTITION_INTERVAL=0). Call after init_db."""
+    if MESSAGE_PARTITION_INTERVAL > 0:
+        partition_maintainer.start()
+
+def stop_partition_maintenance():
+    partition_maintainer.stop()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Archive and drop messages older than the retention period")
+    parser.add_argument("--retention-days", type=int, default=MESSAGE_RETENTION_DAYS)
+    parser.add_argument("--archive-dir", default=ARCHIVE_DIR)
+    parser.add_argument("--format", choices=("jsonl", "parquet"), default=ARCHIVE_FORMAT)
+    parser.add_argument("--dry-run", action="store_true", help="only list the partitions that would be archived")
+    parser.add_argument("--migrate", action="store_true", help="convert an unpartitioned messages table first")
+    args = parser.parse_args()
+
+    if args.migrate:
+        migrate_messages_table()
+    # Pruning only deletes by id, so the embedding model is never needed
+    vector_store.EMBEDDING_WARMUP = "lazy"
+    vector_store.init_pinecone()
+    results = run_archival(args.retention_days, args.archive_dir, args.format, args.dry_run)
+    sys.exit(1 if any("error" in r for r in results) else 0)
@@ -0,0 +1,110 @@
+import asyncio
+import uuid
+from langchain_core.messages import HumanMessage, AIMessageChunk
+
+from graph import aapp
+from persistence import enqueue_message
+from metrics import set_thread_id, span
+from deadline import with_deadline
+
+DEFAULT_MODEL = "llama-3.1-8b-instant"
+
+async def astream_turn(user_id, thread_id, user_input, model=DEFAULT_MODEL):
+    """
+    Runs one user turn through the async graph, yielding events as they happen:
+    {"type": "token", "content": ...} for every generator token, then a single
+    {"type": "final", "content": ...} with the complete answer (which may come
+    from a node that does not stream, e.g. a greeting or an escalation).
+    A {"type": "reset"} event means the tokens streamed so far were discarded
+    (e.g. a cascade tier's answer was rejected and the next attempt follows).
+    """
+    config = {
+        "configurable": {
+            "thread_id": thread_id,
+            "model": model
+        }
+    }
+
+    set_thread_id(thread_id)
+    enqueue_message(user_id=user_id, role="user", content=user_input, thread_id=thread_id, message_id=str(uuid.uuid4()))
+
+    inputs = {
+        "messages": [HumanMessage(content=user_input)],
+        "user_info": {"user_id": user_id},
+        "config": with_deadline(config)
+    }
+
+    final_answer = ""
+    # Id of the model call whose tokens the client has received, and their text
+    streamed_id, streamed = None, []
+    with span("turn"):
+        async for mode, chunk in aapp.astream(inputs, config=config, stream_mode=["messages", "updates"]):
+            if mode == "messages":
+                message_chunk, metadata = chunk
+                # Only streamed chunks: the generator's final AIMessage is also emitted here and
+                # would repeat the whole answer (it is sent once, as the "final" event)
+                if (metadata.get("langgraph_node") == "generator" and isinstance(message_chunk, AIMessageChunk)
+                        and message_chunk.content):
+                    # Tokens of a new model call replace those of a rejected or failed earlier one
+                    if streamed and message_chunk.id != streamed_id:
+                        streamed = []
+                        yield {"type": "reset"}
+                    streamed_id = message_chunk.id
+                    streamed.append(message_chunk.content)
+                    yield {"type": "token", "content": message_chunk.content}
+            else:
+                for key, value in chunk.items():
+                    if value and "messages" in value and value["messages"]:
+                        last_msg = value["messages"][-1]
+                        if hasattr(last_msg, "content") and last_msg.type == "ai":
+                            final_answer = last_msg.content
+
+    if final_answer:
+        enqueue_message(user_id=user_id, role="assistant", content=final_answer, thread_id=thread_id, message_id=str(uuid.uuid4()))
+
+    if streamed and "".join(streamed) != final_answer:
+        # e.g. every tier was rejected or the deadline passed: the fallback answer replaces the tokens
+        yield {"type": "reset"}
+    yield {"type": "final", "content": final_answer}
+
+async def arun_turn(user_id, thread_id, user_input, model=DEFAULT_MODEL):
+    """
+    Async counterpart of main.process_turn: runs one user turn through the
+    async graph and returns the assistant's answer.
+    """
+    final_answer = ""
+    async for event in astream_turn(user_id, thread_id, user_input, model=model):
+        if event["type"] == "final":
+            final_answer = event["content"]
+    return final_answer
+
+async def arun_sessions(turns, max_concurrency=200, model=DEFAULT_MODEL):
+    """
+    Interleaves many sessions on one event loop.
+    `turns` is an iterable of (user_id, thread_id, user_input). Turns of the same
+    thread run in order; different threads run concurrently, at most
+    `max_concurrency` turns at a time. Returns {thread_id: [answers...]}.
+    """
+    sessions = {}
+    for user_id, thread_id, user_input in turns:
+        sessions.setdefault((user_id, thread_id), []).append(user_input)
+
+    semaphore = asyncio.Semaphore(max_concurrency)
+    answers = {}
+
+    async def run_session(user_id, thread_id, inputs):
+        answers[thread_id] = []
+        for user_input in inputs:
+            async with semaphore:
+                try:
+                    answer = await arun_turn(user_id, thread_id, user_input, model=model)
+                except Exception as e:
+                    print(f" [ERROR] Turn failed for thread {thread_id}: {e}")
+                    answer = ""
+            answers[thread_id].append(answer)
+
+    await asyncio.gather(*(
+        run_session(user_id, thread_id, inputs)
+        for (user_id, thread_id), inputs in sessions.items()
+    ))
+    return answers
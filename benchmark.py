@@ -0,0 +1,255 @@
+
+"""
+Offline load test for the chatbot graph.
+
+Drives graph.aapp with N concurrent synthetic sessions using deterministic
+fakes, so it needs no network access:
+- chat model: fake_llm.FakeChatModel with configurable latency ("fake:<first>:<per_token>")
+- embeddings: langchain_core DeterministicFakeEmbedding (384 dims) with optional latency
+- vector store: vector_store.LocalIndex in a temporary directory
+- PostgreSQL: an in-process stand-in with optional latency (or the real DB with --postgres),
+  including the ticket outbox written by escalation turns ("I want to talk to a human agent")
+
+Reports per-node and end-to-end p50/p95/p99 latency and turns per second.
+
+    python benchmark.py --sessions 100 --turns 5 --llm-latency 0.3 --token-latency 0.01
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+from datetime import datetime
+
+SYNTHETIC_MESSAGES = [
+    "hi",
+    "My order hasn't arrived yet, can you check the status?",
+    "How do I reset my MakTek router to factory settings?",
+    "The warranty on my laptop expired last week, can it still be repaired?",
+    "What payment methods do you accept?",
+    "My screen flickers after the latest update.",
+    "Can I change the delivery address of an existing order?",
+    "I want to talk to a human agent",
+    "How long does a refund usually take?",
+    "The charger that came with my phone stopped working.",
+]
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Offline load test for the MakTek support graph")
+    parser.add_argument("--sessions", type=int, default=50, help="concurrent synthetic sessions")
+    parser.add_argument("--turns", type=int, default=5, help="turns per session")
+    parser.add_argument("--concurrency", type=int, default=200, help="max turns in flight")
+    parser.add_argument("--llm-latency", type=float, default=0.2, help="fake LLM time to first token (s)")
+    parser.add_argument("--token-latency", type=float, default=0.005, help="fake LLM time per token (s)")
+    parser.add_argument("--llm-error-rate", type=float, default=0.0, help="fraction of fake LLM calls failing with a 429")
+    parser.add_argument("--llm-jitter", type=float, default=0.0, help="extra random fake LLM first-token latency, up to (s)")
+    parser.add_argument("--embed-latency", type=float, default=0.002, help="fake embedding latency (s)")
+    parser.add_argument("--db-latency", type=float, default=0.002, help="in-process DB stand-in latency (s)")
+    parser.add_argument("--postgres", action="store_true", help="use the real PostgreSQL from .env instead of the stand-in")
+    parser.add_argument("--no-response-cache", action="store_true", help="disable the semantic response cache")
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--json", dest="json_path", help="also write the report as JSON to this path")
+    return parser.parse_args(argv)
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a list of numbers (0 for an empty list)."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(1, int(round(pct / 100.0 * len(ordered))))
+    return ordered[min(rank, len(ordered)) - 1]
+
+class LatencyEmbeddings:
+    """Wraps an embeddings object, adding a fixed delay per call (CPU time stand-in)."""
+    def __init__(self, inner, latency):
+        self.inner = inner
+        self.latency = latency
+
+    def embed_query(self, text):
+        time.sleep(self.latency)
+        return self.inner.embed_query(text)
+
+    def embed_documents(self, texts):
+        time.sleep(self.latency)
+        return self.inner.embed_documents(texts)
+
+class InMemoryDB:
+    """In-process stand-in for the db.py functions on the graph's hot path and escalation's outbox write."""
+    def __init__(self, latency):
+        self.latency = latency
+        self.messages = {}
+        self.by_id = {}
+        self.tickets = {}
+
+    def load_recent_messages(self, user_id, thread_id="default_thread", limit=10, before=None):
+        time.sleep(self.latency)
+        return list(self.messages.get((user_id, thread_id), []))[-limit:]
+
+    async def aload_recent_messages(self, user_id, thread_id="default_thread", limit=10, before=None):
+        await asyncio.sleep(self.latency)
+        return list(self.messages.get((user_id, thread_id), []))[-limit:]
+
+    def save_messages(self, rows):
+        time.sleep(self.latency)
+        for r in rows:
+            message = {"role": r["role"], "content": r["content"], "message_id": r["message_id"]}
+            self.messages.setdefault((r["user_id"], r["thread_id"]), []).append(message)
+            self.by_id[r["message_id"]] = dict(message, user_id=r["user_id"])
+
+    def get_messages_by_ids(self, user_id, message_ids):
+        time.sleep(self.latency)
+        return {
+            message_id: self.by_id[message_id] for message_id in message_ids
+            if message_id in self.by_id and self.by_id[message_id]["user_id"] == user_id
+        }
+
+    def create_ticket(self, ticket):
+        time.sleep(self.latency)
+        self.tickets.setdefault(ticket["ticket_id"], dict(ticket))
+        return ticket["ticket_id"]
+
+    def install(self):
+        """Points every module that imported the real functions at this stand-in."""
+        import db
+        import persistence
+        import tickets
+        import agents.history
+        import agents.generator
+        import vector_store
+        for module in (db, persistence, tickets, agents.history, agents.generator, vector_store):
+            for name in ("load_recent_messages", "aload_recent_messages", "save_messages", "get_messages_by_ids",
+                         "create_ticket"):
+                if hasattr(module, name):
+                    setattr(module, name, getattr(self, name))
+
+async def run_benchmark(args):
+    from langchain_core.embeddings import DeterministicFakeEmbedding
+    import vector_store
+    from graph import aapp
+    from persistence import enqueue_message, shutdown as shutdown_persistence
+    from tickets import ticket_writer
+    from deadline import with_deadline
+    from langchain_core.messages import HumanMessage
+
+    vector_store.index = vector_store.LocalIndex(tempfile.mkdtemp(prefix="bench_vectors_"))
+    vector_store.embeddings = LatencyEmbeddings(DeterministicFakeEmbedding(size=vector_store.EMBEDDING_DIMENSION), args.embed_latency)
+
+    stand_in = None
+    if args.postgres:
+        from db import init_db
+        init_db()
+    else:
+        stand_in = InMemoryDB(args.db_latency)
+        stand_in.install()
+
+    model = f"fake:{args.llm_latency}:{args.token_latency}:{args.llm_error_rate}:{args.llm_jitter}"
+    rng = random.Random(args.seed)
+    sessions = [
+        (f"bench_user_{i}", f"bench_thread_{i}_{args.seed}", [rng.choice(SYNTHETIC_MESSAGES) for _ in range(args.turns)])
+        for i in range(args.sessions)
+    ]
+
+    semaphore = asyncio.Semaphore(args.concurrency)
+    turn_latencies = []
+    node_latencies = {}
+    errors = []
+
+    async def run_turn(user_id, thread_id, user_input):
+        config = {"configurable": {"thread_id": thread_id, "model": model}}
+        enqueue_message(user_id=user_id, role="user", content=user_input, thread_id=thread_id)
+        inputs = {
+            "messages": [HumanMessage(content=user_input)],
+            "user_info": {"user_id": user_id},
+            "config": with_deadline(config)
+        }
+
+        started_tasks = {}
+        final_answer = ""
+        start = time.perf_counter()
+        async for event in aapp.astream(inputs, config=config, stream_mode="debug"):
+            payload = event.get("payload", {})
+            timestamp = datetime.fromisoformat(event["timestamp"].replace("Z", "+00:00"))
+            if event["type"] == "task":
+                started_tasks[payload["id"]] = timestamp
+            elif event["type"] == "task_result" and payload["id"] in started_tasks:
+                elapsed = (timestamp - started_tasks.pop(payload["id"])).total_seconds()
+                node_latencies.setdefault(payload["name"], []).append(elapsed)
+                result = payload.get("result") or []
+                # Newer LangGraph versions report a dict of channel -> value, older ones a list of pairs
+                for channel, value in (result.items() if isinstance(result, dict) else result):
+                    if channel == "messages" and value:
+                        last_msg = value[-1] if isinstance(value, list) else value
+                        if getattr(last_msg, "type", None) == "ai":
+                            final_answer = last_msg.content
+        turn_latencies.append(time.perf_counter() - start)
+
+        if final_answer:
+            enqueue_message(user_id=user_id, role="assistant", content=final_answer, thread_id=thread_id)
+
+    async def run_session(user_id, thread_id, messages):
+        for user_input in messages:
+            async with semaphore:
+                try:
+                    await run_turn(user_id, thread_id, user_input)
+                except Exception as e:
+                    errors.append(repr(e))
+
+    wall_start = time.perf_counter()
+    await asyncio.gather(*(run_session(*session) for session in sessions))
+    wall_time = time.perf_counter() - wall_start
+    shutdown_persistence()
+    ticket_writer.shutdown()
+
+    def summarize(values):
+        return {
+            "count": len(values),
+            "p50_ms": percentile(values, 50) * 1000,
+            "p95_ms": percentile(values, 95) * 1000,
+            "p99_ms": percentile(values, 99) * 1000,
+        }
+
+    return {
+        "sessions": args.sessions,
+        "turns": len(turn_latencies),
+        "errors": len(errors),
+        # Outbox rows written by escalation turns (only counted with the stand-in)
+        "tickets": len(stand_in.tickets) if stand_in is not None else None,
+        "wall_time_s": wall_time,
+        "turns_per_second": len(turn_latencies) / wall_time if wall_time else 0.0,
+        "end_to_end": summarize(turn_latencies),
+        "nodes": {name: summarize(values) for name, values in sorted(node_latencies.items())},
+        "sample_errors": errors[:5],
+    }
+
+def print_report(report):
+    tickets = "" if report["tickets"] is None else f"  Tickets: {report['tickets']}"
+    print(f"\nSessions: {report['sessions']}  Turns: {report['turns']}  Errors: {report['errors']}{tickets}")
+    print(f"Wall time: {report['wall_time_s']:.2f}s  Throughput: {report['turns_per_second']:.1f} turns/s\n")
+    print(f"{'stage':<18}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    rows = [("end_to_end", report["end_to_end"])] + list(report["nodes"].items())
+    for name, stats in rows:
+        print(f"{name:<18}{stats['count']:>8}{stats['p50_ms']:>10.1f}{stats['p95_ms']:>10.1f}{stats['p99_ms']:>10.1f}")
+    for error in report["sample_errors"]:
+        print(f" [ERROR] {error}")
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    # Must be set before the graph and caches are imported
+    if not args.postgres:
+        os.environ["CHECKPOINT_BACKEND"] = "memory"
+    if args.no_response_cache:
+        os.environ["RESPONSE_CACHE_ENABLED"] = "0"
+
+    report = asyncio.run(run_benchmark(args))
+    print_report(report)
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    return 1 if report["errors"] else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,287 @@
+import os
+import asyncio
+import threading
+from collections import OrderedDict
+
+import psycopg2
+from langgraph.checkpoint.base import BaseCheckpointSaver, CheckpointTuple, WRITES_IDX_MAP
+
+from db import get_connection, release_connection
+from metrics import timed
+
+# Hot threads whose latest checkpoint is served from memory
+CHECKPOINT_CACHE_THREADS = int(os.getenv("CHECKPOINT_CACHE_THREADS", "1000"))
+# Checkpoints retained per thread; older ones (and their writes) are compacted away on every put
+CHECKPOINT_KEEP = int(os.getenv("CHECKPOINT_KEEP", "1"))
+
+class PostgresCheckpointer(BaseCheckpointSaver):
+    """
+    Durable LangGraph checkpointer on the db.py connection pool.
+    Tables are created by db.init_db. The latest checkpoint of recently used
+    threads (plus its pending writes) is kept in an LRU, so a turn on a hot
+    thread reads its state without a query; cold threads are evicted and
+    reloaded from PostgreSQL on demand. Each put compacts the thread down to
+    the newest CHECKPOINT_KEEP checkpoints.
+    The cache assumes a thread is served by one process at a time.
+    """
+    def __init__(self, *, serde=None, cache_threads=CHECKPOINT_CACHE_THREADS, keep=CHECKPOINT_KEEP):
+        super().__init__(serde=serde)
+        self.cache_threads = cache_threads
+        self.keep = max(1, keep)
+        # (thread_id, checkpoint_ns) -> latest row: (checkpoint_id, parent_id, (type, bytes), (type, bytes), {(task_id, idx): write})
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    # --- cache helpers ---
+
+    def _cache_get(self, key):
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is not None:
+                self._cache.move_to_end(key)
+            return entry
+
+    def _cache_put(self, key, entry):
+        with self._lock:
+            self._cache[key] = entry
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_threads:
+                self._cache.popitem(last=False)
+
+    def _to_tuple(self, thread_id, checkpoint_ns, entry):
+        checkpoint_id, parent_id, checkpoint, metadata, writes = entry
+        return CheckpointTuple(
+            config={"configurable": {"thread_id": thread_id, "checkpoint_ns": checkpoint_ns, "checkpoint_id": checkpoint_id}},
+            checkpoint=self.serde.loads_typed(checkpoint),
+            metadata=self.serde.loads_typed(metadata),
+            parent_config=(
+                {"configurable": {"thread_id": thread_id, "checkpoint_ns": checkpoint_ns, "checkpoint_id": parent_id}}
+                if parent_id else None
+            ),
+            pending_writes=[
+                (task_id, channel, self.serde.loads_typed(value))
+                for (task_id, _), (channel, value) in sorted(writes.items(), key=lambda item: item[0][1])
+            ]
+        )
+
+    # --- storage ---
+
+    @timed("db.checkpoint.load")
+    def _load(self, thread_id, checkpoint_ns, checkpoint_id=None, before=None, limit=None):
+        """Loads checkpoint rows (newest first) with their pending writes."""
+        conditions = ["thread_id = %s", "checkpoint_ns = %s"]
+        params = [thread_id, checkpoint_ns]
+        if checkpoint_id:
+            conditions.append("checkpoint_id = %s")
+            params.append(checkpoint_id)
+        if before:
+            conditions.append("checkpoint_id < %s")
+            params.append(before)
+        limit_sql = f"LIMIT {int(limit)}" if limit else ""
+
+        entries = []
+        conn = get_connection()
+        try:
+            with conn.cursor() as cur:
+                cur.execute(f"""
+                    SELECT checkpoint_id, parent_checkpoint_id, checkpoint_type, checkpoint, metadata_type, metadata
+                    FROM graph_checkpoints
+                    WHERE {" AND ".join(conditions)}
+                    ORDER BY checkpoint_id DESC
+                    {limit_sql};
+                """, params)
+                rows = cur.fetchall()
+                if rows:
+                    cur.execute("""
+                        SELECT checkpoint_id, task_id, idx, channel, value_type, value
+                        FROM graph_checkpoint_writes
+                        WHERE thread_id = %s AND checkpoint_ns = %s AND checkpoint_id = ANY(%s);
+                    """, (thread_id, checkpoint_ns, [row[0] for row in rows]))
+                    writes = {}
+                    for ckpt_id, task_id, idx, channel, value_type, value in cur.fetchall():
+                        writes.setdefault(ckpt_id, {})[(task_id, idx)] = (channel, (value_type, bytes(value)))
+                    for ckpt_id, parent_id, ckpt_type, ckpt, meta_type, meta in rows:
+                        entries.append((
+                            ckpt_id, parent_id, (ckpt_type, bytes(ckpt)), (meta_type, bytes(meta)), writes.get(ckpt_id, {})
+                        ))
+            conn.commit()
+        finally:
+            release_connection(conn)
+        return entries
+
+    def get_tuple(self, config):
+        configurable = config["configurable"]
+        thread_id = configurable["thread_id"]
+        checkpoint_ns = configurable.get("checkpoint_ns", "")
+        checkpoint_id = configurable.get("checkpoint_id")
+        key = (thread_id, checkpoint_ns)
+
+        entry = self._cache_get(key)
+        if entry is not None and (not checkpoint_id or entry[0] == checkpoint_id):
+            return self._to_tuple(thread_id, checkpoint_ns, entry)
+
+        entries = self._load(thread_id, checkpoint_ns, checkpoint_id=checkpoint_id, limit=1)
+        if not entries:
+            return None
+        if not checkpoint_id:
+            self._cache_put(key, entries[0])
+        return self._to_tuple(thread_id, checkpoint_ns, entries[0])
+
+    def list(self, config, *, filter=None, before=None, limit=None):
+        if not config:
+            raise ValueError("PostgresCheckpointer.list requires a thread_id in config")
+        configurable = config["configurable"]
+        thread_id = configurable["thread_id"]
+        checkpoint_ns = configurable.get("checkpoint_ns", "")
+        before_id = before["configurable"]["checkpoint_id"] if before else None
+
+        # Metadata filters are applied after deserialization, so only push the limit down without one
+        entries = self._load(thread_id, checkpoint_ns, checkpoint_id=configurable.get("checkpoint_id"),
+                             before=before_id, limit=None if filter else limit)
+        count = 0
+        for entry in entries:
+            checkpoint_tuple = self._to_tuple(thread_id, checkpoint_ns, entry)
+            if filter and not all(checkpoint_tuple.metadata.get(k) == v for k, v in filter.items()):
+                continue
+            yield checkpoint_tuple
+            count += 1
+            if limit and count >= limit:
+                return
+
+    @timed("db.checkpoint.put")
+    def put(self, config, checkpoint, metadata, new_versions):
+        configurable = config["configurable"]
+        thread_id = configurable["thread_id"]
+        checkpoint_ns = configurable.get("checkpoint_ns", "")
+        parent_id = configurable.get("checkpoint_id")
+        checkpoint_data = self.serde.dumps_typed(checkpoint)
+        metadata_data = self.serde.dumps_typed(metadata)
+
+        conn = get_connection()
+        try:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    INSERT INTO graph_checkpoints
+                        (thread_id, checkpoint_ns, checkpoint_id, parent_checkpoint_id,
+                         checkpoint_type, checkpoint, metadata_type, metadata)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+                    ON CONFLICT (thread_id, checkpoint_ns, checkpoint_id) DO UPDATE SET
+                        checkpoint_type = EXCLUDED.checkpoint_type, checkpoint = EXCLUDED.checkpoint,
+                        metadata_type = EXCLUDED.metadata_type, metadata = EXCLUDED.metadata;
+                """, (
+                    thread_id, checkpoint_ns, checkpoint["id"], parent_id,
+                    checkpoint_data[0], psycopg2.Binary(checkpoint_data[1]),
+                    metadata_data[0], psycopg2.Binary(metadata_data[1])
+                ))
+
+                # Compaction: only the newest `keep` checkpoints of the thread are retained.
+                # Writes are pruned against the kept ids rather than the deleted ones, so
+                # put_writes calls that committed after their checkpoint was compacted are removed too.
+                cur.execute("""
+                    WITH kept AS (
+                        SELECT checkpoint_id FROM graph_checkpoints
+                        WHERE thread_id = %(thread_id)s AND checkpoint_ns = %(checkpoint_ns)s
+                        ORDER BY checkpoint_id DESC
+                        LIMIT %(keep)s
+                    ), stale AS (
+                        DELETE FROM graph_checkpoints
+                        WHERE thread_id = %(thread_id)s AND checkpoint_ns = %(checkpoint_ns)s
+                          AND checkpoint_id NOT IN (SELECT checkpoint_id FROM kept)
+                    )
+                    DELETE FROM graph_checkpoint_writes
+                    WHERE thread_id = %(thread_id)s AND checkpoint_ns = %(checkpoint_ns)s
+                      AND checkpoint_id NOT IN (SELECT checkpoint_id FROM kept);
+                """, {"thread_id": thread_id, "checkpoint_ns": checkpoint_ns, "keep": self.keep})
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            release_connection(conn)
+
+        self._cache_put((thread_id, checkpoint_ns), (checkpoint["id"], parent_id, checkpoint_data, metadata_data, {}))
+        return {"configurable": {"thread_id": thread_id, "checkpoint_ns": checkpoint_ns, "checkpoint_id": checkpoint["id"]}}
+
+    @timed("db.checkpoint.put_writes")
+    def put_writes(self, config, writes, task_id, task_path=""):
+        configurable = config["configurable"]
+        thread_id = configurable["thread_id"]
+        checkpoint_ns = configurable.get("checkpoint_ns", "")
+        checkpoint_id = configurable["checkpoint_id"]
+
+        rows = []
+        for i, (channel, value) in enumerate(writes):
+            # Special channels (errors, interrupts, ...) have fixed negative indexes and are overwritten
+            idx = WRITES_IDX_MAP.get(channel, i)
+            rows.append((idx, channel, self.serde.dumps_typed(value)))
+
+        conn = get_connection()
+        try:
+            with conn.cursor() as cur:
+                for idx, channel, (value_type, value) in rows:
+                    cur.execute(f"""
+                        INSERT INTO graph_checkpoint_writes
+                            (thread_id, checkpoint_ns, checkpoint_id, task_id, idx, channel, value_type, value, task_path)
+                        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+                        ON CONFLICT (thread_id, checkpoint_ns, checkpoint_id, task_id, idx) DO {
+                            "UPDATE SET channel = EXCLUDED.channel, value_type = EXCLUDED.value_type, value = EXCLUDED.value"
+                            if idx < 0 else "NOTHING"
+                        };
+                    """, (thread_id, checkpoint_ns, checkpoint_id, task_id, idx, channel,
+                          value_type, psycopg2.Binary(value), task_path))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            release_connection(conn)
+
+        with self._lock:
+            entry = self._cache.get((thread_id, checkpoint_ns))
+            if entry is not None and entry[0] == checkpoint_id:
+                for idx, channel, value in rows:
+                    if idx < 0 or (task_id, idx) not in entry[4]:
+                        entry[4][(task_id, idx)] = (channel, value)
+
+    @timed("db.checkpoint.delete_thread")
+    def delete_thread(self, thread_id):
+        conn = get_connection()
+        try:
+            with conn.cursor() as cur:
+                cur.execute("DELETE FROM graph_checkpoint_writes WHERE thread_id = %s;", (thread_id,))
+                cur.execute("DELETE FROM graph_checkpoints WHERE thread_id = %s;", (thread_id,))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            release_connection(conn)
+
+        self.evict(thread_id)
+
+    def evict(self, thread_id):
+        """Drops a thread's cached checkpoint, e.g. when another process takes the thread over."""
+        with self._lock:
+            for key in [key for key in self._cache if key[0] == thread_id]:
+                del self._cache[key]
+
+    # --- async API: psycopg2 calls run in the default executor ---
+
+    async def aget_tuple(self, config):
+        return await asyncio.to_thread(self.get_tuple, config)
+
+    async def alist(self, config, *, filter=None, before=None, limit=None):
+        checkpoint_tuples = await asyncio.to_thread(
+            lambda: list(self.list(config, filter=filter, before=before, limit=limit))
+        )
+        for checkpoint_tuple in checkpoint_tuples:
+            yield checkpoint_tuple
+
+    async def aput(self, config, checkpoint, metadata, new_versions):
+        return await asyncio.to_thread(self.put, config, checkpoint, metadata, new_versions)
+
+    async def aput_writes(self, config, writes, task_id, task_path=""):
+        return await asyncio.to_thread(self.put_writes, config, writes, task_id, task_path)
+
+    async def adelete_thread(self, thread_id):
+        return await asyncio.to_thread(self.delete_thread, thread_id)
@@ -1,24 +1,123 @@
 
 import os
-from langchain_openai import ChatOpenAI
-from langchain_anthropic import ChatAnthropic
-from langchain_google_genai import ChatGoogleGenerativeAI
-from langchain_groq import ChatGroq
+import time
+import importlib
+import threading
 
-def get_model(config: dict):
-    model_name = config.get("configurable", {}).get("model", "llama-3.1-8b-instant")
-    
-    if "gpt" in model_name:
-        return ChatOpenAI(model=model_name, temperature=0)
+from metrics import record_startup
+
+DEFAULT_MODEL = "llama-3.1-8b-instant"
+
+# Generator model cascade, cheapest first. A turn starts at its configured model's tier and moves
+# to the next tier after MODEL_CASCADE_ATTEMPTS failed attempts (bad answer or provider error).
+MODEL_CASCADE = [m.strip() for m in os.getenv("MODEL_CASCADE", "llama-3.1-8b-instant,llama-3.3-70b-versatile").split(",") if m.strip()]
+MODEL_CASCADE_ATTEMPTS = int(os.getenv("MODEL_CASCADE_ATTEMPTS", "1"))
+
+# Provider -> (module, class). SDKs are imported the first time a model of that provider is created,
+# so importing the graph doesn't pay for SDKs the deployment never uses.
+PROVIDER_CLASSES = {
+    "fake": ("fake_llm", "FakeChatModel"),
+    "openai": ("langchain_openai", "ChatOpenAI"),
+    "anthropic": ("langchain_anthropic", "ChatAnthropic"),
+    "google": ("langchain_google_genai", "ChatGoogleGenerativeAI"),
+    "groq": ("langchain_groq", "ChatGroq"),
+}
+
+# Process-wide registry of chat model clients, keyed by (provider, model, params).
+# Clients hold HTTP connection pools, so reusing them keeps connections and TLS sessions warm.
+_model_registry = {}
+_registry_lock = threading.Lock()
+_registry_stats = {"hits": 0, "misses": 0}
+_imported_providers = set()
+
+def resolve_model(model_name: str):
+    """Maps a model name to (provider, model, params) using the routing rules below."""
+    if model_name.startswith("fake"):
+        # Offline model for local testing, e.g. "fake" or "fake:0.5:0.02" (first-token/per-token latency),
+        # optionally followed by an injected error rate and first-token latency jitter: "fake:0.5:0.02:0.1:1.5"
+        _, *settings = model_name.split(":")
+        first_token_latency, token_latency, error_rate, latency_jitter = (float(x) for x in (settings + ["0"] * 4)[:4])
+        return "fake", model_name, (
+            ("first_token_latency", first_token_latency), ("token_latency", token_latency),
+            ("error_rate", error_rate), ("latency_jitter", latency_jitter)
+        )
+    elif "gpt" in model_name:
+        return "openai", model_name, (("temperature", 0),)
     elif "claude" in model_name:
-        return ChatAnthropic(model=model_name, temperature=0)
+        return "anthropic", model_name, (("temperature", 0),)
     elif "gemini" in model_name:
-        return ChatGoogleGenerativeAI(model=model_name, temperature=0)
+        return "google", model_name, (("temperature", 0),)
     elif "llama" in model_name or "mixtral" in model_name:
-        return ChatGroq(model=model_name, temperature=0)
+        return "groq", model_name, (("temperature", 0),)
     else:
         # Default to Groq Llama 3.1 8B if unknown (Fast & Free)
-        return ChatGroq(model="llama-3.1-8b-instant", temperature=0)
+        return "groq", DEFAULT_MODEL, (("temperature", 0),)
+
+def model_cascade(model_name):
+    """
+    Returns the models to try, in order, for a configured model: its own tier
+    and the stronger ones after it. Models outside MODEL_CASCADE are used alone.
+    """
+    if model_name in MODEL_CASCADE:
+        return MODEL_CASCADE[MODEL_CASCADE.index(model_name):]
+    return [model_name]
+
+def _provider_class(provider):
+    module_name, class_name = PROVIDER_CLASSES[provider]
+    start = time.perf_counter()
+    module = importlib.import_module(module_name)
+    if module_name not in _imported_providers:
+        _imported_providers.add(module_name)
+        record_startup(f"import_{provider}", time.perf_counter() - start)
+    return getattr(module, class_name)
+
+def _create_model(provider, model_name, params):
+    kwargs = dict(params)
+    if provider == "fake":
+        return _provider_class("fake")(**kwargs)
+    return _provider_class(provider)(model=model_name, **kwargs)
+
+def get_model(config: dict):
+    """
+    Returns the shared chat model client for the configured model, creating it
+    on first use. Safe to call from threads and coroutines alike: the lookup
+    never awaits, and a client is only ever published once per key.
+    """
+    model_name = config.get("configurable", {}).get("model", DEFAULT_MODEL)
+    key = resolve_model(model_name)
+
+    with _registry_lock:
+        model = _model_registry.get(key)
+        if model is not None:
+            _registry_stats["hits"] += 1
+            return model
+
+    # Construct outside the lock so a slow client init doesn't block other lookups
+    model = _create_model(*key)
+    with _registry_lock:
+        if key in _model_registry:
+            _registry_stats["hits"] += 1
+        else:
+            _model_registry[key] = model
+            _registry_stats["misses"] += 1
+        return _model_registry[key]
+
+def warm_up(model_names=(DEFAULT_MODEL,)):
+    """Pre-creates clients for the given model names, e.g. at worker start-up."""
+    for model_name in model_names:
+        try:
+            get_model({"configurable": {"model": model_name}})
+        except Exception as e:
+            print(f" [ERROR] Error warming up model '{model_name}': {e}")
+
+def registry_stats():
+    """Returns registry hit/miss counters and the keys of the cached clients."""
+    with _registry_lock:
+        return {
+            **_registry_stats,
+            "size": len(_model_registry),
+            "models": [f"{provider}:{model_name}" for provider, model_name, _ in _model_registry]
+        }
 
 # Mock environment setup for demonstration if keys are missing
 if not os.environ.get("GROQ_API_KEY"):
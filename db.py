@@ -1,29 +1,97 @@
 import os
-import uuid
+import weakref
+import threading
+from datetime import datetime
+from collections import OrderedDict, deque
+import asyncio
 import psycopg2
 from psycopg2 import pool
 
-# Database connection pool
+from metrics import span, timed
+
+# Database connection pools (psycopg2 for sync callers, aiopg for the async graph)
 pg_pool = None
+_pool_lock = threading.Lock()
+# aiopg pools and their creation locks are bound to an event loop, so each loop gets its own
+_apg_pools = weakref.WeakKeyDictionary()
+_apool_locks = weakref.WeakKeyDictionary()
+_apool_locks_guard = threading.Lock()
+
+# Server-side prepared statements, created once per pooled connection
+# Both take the batch as parallel arrays: message ids, thread ids, user ids, roles, contents, timestamps
+_PREPARED_STATEMENTS = {
+    # Upserts the batch's users and conversations and inserts its messages in one round trip.
+    # FK checks run at the end of the statement, after the CTE inserts.
+    "save_messages_upsert": """
+        WITH batch AS (
+            SELECT * FROM unnest($1::varchar[], $2::varchar[], $3::varchar[], $4::text[], $5::text[], $6::timestamp[])
+                AS b(message_id, thread_id, user_id, role, content, timestamp)
+        ), new_users AS (
+            INSERT INTO users (user_id) SELECT DISTINCT user_id FROM batch
+            ON CONFLICT (user_id) DO NOTHING
+        ), new_conversations AS (
+            INSERT INTO conversations (thread_id, user_id) SELECT DISTINCT ON (thread_id) thread_id, user_id FROM batch
+            ON CONFLICT (thread_id) DO NOTHING
+        )
+        INSERT INTO messages (message_id, thread_id, user_id, role, content, timestamp)
+        SELECT message_id, thread_id, user_id, role, content, timestamp FROM batch
+    """,
+    # Used once every (user_id, thread_id) pair of the batch is known to exist
+    "save_messages": """
+        INSERT INTO messages (message_id, thread_id, user_id, role, content, timestamp)
+        SELECT * FROM unnest($1::varchar[], $2::varchar[], $3::varchar[], $4::text[], $5::text[], $6::timestamp[])
+    """,
+}
+_prepared_connections = weakref.WeakSet()
+
+# Per-process cache of (user_id, thread_id) pairs known to exist in the DB
+KNOWN_THREADS_CACHE_SIZE = int(os.getenv("KNOWN_THREADS_CACHE_SIZE", "10000"))
+_known_threads = OrderedDict()
+_known_threads_lock = threading.Lock()
+
+# Per-thread ring buffer of the latest messages, written through by save_messages
+HISTORY_CACHE_SIZE = int(os.getenv("HISTORY_CACHE_SIZE", "20"))
+HISTORY_CACHE_THREADS = int(os.getenv("HISTORY_CACHE_THREADS", "1000"))
+_history_cache = OrderedDict()
+_history_cache_lock = threading.Lock()
+# Messages written through while their thread was not cached and not yet flushed to the DB
+_pending_history = OrderedDict()
+
+# Hot-row cache of messages by message_id, for hydrating vector search results; written through on save
+MESSAGE_CACHE_SIZE = int(os.getenv("MESSAGE_CACHE_SIZE", "5000"))
+_message_cache = OrderedDict()
+_message_cache_lock = threading.Lock()
+
+# messages is range-partitioned by month on timestamp (messages_pYYYYMM, plus messages_default
+# for rows outside every range); partitions are created this many months ahead, by init_db and
+# then every MESSAGE_PARTITION_INTERVAL seconds (see archive.start_partition_maintenance)
+MESSAGE_PARTITIONS_AHEAD = int(os.getenv("MESSAGE_PARTITIONS_AHEAD", "3"))
+MESSAGE_PARTITION_PREFIX = "messages_p"
+
+# Escalations repeating the same issue for the same user within this window (seconds) reuse the open ticket
+TICKET_DEDUPE_WINDOW = int(os.getenv("TICKET_DEDUPE_WINDOW", "3600"))
 
 def get_connection():
     global pg_pool
     if not pg_pool:
-        db_name = os.getenv("DB_NAME", "chatbot_db")
-        db_user = os.getenv("DB_USER", "postgres")
-        db_password = os.getenv("DB_PASSWORD", "postgres")
-        db_host = os.getenv("DB_HOST", "localhost")
-        db_port = os.getenv("DB_PORT", "5432")
-
-        pg_pool = psycopg2.pool.SimpleConnectionPool(
-            1, 20,
-            database=db_name,
-            user=db_user,
-            password=db_password,
-            host=db_host,
-            port=db_port
-        )
-    return pg_pool.getconn()
+        with _pool_lock:
+            if not pg_pool:
+                pg_pool = _create_pool()
+    # Time spent waiting for a pooled connection
+    with span("db.pool_acquire"):
+        return pg_pool.getconn()
+
+def _connection_params():
+    return {
+        "database": os.getenv("DB_NAME", "chatbot_db"),
+        "user": os.getenv("DB_USER", "postgres"),
+        "password": os.getenv("DB_PASSWORD", "postgres"),
+        "host": os.getenv("DB_HOST", "localhost"),
+        "port": os.getenv("DB_PORT", "5432"),
+    }
+
+def _create_pool():
+    return psycopg2.pool.ThreadedConnectionPool(1, 20, **_connection_params())
 
 def release_connection(conn):
     if pg_pool:
@@ -52,51 +120,342 @@ def init_db():
                 );
             """)
 
-            # Messages table
+            # Messages table, partitioned by month (see archive.py for retention); the
+            # partitions are created after this transaction, so a failure there can't undo the schema
+            _create_messages_table(cur)
+            cur.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass('messages');")
+            if cur.fetchone()[0] != "p":
+                print(" [WARNING] messages is not partitioned; run `python archive.py --migrate` to enable retention.")
+
+            # Outbox of support tickets, written by the escalator and delivered by tickets.TicketDeliveryWorker
             cur.execute("""
-                CREATE TABLE IF NOT EXISTS messages (
-                    message_id VARCHAR(255) PRIMARY KEY,
-                    thread_id VARCHAR(255) REFERENCES conversations(thread_id),
+                CREATE TABLE IF NOT EXISTS support_tickets (
+                    ticket_id VARCHAR(255) PRIMARY KEY,
                     user_id VARCHAR(255) REFERENCES users(user_id),
-                    role TEXT NOT NULL,
-                    content TEXT NOT NULL,
-                    timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                    thread_id VARCHAR(255),
+                    message_id VARCHAR(255),
+                    issue TEXT NOT NULL,
+                    dedupe_key VARCHAR(64) NOT NULL,
+                    status VARCHAR(16) NOT NULL DEFAULT 'pending',
+                    duplicate_of VARCHAR(255),
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    next_attempt_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    last_error TEXT,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    delivered_at TIMESTAMP
+                );
+            """)
+            cur.execute("""
+                CREATE INDEX IF NOT EXISTS idx_support_tickets_pending
+                ON support_tickets (next_attempt_at) WHERE status = 'pending';
+            """)
+            cur.execute("""
+                CREATE INDEX IF NOT EXISTS idx_support_tickets_dedupe
+                ON support_tickets (dedupe_key, created_at DESC);
+            """)
+
+            # LangGraph checkpoints (see checkpointer.PostgresCheckpointer)
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS graph_checkpoints (
+                    thread_id VARCHAR(255) NOT NULL,
+                    checkpoint_ns VARCHAR(255) NOT NULL DEFAULT '',
+                    checkpoint_id VARCHAR(255) NOT NULL,
+                    parent_checkpoint_id VARCHAR(255),
+                    checkpoint_type VARCHAR(64) NOT NULL,
+                    checkpoint BYTEA NOT NULL,
+                    metadata_type VARCHAR(64) NOT NULL,
+                    metadata BYTEA NOT NULL,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    PRIMARY KEY (thread_id, checkpoint_ns, checkpoint_id)
+                );
+            """)
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS graph_checkpoint_writes (
+                    thread_id VARCHAR(255) NOT NULL,
+                    checkpoint_ns VARCHAR(255) NOT NULL DEFAULT '',
+                    checkpoint_id VARCHAR(255) NOT NULL,
+                    task_id VARCHAR(255) NOT NULL,
+                    idx INTEGER NOT NULL,
+                    channel VARCHAR(255) NOT NULL,
+                    value_type VARCHAR(64) NOT NULL,
+                    value BYTEA NOT NULL,
+                    task_path VARCHAR(255) NOT NULL DEFAULT '',
+                    PRIMARY KEY (thread_id, checkpoint_ns, checkpoint_id, task_id, idx)
                 );
             """)
         conn.commit()
     except Exception as e:
         print(f" [ERROR] Error initializing database: {e}")
         conn.rollback()
+        return
     finally:
         release_connection(conn)
+    ensure_message_partitions()
+
+def _create_messages_table(cur):
+    # The partition key has to be part of the primary key
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS messages (
+            message_id VARCHAR(255) NOT NULL,
+            thread_id VARCHAR(255) REFERENCES conversations(thread_id),
+            user_id VARCHAR(255) REFERENCES users(user_id),
+            role TEXT NOT NULL,
+            content TEXT NOT NULL,
+            timestamp TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (message_id, timestamp)
+        ) PARTITION BY RANGE (timestamp);
+    """)
+
+    # Supports "latest N messages of a thread" and keyset pagination (created on every partition)
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_messages_user_thread_ts
+        ON messages (user_id, thread_id, timestamp DESC, message_id DESC);
+    """)
+
+def _month_start(moment):
+    return datetime(moment.year, moment.month, 1)
+
+def _add_months(month, count):
+    index = month.year * 12 + month.month - 1 + count
+    return datetime(index // 12, index % 12 + 1, 1)
+
+def message_partition_name(month):
+    return f"{MESSAGE_PARTITION_PREFIX}{month:%Y%m}"
+
+def _partition_month(name):
+    """The month a messages_pYYYYMM partition covers, or None for any other table."""
+    suffix = name[len(MESSAGE_PARTITION_PREFIX):]
+    if not name.startswith(MESSAGE_PARTITION_PREFIX) or len(suffix) != 6 or not suffix.isdigit():
+        return None
+    return datetime(int(suffix[:4]), int(suffix[4:]), 1)
+
+def _create_message_partition(cur, month):
+    """
+    Creates the partition for one month unless it exists. Postgres refuses to add a
+    partition while messages_default holds rows in its range, so in that case the
+    default partition is detached, the rows are moved into the new partition and
+    it is attached again. Returns how many rows were moved, or None if it existed.
+    """
+    name = message_partition_name(month)
+    cur.execute("SELECT to_regclass(%s) IS NOT NULL;", (name,))
+    if cur.fetchone()[0]:
+        return None
+    bounds = (month, _add_months(month, 1))
+    cur.execute("""
+        SELECT EXISTS (SELECT 1 FROM messages_default WHERE timestamp >= %s AND timestamp < %s);
+    """, bounds)
+    if not cur.fetchone()[0]:
+        cur.execute(f"CREATE TABLE {name} PARTITION OF messages FOR VALUES FROM (%s) TO (%s);", bounds)
+        return 0
+
+    cur.execute("ALTER TABLE messages DETACH PARTITION messages_default;")
+    cur.execute(f"CREATE TABLE {name} PARTITION OF messages FOR VALUES FROM (%s) TO (%s);", bounds)
+    cur.execute(f"""
+        WITH moved AS (
+            DELETE FROM messages_default WHERE timestamp >= %s AND timestamp < %s
+            RETURNING message_id, thread_id, user_id, role, content, timestamp
+        )
+        INSERT INTO {name} (message_id, thread_id, user_id, role, content, timestamp)
+        SELECT message_id, thread_id, user_id, role, content, timestamp FROM moved;
+    """, bounds)
+    moved = cur.rowcount
+    cur.execute("ALTER TABLE messages ATTACH PARTITION messages_default DEFAULT;")
+    return moved
+
+def _create_message_partitions(cur, first_month, last_month):
+    """Creates the default partition and the monthly partitions from first_month through last_month."""
+    cur.execute("CREATE TABLE IF NOT EXISTS messages_default PARTITION OF messages DEFAULT;")
+    month = first_month
+    while month <= last_month:
+        _create_message_partition(cur, month)
+        month = _add_months(month, 1)
+
+def ensure_message_partitions(months_ahead=MESSAGE_PARTITIONS_AHEAD):
+    """
+    Creates any missing monthly partitions of messages up to months_ahead from now,
+    each in its own transaction. Returns how many partitions were created.
+    """
+    created = 0
+    month = _month_start(datetime.now())
+    for offset in range(months_ahead + 1):
+        conn = get_connection()
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass('messages');")
+                row = cur.fetchone()
+                if row is None or row[0] != "p":
+                    conn.rollback()
+                    return created
+                # Several processes run this; one creates a partition at a time
+                cur.execute("SELECT pg_advisory_xact_lock(hashtext('messages_partitions'));")
+                cur.execute("CREATE TABLE IF NOT EXISTS messages_default PARTITION OF messages DEFAULT;")
+                moved = _create_message_partition(cur, _add_months(month, offset))
+            conn.commit()
+            if moved is not None:
+                created += 1
+                print(f" [SYSTEM] Created partition {message_partition_name(_add_months(month, offset))}"
+                      + (f" ({moved} messages moved from messages_default)" if moved else ""))
+        except Exception as e:
+            print(f" [ERROR] Error creating message partition {message_partition_name(_add_months(month, offset))}: {e}")
+            conn.rollback()
+        finally:
+            release_connection(conn)
+    return created
 
+def list_message_partitions():
+    """Returns [(partition name, first month, end month exclusive)] for the monthly partitions, oldest first."""
+    conn = get_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("""
+                SELECT c.relname FROM pg_inherits i
+                JOIN pg_class c ON c.oid = i.inhrelid
+                WHERE i.inhparent = 'messages'::regclass;
+            """)
+            names = [name for (name,) in cur.fetchall()]
+        conn.commit()
+    except Exception as e:
+        print(f" [ERROR] Error listing message partitions: {e}")
+        conn.rollback()
+        return []
+    finally:
+        release_connection(conn)
+
+    partitions = []
+    for name in names:
+        month = _partition_month(name)
+        if month is not None:
+            partitions.append((name, month, _add_months(month, 1)))
+    return sorted(partitions, key=lambda p: p[1])
+
+def drop_message_partition(name):
+    """Detaches a monthly partition from messages and drops it."""
+    if _partition_month(name) is None:
+        raise ValueError(f"Not a monthly messages partition: {name}")
+    conn = get_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute(f"ALTER TABLE messages DETACH PARTITION {name};")
+            cur.execute(f"DROP TABLE {name};")
+        conn.commit()
+        return True
+    except Exception as e:
+        print(f" [ERROR] Error dropping message partition {name}: {e}")
+        conn.rollback()
+        return False
+    finally:
+        release_connection(conn)
+
+def delete_default_messages(before):
+    """Deletes the rows of messages_default older than `before`. Returns how many were deleted, or None on error."""
+    conn = get_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("DELETE FROM messages_default WHERE timestamp < %s;", (before,))
+            deleted = cur.rowcount
+        conn.commit()
+        return deleted
+    except Exception as e:
+        print(f" [ERROR] Error deleting expired messages from messages_default: {e}")
+        conn.rollback()
+        return None
+    finally:
+        release_connection(conn)
+
+def migrate_messages_table():
+    """
+    Converts an unpartitioned messages table (from before partitioning) into the
+    partitioned layout in one transaction. The old table is kept as
+    messages_unpartitioned, to be dropped once the copy has been checked.
+    """
+    conn = get_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass('messages');")
+            row = cur.fetchone()
+            if row is None or row[0] != "r":
+                print(" [SYSTEM] messages is already partitioned (or missing); nothing to migrate.")
+                conn.rollback()
+                return False
+            cur.execute("ALTER TABLE messages RENAME TO messages_unpartitioned;")
+            cur.execute("ALTER INDEX IF EXISTS messages_pkey RENAME TO messages_unpartitioned_pkey;")
+            cur.execute("ALTER INDEX IF EXISTS idx_messages_user_thread_ts RENAME TO idx_messages_unpartitioned_user_thread_ts;")
+            _create_messages_table(cur)
+
+            cur.execute("SELECT MIN(timestamp) FROM messages_unpartitioned;")
+            oldest = cur.fetchone()[0] or datetime.now()
+            month = _month_start(datetime.now())
+            _create_message_partitions(cur, min(_month_start(oldest), month), _add_months(month, MESSAGE_PARTITIONS_AHEAD))
+            cur.execute("""
+                INSERT INTO messages (message_id, thread_id, user_id, role, content, timestamp)
+                SELECT message_id, thread_id, user_id, role, content, COALESCE(timestamp, CURRENT_TIMESTAMP)
+                FROM messages_unpartitioned;
+            """)
+            copied = cur.rowcount
+        conn.commit()
+        print(f" [SYSTEM] Copied {copied} messages into the partitioned table; messages_unpartitioned can be dropped.")
+        return True
+    except Exception as e:
+        print(f" [ERROR] Error migrating messages table: {e}")
+        conn.rollback()
+        return False
+    finally:
+        release_connection(conn)
+
+def _execute_prepared(conn, cur, name, params):
+    """Executes one of _PREPARED_STATEMENTS, preparing them on first use of this connection."""
+    if conn not in _prepared_connections:
+        cur.execute("DEALLOCATE ALL;")
+        for statement_name, sql in _PREPARED_STATEMENTS.items():
+            cur.execute(f"PREPARE {statement_name} AS {sql};")
+        _prepared_connections.add(conn)
+    placeholders = ", ".join(["%s"] * len(params))
+    cur.execute(f"EXECUTE {name} ({placeholders});", params)
+
+def _is_known_thread(user_id, thread_id):
+    with _known_threads_lock:
+        if (user_id, thread_id) in _known_threads:
+            _known_threads.move_to_end((user_id, thread_id))
+            return True
+    return False
+
+def _mark_known_thread(user_id, thread_id):
+    with _known_threads_lock:
+        _known_threads[(user_id, thread_id)] = True
+        _known_threads.move_to_end((user_id, thread_id))
+        while len(_known_threads) > KNOWN_THREADS_CACHE_SIZE:
+            _known_threads.popitem(last=False)
+
+@timed("db.get_or_create_user")
 def get_or_create_user(user_id):
     """Ensures the user exists in the database."""
     conn = get_connection()
     try:
         with conn.cursor() as cur:
-            cur.execute("SELECT user_id FROM users WHERE user_id = %s;", (user_id,))
-            if not cur.fetchone():
-                cur.execute("INSERT INTO users (user_id) VALUES (%s);", (user_id,))
-                conn.commit()
+            cur.execute("INSERT INTO users (user_id) VALUES (%s) ON CONFLICT (user_id) DO NOTHING;", (user_id,))
+        conn.commit()
     except Exception as e:
         print(f" [ERROR] Error in get_or_create_user: {e}")
         conn.rollback()
     finally:
         release_connection(conn)
 
+@timed("db.get_or_create_conversation")
 def get_or_create_conversation(user_id, thread_id):
     """Ensures a conversation exists for the given user, returning the thread_id."""
-    # Ensure user exists first
-    get_or_create_user(user_id)
-    
+    if _is_known_thread(user_id, thread_id):
+        return thread_id
+
     conn = get_connection()
     try:
         with conn.cursor() as cur:
-            cur.execute("SELECT thread_id FROM conversations WHERE thread_id = %s;", (thread_id,))
-            if not cur.fetchone():
-                cur.execute("INSERT INTO conversations (thread_id, user_id) VALUES (%s, %s);", (thread_id, user_id))
-                conn.commit()
+            cur.execute("INSERT INTO users (user_id) VALUES (%s) ON CONFLICT (user_id) DO NOTHING;", (user_id,))
+            cur.execute("""
+                INSERT INTO conversations (thread_id, user_id) VALUES (%s, %s)
+                ON CONFLICT (thread_id) DO NOTHING;
+            """, (thread_id, user_id))
+        conn.commit()
+        _mark_known_thread(user_id, thread_id)
     except Exception as e:
         print(f" [ERROR] Error in get_or_create_conversation: {e}")
         conn.rollback()
@@ -105,47 +464,385 @@ def get_or_create_conversation(user_id, thread_id):
         
     return thread_id
 
-def load_recent_messages(user_id, thread_id="default_thread", limit=10):
-    """Loads recent messages for a user from PostgreSQL."""
+def remember_message(user_id, thread_id, role, content, message_id, pending=True):
+    """
+    Writes a message through to the thread's ring buffer.
+    If the thread is not cached yet and the message is still on its way to
+    the DB (pending=True), it is held back and merged in when the buffer is
+    warmed, so a warm-up that races the write does not lose it.
+    """
+    message = {"role": role, "content": content, "message_id": message_id}
+    key = (user_id, thread_id)
+    with _history_cache_lock:
+        buffer = _history_cache.get(key)
+        if buffer is not None:
+            buffer.append(message)
+        elif pending:
+            _pending_history.setdefault(key, OrderedDict())[message_id] = message
+            _pending_history.move_to_end(key)
+            while len(_pending_history[key]) > HISTORY_CACHE_SIZE:
+                _pending_history[key].popitem(last=False)
+            while len(_pending_history) > HISTORY_CACHE_THREADS:
+                _pending_history.popitem(last=False)
+
+def _forget_pending(rows):
+    with _history_cache_lock:
+        for r in rows:
+            key = (r["user_id"], r["thread_id"])
+            if key in _pending_history:
+                _pending_history[key].pop(r["message_id"], None)
+                if not _pending_history[key]:
+                    del _pending_history[key]
+
+def _cache_history(user_id, thread_id, messages):
+    key = (user_id, thread_id)
+    with _history_cache_lock:
+        loaded_ids = {m["message_id"] for m in messages}
+        pending = _pending_history.pop(key, {})
+        messages = messages + [m for message_id, m in pending.items() if message_id not in loaded_ids]
+        _history_cache[key] = deque(messages, maxlen=HISTORY_CACHE_SIZE)
+        _history_cache.move_to_end(key)
+        while len(_history_cache) > HISTORY_CACHE_THREADS:
+            _history_cache.popitem(last=False)
+        return list(_history_cache[key])
+
+def evict_thread(thread_id):
+    """Drops a thread's cached history, e.g. when another process takes the thread over."""
+    with _history_cache_lock:
+        for key in [key for key in _history_cache if key[1] == thread_id]:
+            del _history_cache[key]
+
+def _cached_history(user_id, thread_id, limit):
+    with _history_cache_lock:
+        buffer = _history_cache.get((user_id, thread_id))
+        if buffer is None:
+            return None
+        _history_cache.move_to_end((user_id, thread_id))
+        return list(buffer)[-limit:] if limit else []
+
+_LATEST_MESSAGES_SQL = """
+    SELECT message_id, role, content FROM messages
+    WHERE user_id = %s AND thread_id = %s
+    ORDER BY timestamp DESC, message_id DESC
+    LIMIT %s;
+"""
+
+_MESSAGES_BEFORE_SQL = """
+    SELECT message_id, role, content FROM messages
+    WHERE user_id = %s AND thread_id = %s
+      AND (timestamp, message_id) < (
+          SELECT timestamp, message_id FROM messages WHERE message_id = %s
+      )
+    ORDER BY timestamp DESC, message_id DESC
+    LIMIT %s;
+"""
+
+@timed("db.load_recent_messages")
+def load_recent_messages(user_id, thread_id="default_thread", limit=10, before=None):
+    """
+    Loads the latest `limit` messages of a thread, oldest first.
+    Pass `before` (a message_id) to page further back; rows strictly older
+    than that message are returned. The latest page is served from the
+    per-thread ring buffer whenever it is warm.
+    """
+    if before is None and limit <= HISTORY_CACHE_SIZE:
+        cached = _cached_history(user_id, thread_id, limit)
+        if cached is not None:
+            return cached
+
+    # Warm the ring buffer with a full page when loading the latest messages
+    fetch_limit = max(limit, HISTORY_CACHE_SIZE) if before is None else limit
+
     conn = get_connection()
     messages = []
     try:
         with conn.cursor() as cur:
-            cur.execute("""
-                SELECT role, content FROM messages 
-                WHERE user_id = %s AND thread_id = %s
-                ORDER BY timestamp ASC
-                LIMIT %s;
-            """, (user_id, thread_id, limit))
-            
+            if before is None:
+                cur.execute(_LATEST_MESSAGES_SQL, (user_id, thread_id, fetch_limit))
+            else:
+                cur.execute(_MESSAGES_BEFORE_SQL, (user_id, thread_id, before, fetch_limit))
+
             rows = cur.fetchall()
-            for role, content in rows:
-                messages.append({"role": role, "content": content})
+            for message_id, role, content in reversed(rows):
+                messages.append({"role": role, "content": content, "message_id": message_id})
     except Exception as e:
         print(f" [ERROR] Error loading messages: {e}")
+        return messages
     finally:
         release_connection(conn)
+
+    if before is None:
+        messages = _cache_history(user_id, thread_id, messages)
+        return messages[-limit:] if limit else []
     return messages
 
-def save_message(user_id, role, content, thread_id="default_thread", message_id=None):
-    """Saves a message to PostgreSQL."""
-    if not message_id:
-        message_id = str(uuid.uuid4())
-        
-    get_or_create_conversation(user_id, thread_id)
-    
+@timed("db.save_messages")
+def save_messages(rows):
+    """
+    Saves a batch of messages to PostgreSQL in one prepared statement: unless
+    every (user_id, thread_id) pair is already known to this process, the
+    batch's users and conversations are upserted in the same statement.
+    Each row is a dict with message_id, user_id, thread_id, role, content and
+    optionally timestamp (so queued rows keep their enqueue order).
+    Callers are expected to have already written rows through with remember_message.
+    Raises if the batch could not be stored (nothing is committed then).
+    """
+    if not rows:
+        return
+
+    pairs = {(r["user_id"], r["thread_id"]) for r in rows}
+    unknown = [pair for pair in pairs if not _is_known_thread(*pair)]
+    columns = (
+        [r["message_id"] for r in rows],
+        [r["thread_id"] for r in rows],
+        [r["user_id"] for r in rows],
+        [r["role"] for r in rows],
+        [r["content"] for r in rows],
+        [r.get("timestamp") or datetime.now() for r in rows],
+    )
+
+    conn = get_connection()
+    try:
+        with conn.cursor() as cur:
+            _execute_prepared(conn, cur, "save_messages_upsert" if unknown else "save_messages", columns)
+        conn.commit()
+        for pair in unknown:
+            _mark_known_thread(*pair)
+        _forget_pending(rows)
+        _cache_messages(rows)
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        release_connection(conn)
+
+# A ticket whose issue was already raised by the same user within the dedupe window is
+# stored as a duplicate of the open one and never delivered; the open ticket's id is returned
+_INSERT_TICKET_SQL = """
+    INSERT INTO support_tickets (ticket_id, user_id, thread_id, message_id, issue, dedupe_key, status, duplicate_of)
+    SELECT %(ticket_id)s, %(user_id)s, %(thread_id)s, %(message_id)s, %(issue)s, %(dedupe_key)s,
+           CASE WHEN prior.ticket_id IS NULL THEN 'pending' ELSE 'duplicate' END, prior.ticket_id
+    FROM (SELECT 1) AS one
+    LEFT JOIN LATERAL (
+        SELECT ticket_id FROM support_tickets
+        WHERE dedupe_key = %(dedupe_key)s AND status <> 'duplicate'
+          AND created_at > CURRENT_TIMESTAMP - %(window)s * INTERVAL '1 second'
+        ORDER BY created_at DESC
+        LIMIT 1
+    ) AS prior ON TRUE
+    ON CONFLICT (ticket_id) DO NOTHING
+    RETURNING COALESCE(duplicate_of, ticket_id);
+"""
+
+@timed("db.create_ticket")
+def create_ticket(ticket):
+    """
+    Writes a support ticket to the outbox (see tickets.TicketWriter). Returns the
+    id it resolves to: its own, or the open ticket it duplicates. Raises if it
+    could not be stored.
+    """
+    conn = get_connection()
+    try:
+        with conn.cursor() as cur:
+            # The user's first message may still be in the write-behind queue
+            cur.execute("INSERT INTO users (user_id) VALUES (%s) ON CONFLICT DO NOTHING;", (ticket["user_id"],))
+            # Serializes concurrent escalations of the same issue until the transaction ends
+            cur.execute("SELECT pg_advisory_xact_lock(hashtext(%s));", (ticket["dedupe_key"],))
+            cur.execute(_INSERT_TICKET_SQL, {**ticket, "message_id": None, "window": TICKET_DEDUPE_WINDOW})
+            row = cur.fetchone()
+        conn.commit()
+        return row[0] if row else ticket["ticket_id"]
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        release_connection(conn)
+
+@timed("db.claim_tickets")
+def claim_tickets(limit, lease_seconds):
+    """
+    Claims up to `limit` due outbox tickets for delivery, oldest first.
+    Claimed tickets are not handed out again for lease_seconds, so a worker
+    that dies mid-delivery only delays them. Concurrent workers skip each other's rows.
+    """
     conn = get_connection()
     try:
         with conn.cursor() as cur:
             cur.execute("""
-                INSERT INTO messages (message_id, thread_id, user_id, role, content)
-                VALUES (%s, %s, %s, %s, %s);
-            """, (message_id, thread_id, user_id, role, content))
+                UPDATE support_tickets
+                SET attempts = attempts + 1,
+                    next_attempt_at = CURRENT_TIMESTAMP + %s * INTERVAL '1 second'
+                WHERE ticket_id IN (
+                    SELECT ticket_id FROM support_tickets
+                    WHERE status = 'pending' AND next_attempt_at <= CURRENT_TIMESTAMP
+                    ORDER BY next_attempt_at
+                    LIMIT %s
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING ticket_id, user_id, thread_id, issue, attempts;
+            """, (lease_seconds, limit))
+            tickets = [
+                {"ticket_id": ticket_id, "user_id": user_id, "thread_id": thread_id, "issue": issue, "attempts": attempts}
+                for ticket_id, user_id, thread_id, issue, attempts in cur.fetchall()
+            ]
         conn.commit()
+        return tickets
     except Exception as e:
-        print(f" [ERROR] Error saving message: {e}")
+        print(f" [ERROR] Error claiming tickets: {e}")
         conn.rollback()
+        return []
     finally:
         release_connection(conn)
-        
-    return message_id
+
+@timed("db.complete_tickets")
+def complete_tickets(ticket_ids):
+    """Marks delivered tickets so they leave the outbox."""
+    if not ticket_ids:
+        return
+    conn = get_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("""
+                UPDATE support_tickets SET status = 'delivered', delivered_at = CURRENT_TIMESTAMP, last_error = NULL
+                WHERE ticket_id = ANY(%s);
+            """, (list(ticket_ids),))
+        conn.commit()
+    except Exception as e:
+        print(f" [ERROR] Error completing tickets: {e}")
+        conn.rollback()
+    finally:
+        release_connection(conn)
+
+@timed("db.fail_ticket")
+def fail_ticket(ticket_id, error, retry_in=None):
+    """Records a failed delivery: retried after retry_in seconds, or marked failed when retry_in is None."""
+    conn = get_connection()
+    try:
+        with conn.cursor() as cur:
+            if retry_in is None:
+                cur.execute("""
+                    UPDATE support_tickets SET status = 'failed', last_error = %s WHERE ticket_id = %s;
+                """, (error, ticket_id))
+            else:
+                cur.execute("""
+                    UPDATE support_tickets
+                    SET last_error = %s, next_attempt_at = CURRENT_TIMESTAMP + %s * INTERVAL '1 second'
+                    WHERE ticket_id = %s;
+                """, (error, retry_in, ticket_id))
+        conn.commit()
+    except Exception as e:
+        print(f" [ERROR] Error recording ticket failure: {e}")
+        conn.rollback()
+    finally:
+        release_connection(conn)
+
+def _cache_messages(rows):
+    with _message_cache_lock:
+        for r in rows:
+            _message_cache[r["message_id"]] = {
+                "message_id": r["message_id"], "user_id": r["user_id"], "role": r["role"], "content": r["content"]
+            }
+            _message_cache.move_to_end(r["message_id"])
+        while len(_message_cache) > MESSAGE_CACHE_SIZE:
+            _message_cache.popitem(last=False)
+
+@timed("db.get_messages_by_ids")
+def get_messages_by_ids(user_id, message_ids):
+    """
+    Returns {message_id: {"message_id", "user_id", "role", "content"}} for the
+    given ids of one user. Hot rows come from the in-process cache; the rest
+    are fetched with a single batched query. Unknown ids are left out.
+    """
+    found = {}
+    missing = []
+    with _message_cache_lock:
+        for message_id in message_ids:
+            row = _message_cache.get(message_id)
+            if row is not None and row["user_id"] == user_id:
+                _message_cache.move_to_end(message_id)
+                found[message_id] = row
+            else:
+                missing.append(message_id)
+    if not missing:
+        return found
+
+    conn = get_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("""
+                SELECT message_id, role, content FROM messages
+                WHERE message_id = ANY(%s) AND user_id = %s;
+            """, (missing, user_id))
+            rows = [
+                {"message_id": message_id, "user_id": user_id, "role": role, "content": content}
+                for message_id, role, content in cur.fetchall()
+            ]
+        conn.commit()
+    except Exception as e:
+        print(f" [ERROR] Error loading messages by id: {e}")
+        conn.rollback()
+        return found
+    finally:
+        release_connection(conn)
+
+    _cache_messages(rows)
+    found.update((row["message_id"], row) for row in rows)
+    return found
+
+# --- Async API (aiopg) ---
+# Reads only: writes go through persistence's write-behind queue and save_messages.
+
+async def aget_pool():
+    """Returns the running event loop's aiopg pool, creating it on first use."""
+    loop = asyncio.get_running_loop()
+    apg_pool = _apg_pools.get(loop)
+    if apg_pool is None:
+        with _apool_locks_guard:
+            lock = _apool_locks.setdefault(loop, asyncio.Lock())
+        async with lock:
+            apg_pool = _apg_pools.get(loop)
+            if apg_pool is None:
+                import aiopg
+                params = _connection_params()
+                params["dbname"] = params.pop("database")
+                apg_pool = await aiopg.create_pool(minsize=1, maxsize=int(os.getenv("DB_ASYNC_POOL_SIZE", "50")), **params)
+                _apg_pools[loop] = apg_pool
+    return apg_pool
+
+async def aclose_pool():
+    """Closes the running event loop's aiopg pool, waiting for connections in use to be released."""
+    apg_pool = _apg_pools.pop(asyncio.get_running_loop(), None)
+    if apg_pool is not None:
+        apg_pool.close()
+        await apg_pool.wait_closed()
+
+@timed("db.aload_recent_messages")
+async def aload_recent_messages(user_id, thread_id="default_thread", limit=10, before=None):
+    """Async counterpart of load_recent_messages, sharing its ring buffer."""
+    if before is None and limit <= HISTORY_CACHE_SIZE:
+        cached = _cached_history(user_id, thread_id, limit)
+        if cached is not None:
+            return cached
+
+    fetch_limit = max(limit, HISTORY_CACHE_SIZE) if before is None else limit
+
+    messages = []
+    try:
+        pool_ = await aget_pool()
+        async with pool_.acquire() as conn:
+            async with conn.cursor() as cur:
+                if before is None:
+                    await cur.execute(_LATEST_MESSAGES_SQL, (user_id, thread_id, fetch_limit))
+                else:
+                    await cur.execute(_MESSAGES_BEFORE_SQL, (user_id, thread_id, before, fetch_limit))
+                rows = await cur.fetchall()
+        for message_id, role, content in reversed(rows):
+            messages.append({"role": role, "content": content, "message_id": message_id})
+    except Exception as e:
+        print(f" [ERROR] Error loading messages: {e}")
+        return messages
+
+    if before is None:
+        messages = _cache_history(user_id, thread_id, messages)
+        return messages[-limit:] if limit else []
+    return messages
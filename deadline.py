@@ -0,0 +1,111 @@
+import os
+import time
+import queue
+import asyncio
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
+from metrics import increment
+
+# Budget for one turn, from receiving the user message to the final answer (seconds)
+TURN_TIMEOUT = float(os.getenv("TURN_TIMEOUT", "30"))
+# Caps for the optional-context branches; each also gets no more than the turn has left
+RETRIEVAL_TIMEOUT = float(os.getenv("RETRIEVAL_TIMEOUT", "1.5"))
+HISTORY_TIMEOUT = float(os.getenv("HISTORY_TIMEOUT", "1.0"))
+
+# Runs blocking calls that are waited on with a timeout (a timed-out call keeps its thread until it returns)
+_executor = ThreadPoolExecutor(max_workers=int(os.getenv("DEADLINE_WORKERS", "16")), thread_name_prefix="deadline")
+
+class DeadlineExceeded(Exception):
+    """Raised by stream_with_deadline when the turn's deadline passes."""
+
+def with_deadline(config, timeout=TURN_TIMEOUT):
+    """
+    Returns a copy of a state config carrying the turn's deadline (epoch seconds).
+    It goes into AgentState["config"] only, not the RunnableConfig given to LangGraph.
+    """
+    return {**config, "deadline": time.time() + timeout}
+
+def remaining(state, cap=None):
+    """Seconds left before the turn's deadline (at most `cap`), or `cap` if the turn has no deadline."""
+    deadline = state.get("config", {}).get("deadline")
+    if deadline is None:
+        return cap
+    left = max(0.0, deadline - time.time())
+    return left if cap is None else min(cap, left)
+
+def expired(state):
+    left = remaining(state)
+    return left is not None and left <= 0
+
+def _timed_out(name, timeout):
+    increment(f"timeouts.{name}")
+    print(f" [SYSTEM] {name} timed out after {timeout:.2f}s -> Continuing without it")
+
+def call_with_timeout(name, timeout, default, fn, *args, **kwargs):
+    """
+    Calls fn, giving up after `timeout` seconds (None waits indefinitely).
+    On timeout counts timeouts.<name> and returns `default`.
+    """
+    if timeout is None:
+        return fn(*args, **kwargs)
+    if timeout <= 0:
+        _timed_out(name, 0.0)
+        return default
+    future = _executor.submit(contextvars.copy_context().run, fn, *args, **kwargs)
+    try:
+        return future.result(timeout=timeout)
+    except FutureTimeoutError:
+        _timed_out(name, timeout)
+        return default
+
+async def acall_with_timeout(name, timeout, default, awaitable):
+    """Async counterpart of call_with_timeout for an awaitable (cancelled on timeout)."""
+    if timeout is None:
+        return await awaitable
+    try:
+        return await asyncio.wait_for(awaitable, max(0.0, timeout))
+    except asyncio.TimeoutError:
+        _timed_out(name, timeout)
+        return default
+
+def stream_with_deadline(state, fn, *args):
+    """
+    Iterates fn(*args) on a background thread and yields its items, raising
+    DeadlineExceeded as soon as the turn's deadline passes, also while waiting
+    for the first item (e.g. a slow first token or a retry backoff).
+    """
+    items = queue.Queue()
+    stop = threading.Event()
+
+    def pump():
+        iterator = fn(*args)
+        try:
+            for item in iterator:
+                if stop.is_set():
+                    break
+                items.put(("item", item))
+            items.put(("end", None))
+        except Exception as e:
+            items.put(("error", e))
+        finally:
+            close = getattr(iterator, "close", None)
+            if close is not None:
+                close()
+
+    context = contextvars.copy_context()
+    threading.Thread(target=context.run, args=(pump,), name="deadline-stream", daemon=True).start()
+    try:
+        while True:
+            try:
+                kind, payload = items.get(timeout=remaining(state))
+            except queue.Empty:
+                raise DeadlineExceeded("Turn deadline reached")
+            if kind == "end":
+                return
+            if kind == "error":
+                raise payload
+            yield payload
+    finally:
+        stop.set()
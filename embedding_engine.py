@@ -0,0 +1,103 @@
+import os
+import time
+import queue
+import threading
+from concurrent.futures import Future
+
+from metrics import span
+
+# Micro-batching: a worker takes the first waiting text, then keeps collecting
+# until the batch is full or EMBEDDING_BATCH_WAIT_MS have passed
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "32"))
+EMBEDDING_BATCH_WAIT_MS = float(os.getenv("EMBEDDING_BATCH_WAIT_MS", "5"))
+# Dedicated embedding threads; each runs one batch at a time (torch/onnxruntime parallelize inside a batch)
+EMBEDDING_WORKERS = int(os.getenv("EMBEDDING_WORKERS", "1"))
+
+# "torch" (default) or "onnx", optionally with a quantized export from the model repo,
+# e.g. EMBEDDING_ONNX_FILE=onnx/model_qint8_avx512_vnni.onnx (same 384-dim output)
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "torch").lower()
+EMBEDDING_ONNX_FILE = os.getenv("EMBEDDING_ONNX_FILE")
+
+_STOP = object()
+
+def embedding_model_kwargs():
+    """model_kwargs for HuggingFaceEmbeddings selecting the configured sentence-transformers backend."""
+    if EMBEDDING_BACKEND != "onnx":
+        return {}
+    kwargs = {"backend": "onnx"}
+    if EMBEDDING_ONNX_FILE:
+        kwargs["model_kwargs"] = {"file_name": EMBEDDING_ONNX_FILE}
+    return kwargs
+
+class EmbeddingEngine:
+    """
+    Gathers concurrent embedding requests into micro-batches and runs each
+    batch through model.embed_documents on dedicated worker threads.
+    Callers block only on their own result. For all-MiniLM-L6-v2 query and
+    document embeddings are identical, so results match embed_query.
+    """
+    def __init__(self, model, batch_size=EMBEDDING_BATCH_SIZE, batch_wait_ms=EMBEDDING_BATCH_WAIT_MS,
+                 workers=EMBEDDING_WORKERS):
+        self.model = model
+        self.batch_size = max(1, batch_size)
+        self.batch_wait = batch_wait_ms / 1000.0
+        self._queue = queue.Queue()
+        self._threads = [
+            threading.Thread(target=self._run, name=f"embedding-{i}", daemon=True)
+            for i in range(max(1, workers))
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, text):
+        """Queues one text, returning a Future for its vector."""
+        future = Future()
+        self._queue.put((text, future))
+        return future
+
+    def embed(self, text):
+        return self.submit(text).result()
+
+    def embed_many(self, texts):
+        """Embeds several texts; they are queued together, so they usually share a batch."""
+        futures = [self.submit(text) for text in texts]
+        return [future.result() for future in futures]
+
+    def _collect(self, first):
+        batch = [first]
+        deadline = time.monotonic() + self.batch_wait
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is _STOP:
+                # Leave the sentinel for the worker loop once this batch is done
+                self._queue.put(_STOP)
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self):
+        while True:
+            first = self._queue.get()
+            if first is _STOP:
+                self._queue.put(_STOP)
+                return
+            batch = self._collect(first)
+            texts = [text for text, _ in batch]
+            try:
+                with span("embedding.batch", size=len(texts)):
+                    vectors = self.model.embed_documents(texts)
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future), vector in zip(batch, vectors):
+                future.set_result(vector)
+
+    def shutdown(self):
+        self._queue.put(_STOP)
+        for thread in self._threads:
+            thread.join(timeout=5)
@@ -0,0 +1,89 @@
+import re
+import time
+import random
+import asyncio
+import itertools
+from typing import Any, List, Optional
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from pydantic import PrivateAttr
+
+class FakeProviderError(Exception):
+    """Injected provider failure; carries an HTTP-like status_code (429 by default)."""
+    def __init__(self, message, status_code=429):
+        super().__init__(message)
+        self.status_code = status_code
+
+class FakeChatModel(BaseChatModel):
+    """
+    Deterministic offline chat model for local testing.
+    Cycles through `responses` and simulates provider latency: `first_token_latency`
+    (plus up to `latency_jitter` extra) before the first token and `token_latency`
+    between tokens. With `error_rate` > 0, that fraction of calls fails before the
+    first token with FakeProviderError(`error_status`). Supports invoke/ainvoke as
+    well as token-level stream/astream.
+    """
+    responses: List[str] = [
+        "Thanks for reaching out to MakTek support. Could you share your order number so I can look into this?",
+        "I don't know the answer to that yet, but I can escalate this to a human agent if you'd like.",
+    ]
+    first_token_latency: float = 0.0
+    token_latency: float = 0.0
+    latency_jitter: float = 0.0
+    error_rate: float = 0.0
+    error_status: int = 429
+    seed: Optional[int] = None
+
+    _counter: Any = PrivateAttr(default_factory=itertools.count)
+    _rng: Any = PrivateAttr(default=None)
+
+    def model_post_init(self, __context):
+        self._rng = random.Random(self.seed)
+
+    def _first_token_delay(self):
+        """Returns the delay before the first token, or raises an injected error."""
+        if self.error_rate and self._rng.random() < self.error_rate:
+            raise FakeProviderError(f"Injected fake provider error ({self.error_status})", self.error_status)
+        return self.first_token_latency + (self._rng.uniform(0, self.latency_jitter) if self.latency_jitter else 0.0)
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-chat"
+
+    def _next_tokens(self):
+        text = self.responses[next(self._counter) % len(self.responses)]
+        return re.findall(r"\S+\s*", text)
+
+    def _generate(self, messages, stop: Optional[List[str]] = None, run_manager=None, **kwargs) -> ChatResult:
+        delay = self._first_token_delay()
+        tokens = self._next_tokens()
+        time.sleep(delay + self.token_latency * len(tokens))
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content="".join(tokens)))])
+
+    async def _agenerate(self, messages, stop: Optional[List[str]] = None, run_manager=None, **kwargs) -> ChatResult:
+        delay = self._first_token_delay()
+        tokens = self._next_tokens()
+        await asyncio.sleep(delay + self.token_latency * len(tokens))
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content="".join(tokens)))])
+
+    def _stream(self, messages, stop: Optional[List[str]] = None, run_manager=None, **kwargs):
+        time.sleep(self._first_token_delay())
+        for i, token in enumerate(self._next_tokens()):
+            if i:
+                time.sleep(self.token_latency)
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=token))
+            if run_manager:
+                run_manager.on_llm_new_token(token, chunk=chunk)
+            yield chunk
+
+    async def _astream(self, messages, stop: Optional[List[str]] = None, run_manager=None, **kwargs):
+        await asyncio.sleep(self._first_token_delay())
+        for i, token in enumerate(self._next_tokens()):
+            if i:
+                await asyncio.sleep(self.token_latency)
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=token))
+            if run_manager:
+                await run_manager.on_llm_new_token(token, chunk=chunk)
+            yield chunk
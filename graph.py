@@ -1,5 +1,8 @@
 
+import os
+import threading
 from typing import Literal
+from concurrent.futures import ThreadPoolExecutor
 
 from langgraph.graph import StateGraph, START, END
 from langgraph.checkpoint.memory import MemorySaver
@@ -7,66 +10,120 @@ from langgraph.store.memory import InMemoryStore
 from langchain_core.messages import SystemMessage, RemoveMessage
 
 from state import AgentState
-from config import get_model
+import llm_gateway
+from prompt_builder import count_tokens
+from metrics import instrument_node, set_thread_id, span
 from agents.supervisor import supervisor
-from agents.retriever import retrieve
-from agents.generator import generate
+from agents.retriever import retrieve, aretrieve, route_context
+from agents.history import load_history, aload_history
+from agents.generator import generate, agenerate
 from agents.escalator import escalate
 from agents.intent import intent_detector
 
-# Connect to a persistent SQLite DB for long-term memory mock (or actual InMemoryStore use)
-# For this task, we use InMemoryStore as requested for "Long-Term" (though technically ephemeral without persistence)
-# and MemorySaver for "Short-term".
+# We use InMemoryStore as requested for "Long-Term" (though technically ephemeral without persistence).
+# Short-term graph state goes to the checkpointer selected by CHECKPOINT_BACKEND:
+# "postgres" (default, durable, see checkpointer.py) or "memory" (MemorySaver, for local runs and tests).
+CHECKPOINT_BACKEND = os.getenv("CHECKPOINT_BACKEND", "postgres").lower()
+
+# Summarize once the unsummarized messages exceed this many tokens,
+# always keeping the latest SUMMARY_KEEP_MESSAGES messages verbatim
+SUMMARY_TOKEN_BUDGET = int(os.getenv("SUMMARY_TOKEN_BUDGET", "1500"))
+SUMMARY_KEEP_MESSAGES = int(os.getenv("SUMMARY_KEEP_MESSAGES", "2"))
+
+# Summaries are computed in the background; at most one job per thread at a time
+_summary_executor = ThreadPoolExecutor(max_workers=int(os.getenv("SUMMARY_WORKERS", "2")), thread_name_prefix="summarizer")
+_summary_jobs = {}
+_summary_jobs_lock = threading.Lock()
+
+def _needs_summary(messages):
+    # Threshold for summarization
+    if len(messages) <= SUMMARY_KEEP_MESSAGES:
+        return False
+    return sum(count_tokens(m.content) for m in messages if isinstance(m.content, str)) > SUMMARY_TOKEN_BUDGET
+
+def _summary_prompt(messages, summary):
+    # Create a summarization prompt
+    # Only messages that are not yet folded into the summary are sent
+    return (
+        f"Previous summary: {summary}\n\n"
+        "New lines of conversation:\n" + 
+        "\n".join([f"{m.type.capitalize()}: {m.content}" for m in messages if hasattr(m, 'content')]) + 
+        "\n\nUpdate the summary with the new lines, retaining key details for customer support."
+    )
+
+def _run_summary(config, messages, summary):
+    # Runs on the summary executor, outside the turn's context
+    set_thread_id(config.get("configurable", {}).get("thread_id"))
+    with span("llm.invoke", model=config.get("configurable", {}).get("model"), purpose="summary"):
+        new_summary_msg = llm_gateway.invoke(config, [SystemMessage(content=_summary_prompt(messages, summary))])
+    return [m.id for m in messages], new_summary_msg.content
 
 def summarize_conversation(state: AgentState):
     """
-    Middleware: Summarizes the conversation if it gets too long.
-    Prunes old messages to save tokens.
+    Middleware: Incrementally summarizes the conversation once it exceeds the token budget.
+    The LLM call runs in the background and never blocks the turn: a finished
+    summary is applied on the thread's next turn, pruning the messages it covers.
     """
     messages = state["messages"]
     summary = state.get("summary", "")
-    
-    # Threshold for summarization
-    if len(messages) > 6:
-        config = state.get("config", {})
-        model = get_model(config)
-        
-        # Create a summarization prompt
-        # We need to act on the *current* state of messages
-        
-        prompt = (
-            f"Previous summary: {summary}\n\n"
-            "New lines of conversation:\n" + 
-            "\n".join([m.content for m in messages if hasattr(m, 'content')]) + 
-            "\n\nSummarize the conversation so far, retaining key details for customer support."
-        )
-        
-        new_summary_msg = model.invoke([SystemMessage(content=prompt)])
-        new_summary = new_summary_msg.content
-        
-        # Logic to remove old messages and keep only the last 2 + summary
-        # We use RemoveMessage to delete from the graph state
-        delete_messages = [RemoveMessage(id=m.id) for m in messages[:-2]]
-        
-        print(f" [SYSTEM] Summarization triggered. New Summary: {new_summary[:50]}...")
-        
-        return {
-            "summary": new_summary,
-            "messages": delete_messages
-        }
-    
-    return {}
+    config = state.get("config", {})
+    thread_id = config.get("configurable", {}).get("thread_id", "default_thread")
+
+    with _summary_jobs_lock:
+        job = _summary_jobs.get(thread_id)
+        if job is not None and job.done():
+            del _summary_jobs[thread_id]
+        elif job is None and _needs_summary(messages):
+            # Snapshot everything except the latest messages and summarize it off the critical path
+            _summary_jobs[thread_id] = _summary_executor.submit(
+                _run_summary, config, list(messages[:-SUMMARY_KEEP_MESSAGES]), summary
+            )
+            job = None
+        else:
+            job = None
+
+    if job is None:
+        return {}
+
+    try:
+        summarized_ids, new_summary = job.result()
+    except Exception as e:
+        print(f" [ERROR] Error summarizing conversation: {e}")
+        return {}
 
-def build_graph():
+    # We use RemoveMessage to delete the summarized messages from the graph state
+    current_ids = {m.id for m in messages}
+    delete_messages = [RemoveMessage(id=message_id) for message_id in summarized_ids if message_id in current_ids]
+
+    print(f" [SYSTEM] Summarization applied. New Summary: {new_summary[:50]}...")
+
+    return {
+        "summary": new_summary,
+        "messages": delete_messages
+    }
+
+async def asummarize_conversation(state: AgentState):
+    """Async counterpart of summarize_conversation (which itself never blocks on the LLM)."""
+    return summarize_conversation(state)
+
+def build_graph(use_async=False):
+    """
+    Builds the agent graph. With use_async=True the I/O-bound nodes
+    (summarizer, retriever, history loader, generator) are coroutines, for driving the graph
+    with app.astream/ainvoke. The remaining nodes do no I/O and are shared.
+    """
     builder = StateGraph(AgentState)
-    
+
     # 1. Add Nodes
-    builder.add_node("supervisor", supervisor)
-    builder.add_node("retriever", retrieve)
-    builder.add_node("generator", generate)
-    builder.add_node("escalator", escalate)
-    builder.add_node("summarizer", summarize_conversation)
-    builder.add_node("intent_detector", intent_detector)
+    # Every node is timed as span "node.<name>" (see metrics.py)
+    builder.add_node("supervisor", instrument_node("supervisor", supervisor))
+    builder.add_node("retriever", instrument_node("retriever", aretrieve if use_async else retrieve))
+    builder.add_node("history_loader", instrument_node("history_loader", aload_history if use_async else load_history))
+    builder.add_node("context_router", instrument_node("context_router", route_context))
+    builder.add_node("generator", instrument_node("generator", agenerate if use_async else generate))
+    builder.add_node("escalator", instrument_node("escalator", escalate))
+    builder.add_node("summarizer", instrument_node("summarizer", asummarize_conversation if use_async else summarize_conversation))
+    builder.add_node("intent_detector", instrument_node("intent_detector", intent_detector))
 
     # 2. Add Edges
     # Start at Intent Detector
@@ -83,16 +140,27 @@ def build_graph():
     # but we do need to register the possible destinations if using old style. 
     # With Command, we just need nodes to be added.
     
+    # Retriever and History Loader run in parallel; the Context Router waits for both
+    builder.add_edge(["retriever", "history_loader"], "context_router")
+    
     # Implicit logic:
-    # Supervisor -> Retriever or Escalator
-    # Retriever -> Generator or Escalator
-    # Generator -> END (or loop back)
+    # Supervisor -> (Retriever + History Loader) or Escalator
+    # Context Router -> Generator or Escalator
+    # Generator -> END (escalating through the model cascade internally)
     # Escalator -> END
 
     # 3. Setup Memory
-    memory = MemorySaver()
-    store = InMemoryStore() # Can be used to store user preferences
-    
+    # The sync and async graphs share one checkpointer and store, so either can continue a thread
     return builder.compile(checkpointer=memory, store=store)
 
+def create_checkpointer():
+    if CHECKPOINT_BACKEND == "memory":
+        return MemorySaver()
+    from checkpointer import PostgresCheckpointer
+    return PostgresCheckpointer()
+
+memory = create_checkpointer()
+store = InMemoryStore() # Can be used to store user preferences
+
 app = build_graph()
+aapp = build_graph(use_async=True)
@@ -0,0 +1,425 @@
+import os
+import time
+import queue
+import random
+import asyncio
+import threading
+import contextvars
+from collections import deque
+from contextlib import contextmanager, asynccontextmanager
+
+from langchain_core.messages import convert_to_messages
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, LLMResult
+from langchain_core.runnables.config import (
+    var_child_runnable_config, get_callback_manager_for_config, get_async_callback_manager_for_config
+)
+
+from config import get_model, resolve_model, DEFAULT_MODEL
+from metrics import observe, increment
+
+# Admission control, per provider ("groq", "openai", ...). Provider-specific overrides use the
+# upper-cased provider name as a suffix, e.g. LLM_MAX_CONCURRENCY_GROQ=8, LLM_RATE_LIMIT_GROQ=0.5
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "32"))
+# Requests per second (token bucket refill rate; 0 = unlimited) and bucket size
+LLM_RATE_LIMIT = float(os.getenv("LLM_RATE_LIMIT", "0"))
+LLM_RATE_BURST = int(os.getenv("LLM_RATE_BURST", "10"))
+# Seconds a call may wait for a concurrency slot before it is rejected
+LLM_ADMISSION_TIMEOUT = float(os.getenv("LLM_ADMISSION_TIMEOUT", "10"))
+
+# Retries of rate-limited / transient failures, with full-jitter exponential backoff
+LLM_RETRIES = int(os.getenv("LLM_RETRIES", "2"))
+LLM_BACKOFF_BASE = float(os.getenv("LLM_BACKOFF_BASE", "0.25"))
+LLM_BACKOFF_MAX = float(os.getenv("LLM_BACKOFF_MAX", "4"))
+
+# Hedging: if the primary has produced no token after its p95 time to first token
+# (LLM_HEDGE_AFTER until LLM_HEDGE_MIN_SAMPLES are recorded), the same prompt is sent to
+# LLM_HEDGE_MODEL and the first to answer wins. Also used as the fallback when the primary fails.
+LLM_HEDGE_MODEL = os.getenv("LLM_HEDGE_MODEL", "")
+LLM_HEDGE_AFTER = float(os.getenv("LLM_HEDGE_AFTER", "2.0"))
+LLM_HEDGE_MIN_SAMPLES = int(os.getenv("LLM_HEDGE_MIN_SAMPLES", "20"))
+
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504, 529}
+
+class LLMOverloadedError(Exception):
+    """Raised when a provider has no free concurrency slot within LLM_ADMISSION_TIMEOUT."""
+
+def _provider_setting(name, provider, default, cast):
+    return cast(os.getenv(f"{name}_{provider.upper()}", default))
+
+class TokenBucket:
+    """Thread-safe token bucket; reserve() takes a token and returns how long to wait for it."""
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.capacity = max(1, burst)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+class ProviderLimiter:
+    """Concurrency semaphore and optional rate limit for one provider."""
+    def __init__(self, provider):
+        self.provider = provider
+        self.semaphore = threading.BoundedSemaphore(_provider_setting("LLM_MAX_CONCURRENCY", provider, LLM_MAX_CONCURRENCY, int))
+        rate = _provider_setting("LLM_RATE_LIMIT", provider, LLM_RATE_LIMIT, float)
+        self.bucket = TokenBucket(rate, _provider_setting("LLM_RATE_BURST", provider, LLM_RATE_BURST, int)) if rate > 0 else None
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+def _limiter(provider):
+    with _limiters_lock:
+        if provider not in _limiters:
+            _limiters[provider] = ProviderLimiter(provider)
+        return _limiters[provider]
+
+# Recent times to first token per model, for the hedging threshold
+_first_token_times = {}
+_first_token_lock = threading.Lock()
+
+def _record_first_token(model_name, seconds):
+    with _first_token_lock:
+        _first_token_times.setdefault(model_name, deque(maxlen=200)).append(seconds)
+
+def hedge_after(model_name):
+    """Seconds to wait for the primary's first token before hedging: its recent p95, or LLM_HEDGE_AFTER."""
+    with _first_token_lock:
+        samples = sorted(_first_token_times.get(model_name, ()))
+    if len(samples) < LLM_HEDGE_MIN_SAMPLES:
+        return LLM_HEDGE_AFTER
+    return samples[min(len(samples) - 1, int(0.95 * len(samples)))]
+
+def _retryable(error):
+    if isinstance(error, LLMOverloadedError):
+        # Already waited LLM_ADMISSION_TIMEOUT; let the caller fall back instead
+        return False
+    status = getattr(error, "status_code", None) or getattr(getattr(error, "response", None), "status_code", None)
+    if status is not None:
+        return status in RETRYABLE_STATUS_CODES
+    name = type(error).__name__
+    return any(marker in name for marker in ("RateLimit", "Timeout", "Connection", "Overloaded", "ServiceUnavailable"))
+
+def _backoff(attempt):
+    return random.uniform(0, min(LLM_BACKOFF_MAX, LLM_BACKOFF_BASE * 2 ** attempt))
+
+def _model_name(config):
+    return config.get("configurable", {}).get("model", DEFAULT_MODEL)
+
+def _hedge_config(config):
+    model_name = _model_name(config)
+    if not LLM_HEDGE_MODEL or LLM_HEDGE_MODEL == model_name:
+        return None
+    return {**config, "configurable": {**config.get("configurable", {}), "model": LLM_HEDGE_MODEL}}
+
+# --- admission ---
+
+@contextmanager
+def _admitted(provider):
+    limiter = _limiter(provider)
+    start = time.perf_counter()
+    if not limiter.semaphore.acquire(timeout=LLM_ADMISSION_TIMEOUT):
+        increment(f"llm.rejected.{provider}")
+        raise LLMOverloadedError(f"No free {provider} slot within {LLM_ADMISSION_TIMEOUT}s")
+    try:
+        if limiter.bucket is not None:
+            wait = limiter.bucket.reserve()
+            if wait > 0:
+                time.sleep(wait)
+        observe(f"llm.admission_wait.{provider}", time.perf_counter() - start)
+        yield
+    finally:
+        limiter.semaphore.release()
+
+@asynccontextmanager
+async def _aadmitted(provider):
+    limiter = _limiter(provider)
+    start = time.perf_counter()
+    deadline = time.monotonic() + LLM_ADMISSION_TIMEOUT
+    delay = 0.005
+    # Poll instead of blocking, so waiting for a slot never stalls the event loop
+    while not limiter.semaphore.acquire(blocking=False):
+        if time.monotonic() >= deadline:
+            increment(f"llm.rejected.{provider}")
+            raise LLMOverloadedError(f"No free {provider} slot within {LLM_ADMISSION_TIMEOUT}s")
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, 0.05)
+    try:
+        if limiter.bucket is not None:
+            wait = limiter.bucket.reserve()
+            if wait > 0:
+                await asyncio.sleep(wait)
+        observe(f"llm.admission_wait.{provider}", time.perf_counter() - start)
+        yield
+    finally:
+        limiter.semaphore.release()
+
+# --- single-model calls with retries ---
+
+def _stream_with_retries(config, messages):
+    model_name = _model_name(config)
+    provider = resolve_model(model_name)[0]
+    for attempt in range(LLM_RETRIES + 1):
+        started = False
+        try:
+            with _admitted(provider):
+                start = time.perf_counter()
+                for chunk in get_model(config).stream(messages):
+                    if not started:
+                        started = True
+                        _record_first_token(model_name, time.perf_counter() - start)
+                    yield chunk
+            return
+        except Exception as e:
+            # Tokens already handed out can't be taken back, so only retry before the first one
+            if started or attempt == LLM_RETRIES or not _retryable(e):
+                raise
+            increment(f"llm.retries.{provider}")
+            print(f" [SYSTEM] {model_name} failed ({e}) -> Retrying")
+            time.sleep(_backoff(attempt))
+
+async def _astream_with_retries(config, messages):
+    model_name = _model_name(config)
+    provider = resolve_model(model_name)[0]
+    for attempt in range(LLM_RETRIES + 1):
+        started = False
+        try:
+            async with _aadmitted(provider):
+                start = time.perf_counter()
+                async for chunk in get_model(config).astream(messages):
+                    if not started:
+                        started = True
+                        _record_first_token(model_name, time.perf_counter() - start)
+                    yield chunk
+            return
+        except Exception as e:
+            if started or attempt == LLM_RETRIES or not _retryable(e):
+                raise
+            increment(f"llm.retries.{provider}")
+            print(f" [SYSTEM] {model_name} failed ({e}) -> Retrying")
+            await asyncio.sleep(_backoff(attempt))
+
+def invoke(config, messages):
+    """Calls the configured model once (with admission control and retries) and returns its message."""
+    model_name = _model_name(config)
+    provider = resolve_model(model_name)[0]
+    for attempt in range(LLM_RETRIES + 1):
+        try:
+            with _admitted(provider):
+                return get_model(config).invoke(messages)
+        except Exception as e:
+            if attempt == LLM_RETRIES or not _retryable(e):
+                raise
+            increment(f"llm.retries.{provider}")
+            time.sleep(_backoff(attempt))
+
+# --- hedged streaming ---
+# Both models stream with callbacks off; the winner's chunks are replayed through a chat model
+# run opened on the caller's callbacks, so graph consumers see exactly one model's tokens.
+
+def _winner_run(model_name, messages):
+    config = var_child_runnable_config.get()
+    if not config:
+        return None
+    manager = get_callback_manager_for_config(config)
+    return manager.on_chat_model_start({"name": model_name}, [convert_to_messages(messages)], name=model_name)[0]
+
+async def _awinner_run(model_name, messages):
+    config = var_child_runnable_config.get()
+    if not config:
+        return None
+    manager = get_async_callback_manager_for_config(config)
+    return (await manager.on_chat_model_start({"name": model_name}, [convert_to_messages(messages)], name=model_name))[0]
+
+def _winner_result(message):
+    return LLMResult(generations=[[ChatGeneration(message=message)]] if message is not None else [[]])
+
+def _pump(name, config, messages, items, stop):
+    """Thread body: streams one model into the shared queue until told to stop."""
+    var_child_runnable_config.set(None)
+    chunks = _stream_with_retries(config, messages)
+    try:
+        for chunk in chunks:
+            if stop.is_set():
+                break
+            items.put((name, "chunk", chunk))
+        items.put((name, "end", None))
+    except Exception as e:
+        items.put((name, "error", e))
+    finally:
+        chunks.close()
+
+def stream(config, messages):
+    """
+    Streams the configured model's answer through the gateway: admission
+    control, retries and, if LLM_HEDGE_MODEL is set, hedging/fallback to it.
+    """
+    hedge_config = _hedge_config(config)
+    if hedge_config is None:
+        yield from _stream_with_retries(config, messages)
+        return
+
+    items = queue.Queue()
+    stops = {"primary": threading.Event(), "hedge": threading.Event()}
+
+    def start(name, target_config):
+        context = contextvars.copy_context()
+        threading.Thread(
+            target=context.run, args=(_pump, name, target_config, messages, items, stops[name]),
+            name=f"llm-{name}", daemon=True
+        ).start()
+
+    start("primary", config)
+    started_at = time.monotonic()
+    threshold = hedge_after(_model_name(config))
+    running, winner, hedged, fallback = {"primary"}, None, False, False
+    run, message = None, None
+    try:
+        while True:
+            timeout = None if hedged or winner else max(0.0, started_at + threshold - time.monotonic())
+            try:
+                name, kind, payload = items.get(timeout=timeout)
+            except queue.Empty:
+                print(f" [SYSTEM] No first token after {threshold:.2f}s -> Hedging with {LLM_HEDGE_MODEL}")
+                increment("llm.hedges")
+                start("hedge", hedge_config)
+                running.add("hedge")
+                hedged = True
+                continue
+
+            if winner is not None and name != winner:
+                continue
+            if kind == "chunk":
+                if winner is None:
+                    winner = name
+                    stops["hedge" if name == "primary" else "primary"].set()
+                    if name == "hedge" and not fallback:
+                        increment("llm.hedge_wins")
+                    run = _winner_run(_model_name(config if name == "primary" else hedge_config), messages)
+                message = payload if message is None else message + payload
+                if run is not None:
+                    run.on_llm_new_token(payload.content, chunk=ChatGenerationChunk(message=payload))
+                yield payload
+            elif kind == "end":
+                if winner is None:
+                    winner = name
+                return
+            else:
+                running.discard(name)
+                if winner == name or (not running and hedged):
+                    raise payload
+                if not hedged:
+                    # Primary failed outright: fall back to the secondary model
+                    print(f" [SYSTEM] {_model_name(config)} failed ({payload}) -> Falling back to {LLM_HEDGE_MODEL}")
+                    increment("llm.fallbacks")
+                    fallback = True
+                    start("hedge", hedge_config)
+                    running.add("hedge")
+                    hedged = True
+    except Exception as e:
+        if run is not None:
+            run.on_llm_error(e)
+            run = None
+        raise
+    finally:
+        # Also reached when the caller stops early (e.g. its deadline passed)
+        if run is not None:
+            run.on_llm_end(_winner_result(message))
+        for stop in stops.values():
+            stop.set()
+
+async def astream(config, messages):
+    """Async counterpart of stream."""
+    hedge_config = _hedge_config(config)
+    if hedge_config is None:
+        async for chunk in _astream_with_retries(config, messages):
+            yield chunk
+        return
+
+    items = asyncio.Queue()
+    # Attempts whose time to first token has been recorded
+    timed = set()
+
+    async def pump(name, target_config):
+        var_child_runnable_config.set(None)
+        try:
+            async for chunk in _astream_with_retries(target_config, messages):
+                timed.add(name)
+                await items.put((name, "chunk", chunk))
+            await items.put((name, "end", None))
+        except Exception as e:
+            await items.put((name, "error", e))
+
+    tasks = {"primary": asyncio.create_task(pump("primary", config))}
+    started_at = time.monotonic()
+
+    def cancel(name):
+        task = tasks.get(name)
+        if task is None or task.done():
+            return
+        if name == "primary" and name not in timed:
+            # Record how long the primary had waited (a censored sample); otherwise only the fast
+            # answers count, and the hedge delay, their p95, keeps drifting down
+            _record_first_token(_model_name(config), time.monotonic() - started_at)
+            timed.add(name)
+        task.cancel()
+    threshold = hedge_after(_model_name(config))
+    running, winner, hedged, fallback = {"primary"}, None, False, False
+    run, message = None, None
+    try:
+        while True:
+            timeout = None if hedged or winner else max(0.0, started_at + threshold - time.monotonic())
+            try:
+                name, kind, payload = await asyncio.wait_for(items.get(), timeout)
+            except asyncio.TimeoutError:
+                print(f" [SYSTEM] No first token after {threshold:.2f}s -> Hedging with {LLM_HEDGE_MODEL}")
+                increment("llm.hedges")
+                tasks["hedge"] = asyncio.create_task(pump("hedge", hedge_config))
+                running.add("hedge")
+                hedged = True
+                continue
+
+            if winner is not None and name != winner:
+                continue
+            if kind == "chunk":
+                if winner is None:
+                    winner = name
+                    cancel("hedge" if name == "primary" else "primary")
+                    if name == "hedge" and not fallback:
+                        increment("llm.hedge_wins")
+                    run = await _awinner_run(_model_name(config if name == "primary" else hedge_config), messages)
+                message = payload if message is None else message + payload
+                if run is not None:
+                    await run.on_llm_new_token(payload.content, chunk=ChatGenerationChunk(message=payload))
+                yield payload
+            elif kind == "end":
+                if winner is None:
+                    winner = name
+                return
+            else:
+                running.discard(name)
+                if winner == name or (not running and hedged):
+                    raise payload
+                if not hedged:
+                    print(f" [SYSTEM] {_model_name(config)} failed ({payload}) -> Falling back to {LLM_HEDGE_MODEL}")
+                    increment("llm.fallbacks")
+                    fallback = True
+                    tasks["hedge"] = asyncio.create_task(pump("hedge", hedge_config))
+                    running.add("hedge")
+                    hedged = True
+    except Exception as e:
+        if run is not None:
+            await run.on_llm_error(e)
+            run = None
+        raise
+    finally:
+        for name in list(tasks):
+            cancel(name)
+        if run is not None:
+            await run.on_llm_end(_winner_result(message))
@@ -1,8 +1,11 @@
 
 import os
+import time
 
-# Suppress TensorFlow oneDNN custom operations warning
-os.environ["TF_ENABLE_ONEDNN_OPTS"] = "0"
+_import_start = time.perf_counter()
+
+# sentence-transformers only needs torch; keep transformers from importing TensorFlow
+os.environ.setdefault("USE_TF", "0")
 import uuid
 from langchain_core.messages import HumanMessage
 from dotenv import load_dotenv
@@ -11,19 +14,75 @@ from dotenv import load_dotenv
 load_dotenv()
 
 from graph import app
-from db import init_db, save_message
-from vector_store import init_pinecone, store_embedding
+from db import init_db
+from vector_store import init_pinecone
+from persistence import enqueue_message, shutdown as shutdown_persistence
+from tickets import start_ticket_worker
+from archive import start_partition_maintenance
+from metrics import set_thread_id, span, record_startup, startup_phase, print_startup_report
+from deadline import with_deadline
+
+record_startup("imports", time.perf_counter() - _import_start)
 
 # Ensure API key is set for testing
 if not os.environ.get("GROQ_API_KEY"):
     print("Warning: GROQ_API_KEY not set in .env. Please set it for Groq to work.")
 
+def process_turn(user_id, thread_id, user_input, config):
+    """
+    Runs one user turn through the graph and returns the assistant's answer.
+    Messages and embeddings are handed to the write-behind queue, so the
+    reply does not wait on PostgreSQL or the vector store.
+    """
+    # Tag this turn's latency spans with its thread
+    set_thread_id(thread_id)
+
+    # Queue user message for the persistent DB and vector store
+    user_msg_id = str(uuid.uuid4())
+    enqueue_message(user_id=user_id, role="user", content=user_input, thread_id=thread_id, message_id=user_msg_id)
+
+    # Invoke the graph
+    # We pass the user input as a new message
+    # And user_info in the state
+    inputs = {
+        "messages": [HumanMessage(content=user_input)],
+        "user_info": {"user_id": user_id},
+        # Pass config into state so nodes can access it, along with this turn's deadline
+        "config": with_deadline(config)
+    }
+
+    # Stream events or just get final state
+    # For simplicity, we'll just return the final response from the assistant
+    final_answer = ""
+    with span("turn"):
+        for event in app.stream(inputs, config=config):
+            for key, value in event.items():
+                # Value is the state update
+                # print(f"DEBUG: Node '{key}' finished.")
+                if value and "messages" in value and value["messages"]:
+                     # Check if it's an AI Message (generation)
+                     last_msg = value["messages"][-1]
+                     if hasattr(last_msg, "content") and last_msg.type == "ai":
+                         final_answer = last_msg.content
+
+    if final_answer:
+        # Queue assistant message for the persistent DB and vector store
+        ai_msg_id = str(uuid.uuid4())
+        enqueue_message(user_id=user_id, role="assistant", content=final_answer, thread_id=thread_id, message_id=ai_msg_id)
+
+    return final_answer
+
 def run_chat_loop():
     print("Initializing MakTek Support System...")
     
-    # Initialize DB and Pinecone
-    init_db()
-    init_pinecone()
+    # Initialize DB and Pinecone (the embedding model keeps loading in the background)
+    with startup_phase("init_db"):
+        init_db()
+    with startup_phase("init_vector_store"):
+        init_pinecone()
+    start_ticket_worker()
+    start_partition_maintenance()
+    print_startup_report()
     
     # Simulate a user session
     thread_id = str(uuid.uuid4())
@@ -39,54 +98,19 @@ def run_chat_loop():
     print(f"Session started for User {user_id} (Thread: {thread_id})")
     print("Type 'quit' to exit.")
     
-    while True:
-        user_input = input("User: ")
-        if user_input.lower() in ["quit", "exit"]:
-            break
-            
-        # Save user message to persistent DB and vector store
-        user_msg_id = str(uuid.uuid4())
-        save_message(user_id=user_id, role="user", content=user_input, thread_id=thread_id, message_id=user_msg_id)
-        store_embedding(user_id=user_id, message_id=user_msg_id, content=user_input, role="user")
-            
-        # Invoke the graph
-        # We pass the user input as a new message
-        # And user_info in the state
-        inputs = {
-            "messages": [HumanMessage(content=user_input)],
-            "user_info": {"user_id": user_id},
-            "config": config  # Pass config into state so nodes can access it
-        }
-        
-        # Stream events or just get final state
-        # For simplicity, we'll just print the final response from the assistant
-        
-        # We can use .stream() to see the steps
-        print(" [Assistant is thinking...]")
-        
-        final_answer = ""
-        for event in app.stream(inputs, config=config):
-            for key, value in event.items():
-                # Value is the state update
-                # print(f"DEBUG: Node '{key}' finished.")
-                if value and "messages" in value and value["messages"]:
-                     # Check if it's an AI Message (generation)
-                     last_msg = value["messages"][-1]
-                     if hasattr(last_msg, "content") and last_msg.type == "ai":
-                         final_answer = last_msg.content
-        
-        if final_answer:
-            print(f"MakTek: {final_answer}")
-            # Save assistant message to persistent DB and vector store
-            ai_msg_id = str(uuid.uuid4())
-            save_message(user_id=user_id, role="assistant", content=final_answer, thread_id=thread_id, message_id=ai_msg_id)
-            store_embedding(user_id=user_id, message_id=ai_msg_id, content=final_answer, role="assistant")
-            
-        else:
-             # Fallback if no final answer generated (e.g. escalation only or partial validation)
-             # Logic needs to be robust to pull from state if stream didn't catch it
-             # snapshot = app.get_state(config)
-             pass
+    try:
+        while True:
+            user_input = input("User: ")
+            if user_input.lower() in ["quit", "exit"]:
+                break
+
+            print(" [Assistant is thinking...]")
+            final_answer = process_turn(user_id, thread_id, user_input, config)
+            if final_answer:
+                print(f"MakTek: {final_answer}")
+    finally:
+        # Drain pending writes before exiting
+        shutdown_persistence()
 
 if __name__ == "__main__":
     run_chat_loop()
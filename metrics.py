@@ -0,0 +1,208 @@
+import os
+import json
+import time
+import atexit
+import random
+import bisect
+import inspect
+import functools
+import threading
+import contextvars
+from contextlib import contextmanager
+
+# Span timing is cheap (two perf_counter calls and one lock per span); METRICS_ENABLED=0 turns it off entirely
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") == "1"
+# Optional JSONL trace of individual spans; TRACE_SAMPLE_RATE keeps a fraction of them
+TRACE_FILE = os.getenv("TRACE_FILE")
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "1.0"))
+
+# Histogram bucket upper bounds, in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Thread of the turn being processed, attached to every span recorded while it is set
+current_thread_id = contextvars.ContextVar("current_thread_id", default=None)
+
+# (span, status) -> [bucket counts (+Inf last), sum, count]
+_histograms = {}
+_histograms_lock = threading.Lock()
+
+# event -> count
+_counters = {}
+
+_trace_file = None
+_trace_lock = threading.Lock()
+
+# Start-up phase -> seconds, for the start-up report
+_startup_phases = {}
+
+def set_thread_id(thread_id):
+    """Tags spans recorded in the current context with thread_id. Returns a token for current_thread_id.reset."""
+    return current_thread_id.set(thread_id)
+
+def observe(name, seconds, status="ok", **attrs):
+    """Records one duration for the named span in its histogram (and in the trace file, if enabled)."""
+    if not METRICS_ENABLED:
+        return
+    position = bisect.bisect_left(LATENCY_BUCKETS, seconds)
+    with _histograms_lock:
+        histogram = _histograms.get((name, status))
+        if histogram is None:
+            histogram = _histograms[(name, status)] = [[0] * (len(LATENCY_BUCKETS) + 1), 0.0, 0]
+        histogram[0][position] += 1
+        histogram[1] += seconds
+        histogram[2] += 1
+
+    if TRACE_FILE and (TRACE_SAMPLE_RATE >= 1.0 or random.random() < TRACE_SAMPLE_RATE):
+        _write_trace(name, seconds, status, attrs)
+
+def increment(name, amount=1):
+    """Adds to the named event counter (escalations, timeouts, ...)."""
+    if not METRICS_ENABLED:
+        return
+    with _histograms_lock:
+        _counters[name] = _counters.get(name, 0) + amount
+
+def counters():
+    with _histograms_lock:
+        return dict(_counters)
+
+def _write_trace(name, seconds, status, attrs):
+    global _trace_file
+    record = {
+        "ts": time.time(),
+        "span": name,
+        "duration_ms": round(seconds * 1000, 3),
+        "status": status,
+        "thread_id": attrs.pop("thread_id", None) or current_thread_id.get(),
+    }
+    record.update(attrs)
+    line = json.dumps(record, default=str) + "\n"
+    try:
+        with _trace_lock:
+            if _trace_file is None:
+                # Buffered; flushed when the buffer fills and at exit
+                _trace_file = open(TRACE_FILE, "a", encoding="utf-8")
+            _trace_file.write(line)
+    except Exception as e:
+        print(f" [ERROR] Error writing trace: {e}")
+
+@contextmanager
+def span(name, **attrs):
+    """
+    Times the enclosed block as one span. Exceptions are recorded with
+    status="error" and re-raised. Extra keyword arguments go to the trace only.
+    """
+    if not METRICS_ENABLED:
+        yield
+        return
+    start = time.perf_counter()
+    status = "ok"
+    try:
+        yield
+    except BaseException:
+        status = "error"
+        raise
+    finally:
+        observe(name, time.perf_counter() - start, status, **attrs)
+
+def timed(name):
+    """Decorator form of span for sync and async functions."""
+    def decorator(fn):
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                with span(name):
+                    return await fn(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def _state_thread_id(state):
+    return state.get("config", {}).get("configurable", {}).get("thread_id")
+
+def instrument_node(name, node):
+    """
+    Wraps a graph node so each run is recorded as span "node.<name>", tagged
+    with the thread_id from the state's config. Signature and annotations are
+    preserved, so LangGraph still sees the node's Command destinations.
+    """
+    span_name = f"node.{name}"
+    if inspect.iscoroutinefunction(node):
+        @functools.wraps(node)
+        async def async_wrapper(state):
+            token = current_thread_id.set(_state_thread_id(state))
+            try:
+                with span(span_name):
+                    return await node(state)
+            finally:
+                current_thread_id.reset(token)
+        return async_wrapper
+
+    @functools.wraps(node)
+    def wrapper(state):
+        token = current_thread_id.set(_state_thread_id(state))
+        try:
+            with span(span_name):
+                return node(state)
+        finally:
+            current_thread_id.reset(token)
+    return wrapper
+
+def record_startup(phase, seconds):
+    """Records how long a start-up phase (imports, DB init, model load, ...) took."""
+    _startup_phases[phase] = seconds
+    observe(f"startup.{phase}", seconds)
+
+@contextmanager
+def startup_phase(phase):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_startup(phase, time.perf_counter() - start)
+
+def startup_report():
+    """Returns the recorded start-up phases and their durations in seconds."""
+    return dict(_startup_phases)
+
+def print_startup_report():
+    phases = ", ".join(f"{phase} {seconds:.2f}s" for phase, seconds in _startup_phases.items())
+    print(f" [SYSTEM] Start-up times: {phases or 'none recorded'}")
+
+def render_prometheus():
+    """Returns all span histograms and event counters in the Prometheus text exposition format."""
+    with _histograms_lock:
+        items = sorted((key, (list(h[0]), h[1], h[2])) for key, h in _histograms.items())
+        counter_items = sorted(_counters.items())
+
+    lines = [
+        "# HELP chatbot_span_duration_seconds Duration of graph nodes and dependency calls.",
+        "# TYPE chatbot_span_duration_seconds histogram",
+    ]
+    for (name, status), (buckets, total, count) in items:
+        labels = f'span="{name}",status="{status}"'
+        cumulative = 0
+        for bound, bucket_count in zip(LATENCY_BUCKETS, buckets):
+            cumulative += bucket_count
+            lines.append(f'chatbot_span_duration_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+        lines.append(f'chatbot_span_duration_seconds_bucket{{{labels},le="+Inf"}} {count}')
+        lines.append(f"chatbot_span_duration_seconds_sum{{{labels}}} {total}")
+        lines.append(f"chatbot_span_duration_seconds_count{{{labels}}} {count}")
+
+    lines.append("# HELP chatbot_events_total Counted events such as model escalations and timeouts.")
+    lines.append("# TYPE chatbot_events_total counter")
+    for name, count in counter_items:
+        lines.append(f'chatbot_events_total{{event="{name}"}} {count}')
+    return "\n".join(lines) + "\n"
+
+def flush_trace():
+    with _trace_lock:
+        if _trace_file is not None:
+            _trace_file.flush()
+
+atexit.register(flush_trace)
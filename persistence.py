@@ -0,0 +1,194 @@
+import os
+import uuid
+import time
+import queue
+import atexit
+import threading
+from datetime import datetime
+
+from db import save_messages, remember_message
+from vector_store import store_embeddings
+from metrics import increment
+
+# Flush when this many messages are pending, or when the oldest has waited this long (seconds)
+PERSIST_BATCH_SIZE = int(os.getenv("PERSIST_BATCH_SIZE", "64"))
+PERSIST_FLUSH_INTERVAL = float(os.getenv("PERSIST_FLUSH_INTERVAL", "0.5"))
+# Rows whose write failed are retried with exponential backoff, at most PERSIST_MAX_RETRIES times
+PERSIST_MAX_RETRIES = int(os.getenv("PERSIST_MAX_RETRIES", "8"))
+PERSIST_RETRY_BASE = float(os.getenv("PERSIST_RETRY_BASE", "0.5"))
+PERSIST_RETRY_MAX = float(os.getenv("PERSIST_RETRY_MAX", "30"))
+
+_STOP = object()
+
+class WriteBehindQueue:
+    """
+    Background writer for messages and their embeddings.
+    Callers enqueue and return immediately; a single worker thread batches the
+    rows into one multi-row Postgres insert and one vector upsert per namespace.
+    A failed batch is retried row by row: rows that still fail while others
+    succeed are dropped as bad data, and if every row fails (the database is
+    down) they are retried later with backoff.
+    """
+    def __init__(self, batch_size=PERSIST_BATCH_SIZE, flush_interval=PERSIST_FLUSH_INTERVAL):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        # Rows waiting for a retry, owned by the worker thread
+        self._retry = []
+        self._retry_at = None
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+                self._thread.start()
+
+    def enqueue(self, user_id, role, content, thread_id="default_thread", message_id=None):
+        """
+        Queues a message for persistence and returns its message_id.
+        The thread's history ring buffer is updated immediately.
+        """
+        if not message_id:
+            message_id = str(uuid.uuid4())
+        remember_message(user_id, thread_id, role, content, message_id)
+        self._ensure_started()
+        self._queue.put({
+            "message_id": message_id,
+            "user_id": user_id,
+            "thread_id": thread_id,
+            "role": role,
+            "content": content,
+            "timestamp": datetime.now()
+        })
+        return message_id
+
+    def _run(self):
+        batch = []
+        deadline = None
+        while True:
+            wake_at = [t for t in (deadline, self._retry_at) if t is not None]
+            timeout = None if not wake_at else max(0.0, min(wake_at) - time.monotonic())
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+
+            if item is _STOP:
+                # Last attempt for rows still waiting on a retry
+                self._flush(self._retry + batch, requeue=False)
+                self._retry, self._retry_at = [], None
+                return
+            if isinstance(item, threading.Event):
+                # flush(): write everything queued before it, then keep running
+                retry, self._retry, self._retry_at = self._retry, [], None
+                self._flush(retry + batch)
+                batch, deadline = [], None
+                item.set()
+                continue
+            if item is not None:
+                if not batch:
+                    deadline = time.monotonic() + self.flush_interval
+                batch.append(item)
+
+            if self._retry and time.monotonic() >= self._retry_at:
+                batch = self._retry + batch
+                self._retry, self._retry_at = [], None
+                deadline = time.monotonic()
+
+            if batch and (len(batch) >= self.batch_size or time.monotonic() >= deadline):
+                self._flush(batch)
+                batch = []
+                deadline = None
+
+    def _flush(self, batch, requeue=True):
+        if not batch:
+            return
+        saved, failed = self._save(batch)
+        # Only stored rows get vectors, so a vector never points at a message that isn't stored
+        if saved:
+            store_embeddings(saved)
+        if failed:
+            if requeue:
+                self._schedule_retry(failed)
+            else:
+                print(f" [ERROR] Dropping {len(failed)} unsaved messages at shutdown")
+                increment("persistence.dropped", len(failed))
+
+    def _save(self, batch):
+        """Returns (saved rows, rows to retry)."""
+        try:
+            save_messages(batch)
+            return batch, []
+        except Exception as e:
+            print(f" [ERROR] Error flushing write-behind batch of {len(batch)}: {e}")
+        if len(batch) == 1:
+            return [], batch
+
+        saved, failed = [], []
+        for row in batch:
+            try:
+                save_messages([row])
+                saved.append(row)
+            except Exception as e:
+                print(f" [ERROR] Error saving message {row['message_id']}: {e}")
+                failed.append(row)
+        if saved and failed:
+            # The database accepts other rows, so these are bad data: retrying won't help
+            print(f" [ERROR] Dropping {len(failed)} messages the database rejected")
+            increment("persistence.dropped", len(failed))
+            return saved, []
+        return saved, failed
+
+    def _schedule_retry(self, rows):
+        retry = []
+        for row in rows:
+            row["attempts"] = row.get("attempts", 0) + 1
+            if row["attempts"] > PERSIST_MAX_RETRIES:
+                print(f" [ERROR] Dropping message {row['message_id']} after {PERSIST_MAX_RETRIES} retries")
+                increment("persistence.dropped")
+            else:
+                retry.append(row)
+        if not retry:
+            return
+        attempts = min(row["attempts"] for row in retry)
+        delay = min(PERSIST_RETRY_MAX, PERSIST_RETRY_BASE * 2 ** (attempts - 1))
+        increment("persistence.retries", len(retry))
+        self._retry.extend(retry)
+        self._retry_at = time.monotonic() + delay
+
+    def flush(self, timeout=10.0):
+        """Writes everything queued so far without stopping the worker. Returns False on timeout."""
+        with self._lock:
+            running = self._thread is not None and self._thread.is_alive()
+        if not running:
+            return True
+        done = threading.Event()
+        self._queue.put(done)
+        return done.wait(timeout)
+
+    def shutdown(self, timeout=10.0):
+        """Flushes everything queued so far and stops the worker thread."""
+        with self._lock:
+            thread = self._thread
+            self._thread = None
+        if thread is not None and thread.is_alive():
+            self._queue.put(_STOP)
+            thread.join(timeout)
+
+writer = WriteBehindQueue()
+
+def enqueue_message(user_id, role, content, thread_id="default_thread", message_id=None):
+    """Queues a message (and its embedding) for background persistence."""
+    return writer.enqueue(user_id, role, content, thread_id=thread_id, message_id=message_id)
+
+def flush(timeout=10.0):
+    """Waits until every message queued so far has been written (or has failed)."""
+    return writer.flush(timeout)
+
+def shutdown():
+    """Drains the write-behind queue. Registered to run at interpreter exit."""
+    writer.shutdown()
+
+atexit.register(shutdown)
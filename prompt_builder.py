@@ -0,0 +1,128 @@
+import os
+import re
+import threading
+
+# Prompt token budgets per model; anything not listed uses DEFAULT_PROMPT_TOKEN_BUDGET
+MODEL_TOKEN_BUDGETS = {
+    "llama-3.1-8b-instant": 4000,
+    "llama-3.3-70b-versatile": 6000,
+    "mixtral-8x7b-32768": 6000,
+}
+DEFAULT_PROMPT_TOKEN_BUDGET = int(os.getenv("DEFAULT_PROMPT_TOKEN_BUDGET", "4000"))
+# "tiktoken" (loaded in the background; its BPE file may need a download) or "chars" (~4 characters per token)
+PROMPT_TOKENIZER = os.getenv("PROMPT_TOKENIZER", "tiktoken").lower()
+
+INSTRUCTIONS = "You are a MakTek support agent. Use the provided context to answer the user's question."
+FALLBACK_INSTRUCTIONS = "If the answer is not in the context, say 'I don't know' or ask to escalate."
+
+_encoder = None
+_encoder_loading = threading.Lock()
+
+def _load_encoder():
+    global _encoder
+    try:
+        import tiktoken
+        # Downloads the BPE file on first use; without network this fails (or hangs) off the request path
+        _encoder = tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        print(f" [WARNING] tiktoken unavailable ({e}); estimating prompt tokens as ~4 characters each")
+
+def count_tokens(text):
+    """
+    Approximate token count, used to keep prompts within their budget.
+    Uses tiktoken's cl100k_base encoding (installed with langchain-openai), an
+    OpenAI tokenizer: for the Groq/Llama models counts are close but not exact,
+    so the budgets leave headroom. The encoding is loaded on a background
+    thread; until it is ready, or if it can't be loaded (e.g. no network for
+    the BPE download), counts use a ~4 characters per token estimate.
+    """
+    if _encoder is None and PROMPT_TOKENIZER == "tiktoken" and _encoder_loading.acquire(blocking=False):
+        threading.Thread(target=_load_encoder, name="tiktoken-load", daemon=True).start()
+    if _encoder is not None:
+        return len(_encoder.encode(text, disallowed_special=()))
+    return len(text) // 4 + 1
+
+def token_budget(model_name):
+    return MODEL_TOKEN_BUDGETS.get(model_name, DEFAULT_PROMPT_TOKEN_BUDGET)
+
+def _normalize(text):
+    return re.sub(r"\s+", " ", str(text)).strip().lower()
+
+def _doc_content(doc):
+    # Retrieved docs are formatted as "<Role> (past): <content>"
+    return doc.split("(past): ", 1)[-1]
+
+def assemble_prompt(messages, summary, past_history, docs, model_name):
+    """
+    Builds the generator's message list within the model's prompt token budget.
+    Sources are admitted by priority: instructions and the latest user message,
+    then the conversation summary, then recent graph messages (newest first),
+    retrieved docs (by rank) and finally PostgreSQL history rows.
+    Graph messages are deduplicated by message id only, so a question really
+    asked twice stays in the transcript twice. Docs and history rows, which
+    mostly repeat the transcript, are left out when their content is already in.
+    """
+    budget = token_budget(model_name)
+    latest, earlier = messages[-1], list(messages[:-1])
+
+    used = count_tokens(INSTRUCTIONS) + count_tokens(FALLBACK_INSTRUCTIONS) + count_tokens(str(latest.content))
+    seen = {_normalize(latest.content)}
+    seen_ids = {latest.id} if getattr(latest, "id", None) else set()
+
+    def admit(text, dedupe=True):
+        nonlocal used
+        key = _normalize(text)
+        if not key or (dedupe and key in seen):
+            return False
+        cost = count_tokens(text)
+        if used + cost > budget:
+            return False
+        seen.add(key)
+        used += cost
+        return True
+
+    summary_str = summary if summary and admit(summary) else ""
+
+    kept_messages = []
+    for message in reversed(earlier):
+        message_id = getattr(message, "id", None)
+        if message_id is not None and message_id in seen_ids:
+            continue
+        content = message.content if isinstance(message.content, str) else str(message.content)
+        if not _normalize(content):
+            continue
+        if not admit(content, dedupe=False):
+            # Keep the transcript contiguous: stop at the first message that doesn't fit
+            break
+        if message_id is not None:
+            seen_ids.add(message_id)
+        kept_messages.append(message)
+    kept_messages.reverse()
+
+    kept_docs = [doc for doc in docs if admit(_doc_content(doc))]
+
+    kept_history = []
+    history_ids = set()
+    for row in reversed(past_history):
+        if row.get("message_id") in history_ids:
+            continue
+        if admit(row["content"]):
+            kept_history.append(row)
+            if row.get("message_id"):
+                history_ids.add(row["message_id"])
+    kept_history.reverse()
+
+    history_str = "\n".join([f"{row['role'].capitalize()}: {row['content']}" for row in kept_history])
+    if not history_str:
+        history_str = "No recent history."
+    context_str = "\n\n".join(kept_docs) if kept_docs else "No relevant semantic context found."
+
+    system_prompt = (
+        f"{INSTRUCTIONS}\n"
+        + (f"--- Conversation Summary ---\n{summary_str}\n\n" if summary_str else "")
+        + f"--- Semantic Context (from Pinecone) ---\n{context_str}\n\n"
+        f"--- Recent Persistent History (from PostgreSQL) ---\n{history_str}\n\n"
+        f"{FALLBACK_INSTRUCTIONS}"
+    )
+
+    return [("system", system_prompt)] + kept_messages + [latest]
@@ -0,0 +1,123 @@
+import os
+import re
+import time
+import uuid
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "1") == "1"
+RESPONSE_CACHE_THRESHOLD = float(os.getenv("RESPONSE_CACHE_THRESHOLD", "0.95"))
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "3600"))
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "2000"))
+# In a conversation with history, queries shorter than this (in words) are follow-ups and never cached
+RESPONSE_CACHE_MIN_WORDS = int(os.getenv("RESPONSE_CACHE_MIN_WORDS", "4"))
+
+# Words that refer back to earlier turns ("what about it?", "does that apply to the other one too?")
+_ANAPHORA = {
+    "it", "its", "that", "this", "these", "those", "they", "them", "their", "he", "she", "him", "her",
+    "there", "one", "ones", "same", "other", "else", "again", "also", "too", "above", "previous", "earlier",
+}
+
+def context_fingerprint(user_id, docs):
+    """
+    Stable fingerprint of the scope an answer can be reused in: the user (answers
+    are never shared between users) and the retrieved docs it was generated from.
+    """
+    parts = [user_id or ""] + list(docs or [])
+    return hashlib.sha256("\x1e".join(parts).encode("utf-8")).hexdigest()
+
+def depends_on_context(query, history):
+    """
+    True for a follow-up whose meaning depends on earlier turns: a short or
+    anaphoric query in a conversation that has history. Its answer must not be
+    cached or served from the cache.
+    """
+    if not history:
+        return False
+    words = re.findall(r"[\w']+", query.lower())
+    return len(words) < RESPONSE_CACHE_MIN_WORDS or any(word in _ANAPHORA for word in words)
+
+class SemanticResponseCache:
+    """
+    Caches generator answers by query embedding.
+    A lookup hits when a stored query in the same scope (model name + context
+    fingerprint of the user and retrieved docs, see context_fingerprint) has
+    cosine similarity >= threshold with the new query. Follow-ups that depend
+    on the conversation (see depends_on_context) are kept out of the cache.
+    Entries expire after `ttl` seconds; beyond `max_entries` the least recently
+    used entry is evicted.
+    """
+    def __init__(self, threshold=RESPONSE_CACHE_THRESHOLD, ttl=RESPONSE_CACHE_TTL, max_entries=RESPONSE_CACHE_SIZE):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # entry_id -> (scope, unit vector, answer, expires_at)
+        self._scopes = {}              # scope -> set of entry_ids
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0, "expirations": 0}
+
+    @staticmethod
+    def _normalize(vector):
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _remove(self, entry_id):
+        scope = self._entries.pop(entry_id)[0]
+        ids = self._scopes.get(scope)
+        if ids is not None:
+            ids.discard(entry_id)
+            if not ids:
+                del self._scopes[scope]
+
+    def lookup(self, query_vector, model, context_fp):
+        """Returns the cached answer for a similar query in this scope, or None."""
+        scope = (model, context_fp)
+        now = time.time()
+        with self._lock:
+            entry_ids = list(self._scopes.get(scope, ()))
+            live = []
+            for entry_id in entry_ids:
+                if self._entries[entry_id][3] <= now:
+                    self._remove(entry_id)
+                    self._stats["expirations"] += 1
+                else:
+                    live.append(entry_id)
+
+            if live:
+                matrix = np.stack([self._entries[entry_id][1] for entry_id in live])
+                scores = matrix @ self._normalize(query_vector)
+                best = int(np.argmax(scores))
+                if scores[best] >= self.threshold:
+                    self._entries.move_to_end(live[best])
+                    self._stats["hits"] += 1
+                    return self._entries[live[best]][2]
+
+            self._stats["misses"] += 1
+            return None
+
+    def store(self, query_vector, model, context_fp, answer):
+        """Caches an answer for a query in the given scope."""
+        scope = (model, context_fp)
+        entry_id = uuid.uuid4().hex
+        with self._lock:
+            self._entries[entry_id] = (scope, self._normalize(query_vector), answer, time.time() + self.ttl)
+            self._scopes.setdefault(scope, set()).add(entry_id)
+            self._stats["stores"] += 1
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+                self._stats["evictions"] += 1
+
+    def stats(self):
+        """Returns hit/miss/eviction counters, the hit rate and the current size."""
+        with self._lock:
+            lookups = self._stats["hits"] + self._stats["misses"]
+            return {
+                **self._stats,
+                "size": len(self._entries),
+                "hit_rate": self._stats["hits"] / lookups if lookups else 0.0
+            }
+
+response_cache = SemanticResponseCache()
@@ -0,0 +1,144 @@
+import os
+import json
+import time
+import uuid
+import argparse
+
+_import_start = time.perf_counter()
+
+# sentence-transformers only needs torch; keep transformers from importing TensorFlow
+os.environ.setdefault("USE_TF", "0")
+from aiohttp import web, WSMsgType
+from dotenv import load_dotenv
+
+# Load environment variables from .env file
+load_dotenv()
+
+from async_runner import astream_turn, DEFAULT_MODEL
+from db import init_db, aclose_pool
+from vector_store import init_pinecone
+from persistence import shutdown as shutdown_persistence
+from tickets import start_ticket_worker, stop_ticket_worker
+from archive import start_partition_maintenance, stop_partition_maintenance
+from config import registry_stats
+from response_cache import response_cache
+from metrics import render_prometheus, record_startup, startup_phase, startup_report, print_startup_report
+
+record_startup("imports", time.perf_counter() - _import_start)
+
+def _parse_turn(payload):
+    """Validates a chat request body, returning (user_id, thread_id, message, model)."""
+    message = str(payload.get("message", "")).strip()
+    if not message:
+        raise ValueError("'message' is required")
+    user_id = str(payload.get("user_id", "guest"))
+    thread_id = str(payload.get("thread_id") or uuid.uuid4())
+    model = str(payload.get("model", DEFAULT_MODEL))
+    return user_id, thread_id, message, model
+
+async def chat(request):
+    """
+    POST /chat {"user_id", "thread_id", "message", "model"}
+    Streams the reply as newline-delimited JSON events: a "start" event with
+    the thread_id, one "token" event per generated token and a "final" event.
+    A "reset" event tells the client to discard the tokens received so far.
+    """
+    try:
+        user_id, thread_id, message, model = _parse_turn(await request.json())
+    except (ValueError, json.JSONDecodeError) as e:
+        return web.json_response({"error": str(e)}, status=400)
+
+    response = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+    await response.prepare(request)
+    await response.write((json.dumps({"type": "start", "thread_id": thread_id}) + "\n").encode("utf-8"))
+    try:
+        async for event in astream_turn(user_id, thread_id, message, model=model):
+            await response.write((json.dumps(event) + "\n").encode("utf-8"))
+    except Exception as e:
+        print(f" [ERROR] Error streaming turn for thread {thread_id}: {e}")
+        await response.write((json.dumps({"type": "error", "content": "Internal error"}) + "\n").encode("utf-8"))
+    await response.write_eof()
+    return response
+
+async def websocket(request):
+    """
+    GET /ws: one WebSocket per client. Each text frame is a chat request
+    (same body as POST /chat); replies are sent as JSON events, token by token.
+    """
+    ws = web.WebSocketResponse(heartbeat=30)
+    await ws.prepare(request)
+
+    async for msg in ws:
+        if msg.type != WSMsgType.TEXT:
+            continue
+        try:
+            user_id, thread_id, message, model = _parse_turn(json.loads(msg.data))
+        except (ValueError, json.JSONDecodeError) as e:
+            await ws.send_json({"type": "error", "content": str(e)})
+            continue
+
+        await ws.send_json({"type": "start", "thread_id": thread_id})
+        try:
+            async for event in astream_turn(user_id, thread_id, message, model=model):
+                await ws.send_json(event)
+        except Exception as e:
+            print(f" [ERROR] Error streaming turn for thread {thread_id}: {e}")
+            await ws.send_json({"type": "error", "content": "Internal error"})
+
+    return ws
+
+async def health(request):
+    return web.json_response({"status": "ok"})
+
+async def stats(request):
+    """GET /stats: model client registry, semantic response cache counters and start-up times."""
+    return web.json_response({
+        "model_registry": registry_stats(),
+        "response_cache": response_cache.stats(),
+        "startup_seconds": startup_report()
+    })
+
+async def metrics(request):
+    """GET /metrics: span latency histograms in the Prometheus text format."""
+    return web.Response(
+        body=render_prometheus().encode("utf-8"),
+        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+    )
+
+async def _on_startup(app):
+    with startup_phase("init_db"):
+        init_db()
+    with startup_phase("init_vector_store"):
+        init_pinecone()
+    start_ticket_worker()
+    start_partition_maintenance()
+    print_startup_report()
+
+async def _on_cleanup(app):
+    # Drain pending writes before exiting
+    shutdown_persistence()
+    stop_ticket_worker()
+    stop_partition_maintenance()
+    await aclose_pool()
+
+def create_app(init_backends=True):
+    """Builds the aiohttp application. Pass init_backends=False to skip DB/vector setup."""
+    app = web.Application()
+    app.router.add_post("/chat", chat)
+    app.router.add_get("/ws", websocket)
+    app.router.add_get("/health", health)
+    app.router.add_get("/stats", stats)
+    app.router.add_get("/metrics", metrics)
+    if init_backends:
+        app.on_startup.append(_on_startup)
+    app.on_cleanup.append(_on_cleanup)
+    return app
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="MakTek support streaming server")
+    parser.add_argument("--host", default=os.getenv("SERVER_HOST", "0.0.0.0"))
+    parser.add_argument("--port", type=int, default=int(os.getenv("SERVER_PORT", "8000")))
+    args = parser.parse_args()
+
+    print(f"MakTek Support server listening on http://{args.host}:{args.port}")
+    web.run_app(create_app(), host=args.host, port=args.port)
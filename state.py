@@ -6,5 +6,6 @@ class AgentState(TypedDict):
     messages: Annotated[list, add_messages]
     summary: str
     retrieved_docs: List[str]
+    history: List[Dict[str, Any]] # Recent persisted messages, loaded in parallel with retrieval
     config: Dict[str, Any]
     user_info: Dict[str, Any] # Store user preferences here
@@ -0,0 +1,34 @@
+import sys
+import types
+import asyncio
+
+import db
+
+class _FakePool:
+    def __init__(self):
+        # Bound to the loop that created it, like aiopg's pool
+        self.loop = asyncio.get_running_loop()
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+    async def wait_closed(self):
+        assert asyncio.get_running_loop() is self.loop
+
+def test_each_event_loop_gets_its_own_pool(monkeypatch):
+    async def create_pool(**kwargs):
+        return _FakePool()
+
+    monkeypatch.setitem(sys.modules, "aiopg", types.SimpleNamespace(create_pool=create_pool))
+
+    async def use_pool():
+        first, second = await asyncio.gather(db.aget_pool(), db.aget_pool())
+        assert first is second and first.loop is asyncio.get_running_loop()
+        await db.aclose_pool()
+        return first
+
+    # e.g. async_runner's asyncio.run per request
+    pools = [asyncio.run(use_pool()), asyncio.run(use_pool())]
+    assert pools[0] is not pools[1]
+    assert all(pool.closed for pool in pools)
@@ -0,0 +1,44 @@
+from langchain_core.messages import HumanMessage
+
+import tickets
+from agents.escalator import escalate
+
+def _escalate(user_id, text):
+    state = {
+        "messages": [HumanMessage(content=text)],
+        "user_info": {"user_id": user_id},
+        "config": {"configurable": {"thread_id": f"{user_id}_thread"}},
+    }
+    return escalate(state).update["messages"][0].content
+
+def test_escalation_replies_without_database(monkeypatch):
+    written = []
+    monkeypatch.setattr(tickets, "create_ticket", lambda ticket: written.append(ticket) or ticket["ticket_id"])
+
+    first = _escalate("esc_user", "I want to talk to a human agent")
+    repeat = _escalate("esc_user", "i want to talk to a HUMAN agent!")
+    assert tickets.ticket_writer.flush()
+
+    assert "has been created" in first
+    assert "is already open" in repeat
+    assert len(written) == 1
+    assert f"#{written[0]['ticket_id']}" in first and f"#{written[0]['ticket_id']}" in repeat
+
+def test_failed_outbox_write_is_retried(monkeypatch):
+    attempts = []
+
+    def flaky_create_ticket(ticket):
+        attempts.append(ticket["ticket_id"])
+        if len(attempts) == 1:
+            raise ConnectionError("database unavailable")
+        return ticket["ticket_id"]
+
+    monkeypatch.setattr(tickets, "create_ticket", flaky_create_ticket)
+    monkeypatch.setattr(tickets, "_retry_delay", lambda attempts: 0.0)
+
+    reply = _escalate("retry_user", "My replacement never shipped, escalate please")
+    assert tickets.ticket_writer.flush()
+
+    assert "has been created" in reply
+    assert len(attempts) == 2
+    assert tickets.dedupe_key("retry_user", "My replacement never shipped, escalate please") in tickets._recent_tickets
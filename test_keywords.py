@@ -0,0 +1,40 @@
+import pytest
+
+from agents.intent import ABUSIVE_PATTERN, GREETING_PATTERN
+from agents.supervisor import ESCALATION_PATTERN
+
+@pytest.mark.parametrize("text", [
+    "you idiots",
+    "fucking hell this is broken",
+    "this is shitty service",
+    "you dumbass",
+    "you are stupid",
+    "i hate you",
+])
+def test_abusive_inflections_are_flagged(text):
+    assert ABUSIVE_PATTERN.search(text)
+
+@pytest.mark.parametrize("text", [
+    "escalated please",
+    "please escalate this",
+    "can i talk to one of your agents",
+    "i need a human",
+    "open a support ticket",
+])
+def test_escalation_inflections_are_detected(text):
+    assert ESCALATION_PATTERN.search(text)
+
+@pytest.mark.parametrize("text", [
+    "my order hasn't arrived yet",
+    "the charger stopped working",
+    "what payment methods do you accept?",
+])
+def test_ordinary_questions_are_not_flagged(text):
+    assert not ABUSIVE_PATTERN.search(text)
+    assert not ESCALATION_PATTERN.search(text)
+
+def test_greetings_match_whole_words_only():
+    assert GREETING_PATTERN.fullmatch("hi!")
+    assert GREETING_PATTERN.fullmatch("good morning")
+    assert not GREETING_PATTERN.fullmatch("this is broken")
+    assert not GREETING_PATTERN.fullmatch("highway")
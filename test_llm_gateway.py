@@ -0,0 +1,21 @@
+import asyncio
+
+from langchain_core.messages import HumanMessage
+
+import llm_gateway
+
+def test_losing_primary_still_counts_toward_hedge_delay(monkeypatch):
+    primary, hedge = "fake:1.0:0", "fake:0.01:0"
+    monkeypatch.setattr(llm_gateway, "LLM_HEDGE_MODEL", hedge)
+    monkeypatch.setattr(llm_gateway, "LLM_HEDGE_AFTER", 0.05)
+    monkeypatch.setattr(llm_gateway, "_first_token_times", {})
+
+    async def answer():
+        config = {"configurable": {"model": primary}}
+        return [chunk async for chunk in llm_gateway.astream(config, [HumanMessage(content="hi")])]
+
+    assert asyncio.run(answer())
+    # The primary was cancelled before its first token; how long it had waited is recorded
+    samples = list(llm_gateway._first_token_times[primary])
+    assert len(samples) == 1 and 0.05 <= samples[0] < 1.0
+    assert len(llm_gateway._first_token_times[hedge]) == 1
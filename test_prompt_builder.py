@@ -0,0 +1,33 @@
+from langchain_core.messages import AIMessage, HumanMessage
+
+import prompt_builder
+from prompt_builder import assemble_prompt
+
+def test_repeated_turns_are_kept(monkeypatch):
+    monkeypatch.setattr(prompt_builder, "_encoder", None)
+    monkeypatch.setattr(prompt_builder, "PROMPT_TOKENIZER", "chars")
+    messages = [
+        HumanMessage(content="Is my order shipped?", id="m1"),
+        AIMessage(content="Not yet.", id="m2"),
+        HumanMessage(content="Is my order shipped?", id="m3"),
+        AIMessage(content="Not yet.", id="m4"),
+        HumanMessage(content="Can you escalate this?", id="m5"),
+    ]
+    history = [
+        {"role": "user", "content": "Is my order shipped?", "message_id": "r1"},
+        {"role": "user", "content": "Where is the invoice?", "message_id": "r2"},
+        {"role": "user", "content": "Where is the invoice?", "message_id": "r2"},
+    ]
+
+    prompt = assemble_prompt(messages, "", history, [], "llama-3.1-8b-instant")
+
+    assert [m.id for m in prompt[1:]] == ["m1", "m2", "m3", "m4", "m5"]
+    system = prompt[0][1]
+    # History rows repeating the transcript are left out; the other row appears once
+    assert "User: Is my order shipped?" not in system
+    assert system.count("User: Where is the invoice?") == 1
+
+def test_count_tokens_falls_back_without_encoder(monkeypatch):
+    monkeypatch.setattr(prompt_builder, "_encoder", None)
+    monkeypatch.setattr(prompt_builder, "PROMPT_TOKENIZER", "chars")
+    assert prompt_builder.count_tokens("x" * 40) == 11
@@ -0,0 +1,60 @@
+from langchain_core.embeddings import DeterministicFakeEmbedding
+from langchain_core.messages import AIMessage, HumanMessage
+
+import vector_store
+import agents.generator as generator
+from response_cache import SemanticResponseCache, depends_on_context
+
+QUESTION = "How long does a refund usually take?"
+DOCS = ["Refunds are issued within 5-7 business days."]
+
+def _state(user_id, thread_id, messages, history=()):
+    return {
+        "messages": messages,
+        "history": list(history),
+        "retrieved_docs": DOCS,
+        "summary": "",
+        "user_info": {"user_id": user_id},
+        "config": {"configurable": {"thread_id": thread_id, "model": "fake"}},
+    }
+
+def _use_fresh_cache(monkeypatch):
+    cache = SemanticResponseCache(threshold=0.95, ttl=60, max_entries=100)
+    embedder = DeterministicFakeEmbedding(size=vector_store.EMBEDDING_DIMENSION)
+    monkeypatch.setattr(generator, "response_cache", cache)
+    monkeypatch.setattr(generator, "RESPONSE_CACHE_ENABLED", True)
+    monkeypatch.setattr(vector_store, "embeddings_enabled", lambda: True)
+    monkeypatch.setattr(vector_store, "embed_text", embedder.embed_query)
+    return cache
+
+def test_repeated_question_hits_the_cache(monkeypatch):
+    cache = _use_fresh_cache(monkeypatch)
+    for thread_id in ("thread_a", "thread_b"):
+        messages = []
+        for _ in range(3):
+            messages.append(HumanMessage(content=QUESTION))
+            answer = generator.generate(_state("cache_user", thread_id, messages)).update["messages"][-1]
+            messages.append(answer)
+
+    stats = cache.stats()
+    assert stats["misses"] == 1
+    assert stats["hits"] == 5
+    assert stats["stores"] == 1
+
+def test_answers_are_not_shared_between_users(monkeypatch):
+    cache = _use_fresh_cache(monkeypatch)
+    for user_id in ("alice", "bob"):
+        generator.generate(_state(user_id, f"{user_id}_thread", [HumanMessage(content=QUESTION)]))
+    assert cache.stats()["hits"] == 0
+
+def test_follow_ups_skip_the_cache(monkeypatch):
+    cache = _use_fresh_cache(monkeypatch)
+    messages = [HumanMessage(content=QUESTION), AIMessage(content="About a week."), HumanMessage(content="Is that true for laptops too?")]
+    generator.generate(_state("cache_user", "thread_c", messages))
+    assert cache.stats() == SemanticResponseCache().stats()
+
+def test_depends_on_context():
+    assert not depends_on_context("what about it?", [])
+    assert depends_on_context("what about it?", ["earlier turn"])
+    assert depends_on_context("and laptops?", ["earlier turn"])
+    assert not depends_on_context(QUESTION, ["earlier turn"])
@@ -0,0 +1,20 @@
+from vector_store import LocalIndex
+
+def _vector(i, dimension=8):
+    return [1.0 if j == i else 0.0 for j in range(dimension)]
+
+def test_deletes_from_another_process_are_picked_up(tmp_path):
+    serving = LocalIndex(str(tmp_path), dimension=8)
+    serving.upsert([{"id": f"m{i}", "values": _vector(i), "metadata": {"message_id": f"m{i}"}} for i in range(3)], namespace="u1")
+    assert serving.query(namespace="u1", vector=_vector(0), top_k=1)["matches"][0]["id"] == "m0"
+
+    # archive.py opens its own index over the same directory
+    LocalIndex(str(tmp_path), dimension=8).delete(ids=["m0"], namespace="u1")
+
+    matches = serving.query(namespace="u1", vector=_vector(0), top_k=3)["matches"]
+    assert [m["id"] for m in matches if m["id"] == "m0"] == []
+    assert len(matches) == 2
+
+    serving.upsert([{"id": "m3", "values": _vector(3), "metadata": {}}], namespace="u1")
+    assert serving.query(namespace="u1", vector=_vector(3), top_k=1)["matches"][0]["id"] == "m3"
+    assert LocalIndex(str(tmp_path), dimension=8).query(namespace="u1", vector=_vector(3), top_k=1)["matches"][0]["id"] == "m3"
@@ -0,0 +1,240 @@
+import os
+import re
+import time
+import uuid
+import heapq
+import queue
+import atexit
+import hashlib
+import itertools
+import threading
+from collections import OrderedDict
+
+from db import create_ticket, claim_tickets, complete_tickets, fail_ticket, TICKET_DEDUPE_WINDOW
+from tools import create_support_ticket
+from metrics import increment
+
+# Delivery worker: claims up to TICKET_BATCH_SIZE due tickets every TICKET_POLL_INTERVAL seconds
+TICKET_WORKER_ENABLED = os.getenv("TICKET_WORKER_ENABLED", "1") == "1"
+TICKET_BATCH_SIZE = int(os.getenv("TICKET_BATCH_SIZE", "20"))
+TICKET_POLL_INTERVAL = float(os.getenv("TICKET_POLL_INTERVAL", "2.0"))
+# A claimed ticket is handed out again after this long if its worker never reports back (seconds)
+TICKET_LEASE_SECONDS = int(os.getenv("TICKET_LEASE_SECONDS", "60"))
+# Failed deliveries back off exponentially, up to TICKET_MAX_ATTEMPTS tries
+TICKET_MAX_ATTEMPTS = int(os.getenv("TICKET_MAX_ATTEMPTS", "8"))
+TICKET_RETRY_BASE = float(os.getenv("TICKET_RETRY_BASE", "5"))
+TICKET_RETRY_MAX = float(os.getenv("TICKET_RETRY_MAX", "600"))
+# Outbox writes of newly opened tickets are retried (with the same backoff) this many times
+TICKET_WRITE_RETRIES = int(os.getenv("TICKET_WRITE_RETRIES", "8"))
+
+# Per-process view of recently opened tickets: dedupe_key -> (ticket_id, opened at), committed only
+RECENT_TICKETS_SIZE = int(os.getenv("RECENT_TICKETS_SIZE", "10000"))
+_recent_tickets = OrderedDict()
+# dedupe_key -> ticket_id of tickets queued for the outbox but not committed yet
+_pending_tickets = {}
+_recent_tickets_lock = threading.Lock()
+
+def dedupe_key(user_id, issue):
+    """Same user + same issue (ignoring case, punctuation and spacing) -> same key."""
+    normalized = " ".join(re.findall(r"\w+", issue.lower()))
+    return hashlib.sha1(f"{user_id}\n{normalized}".encode("utf-8")).hexdigest()
+
+def open_ticket(user_id, thread_id, issue):
+    """
+    Returns (ticket_id, is_new) without touching the database.
+    A repeat of an issue this process opened within TICKET_DEDUPE_WINDOW (or is
+    still writing) returns that ticket's id with is_new=False. A new ticket is
+    written to the outbox in the background by ticket_writer.
+    """
+    key = dedupe_key(user_id, issue)
+    now = time.time()
+    with _recent_tickets_lock:
+        recent = _recent_tickets.get(key)
+        if recent is not None and now - recent[1] < TICKET_DEDUPE_WINDOW:
+            _recent_tickets.move_to_end(key)
+            increment("tickets.deduplicated")
+            return recent[0], False
+        pending = _pending_tickets.get(key)
+        if pending is not None:
+            increment("tickets.deduplicated")
+            return pending, False
+        ticket_id = f"TICKET-{uuid.uuid4().hex[:8].upper()}"
+        _pending_tickets[key] = ticket_id
+
+    ticket_writer.enqueue({"ticket_id": ticket_id, "user_id": user_id, "thread_id": thread_id,
+                           "issue": issue, "dedupe_key": key, "opened_at": now})
+    increment("tickets.opened")
+    return ticket_id, True
+
+def _ticket_stored(ticket, stored_id):
+    # Only committed tickets are deduplicated against for the whole window
+    with _recent_tickets_lock:
+        _pending_tickets.pop(ticket["dedupe_key"], None)
+        _recent_tickets[ticket["dedupe_key"]] = (stored_id, ticket["opened_at"])
+        _recent_tickets.move_to_end(ticket["dedupe_key"])
+        while len(_recent_tickets) > RECENT_TICKETS_SIZE:
+            _recent_tickets.popitem(last=False)
+
+def _ticket_lost(ticket):
+    with _recent_tickets_lock:
+        _pending_tickets.pop(ticket["dedupe_key"], None)
+    print(f" [ERROR] Dropping ticket {ticket['ticket_id']} after {TICKET_WRITE_RETRIES} failed outbox writes")
+    increment("tickets.lost")
+
+def _retry_delay(attempts):
+    return min(TICKET_RETRY_MAX, TICKET_RETRY_BASE * (2 ** (attempts - 1)))
+
+_STOP = object()
+
+class TicketWriter:
+    """
+    Background thread that writes newly opened tickets to the outbox, one row
+    per transaction, so the escalation reply never waits for Postgres. A failed
+    write is retried with backoff on its own, without holding up other tickets
+    or the message batches.
+    """
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="ticket-writer", daemon=True)
+                self._thread.start()
+
+    def enqueue(self, ticket):
+        self._ensure_started()
+        self._queue.put(ticket)
+
+    def _run(self):
+        retries = []  # heap of (due, sequence, ticket, attempts so far)
+        sequence = itertools.count()
+        while True:
+            timeout = max(0.0, retries[0][0] - time.monotonic()) if retries else None
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+
+            if item is _STOP or isinstance(item, threading.Event):
+                # Last attempt at stop; flush() gives waiting tickets one more try now
+                waiting, retries = retries, []
+                for _, _, ticket, attempts in sorted(waiting, key=lambda r: r[:2]):
+                    self._write(ticket, attempts, retries, sequence, final=item is _STOP)
+                if item is _STOP:
+                    return
+                item.set()
+                continue
+            if item is not None:
+                self._write(item, 0, retries, sequence)
+            while retries and retries[0][0] <= time.monotonic():
+                _, _, ticket, attempts = heapq.heappop(retries)
+                self._write(ticket, attempts, retries, sequence)
+
+    def _write(self, ticket, attempts, retries, sequence, final=False):
+        try:
+            stored_id = create_ticket(ticket)
+        except Exception as e:
+            print(f" [ERROR] Error writing ticket {ticket['ticket_id']} to the outbox: {e}")
+            attempts += 1
+            if final or attempts > TICKET_WRITE_RETRIES:
+                _ticket_lost(ticket)
+            else:
+                increment("tickets.write_retries")
+                heapq.heappush(retries, (time.monotonic() + _retry_delay(attempts), next(sequence), ticket, attempts))
+            return
+        _ticket_stored(ticket, stored_id)
+
+    def flush(self, timeout=10.0):
+        """Writes every ticket queued so far (one more try for those waiting on a retry). Returns False on timeout."""
+        with self._lock:
+            running = self._thread is not None and self._thread.is_alive()
+        if not running:
+            return True
+        done = threading.Event()
+        self._queue.put(done)
+        return done.wait(timeout)
+
+    def shutdown(self, timeout=10.0):
+        """Writes everything queued so far and stops the writer thread."""
+        with self._lock:
+            thread = self._thread
+            self._thread = None
+        if thread is not None and thread.is_alive():
+            self._queue.put(_STOP)
+            thread.join(timeout)
+
+ticket_writer = TicketWriter()
+atexit.register(ticket_writer.shutdown)
+
+class TicketDeliveryWorker:
+    """
+    Background thread that delivers outbox tickets to the ticketing system in batches.
+    Delivery is at-least-once; the ticket_id is passed along as the idempotency key.
+    Several workers (or processes) can run against the same table.
+    """
+    def __init__(self, batch_size=TICKET_BATCH_SIZE, poll_interval=TICKET_POLL_INTERVAL):
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stop.clear()
+                self._thread = threading.Thread(target=self._run, name="ticket-delivery", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                claimed = self.deliver_batch()
+            except Exception as e:
+                print(f" [ERROR] Error delivering tickets: {e}")
+                claimed = 0
+            # A full batch suggests more are waiting
+            if claimed < self.batch_size:
+                self._stop.wait(self.poll_interval)
+
+    def deliver_batch(self):
+        """Delivers one batch of due tickets. Returns how many were claimed."""
+        tickets = claim_tickets(self.batch_size, TICKET_LEASE_SECONDS)
+        delivered = []
+        for ticket in tickets:
+            try:
+                create_support_ticket.invoke({
+                    "issue": ticket["issue"], "user_id": ticket["user_id"], "ticket_id": ticket["ticket_id"]
+                })
+                delivered.append(ticket["ticket_id"])
+            except Exception as e:
+                print(f" [ERROR] Error delivering ticket {ticket['ticket_id']}: {e}")
+                increment("tickets.delivery_errors")
+                retry_in = _retry_delay(ticket["attempts"]) if ticket["attempts"] < TICKET_MAX_ATTEMPTS else None
+                fail_ticket(ticket["ticket_id"], str(e), retry_in)
+        complete_tickets(delivered)
+        if delivered:
+            increment("tickets.delivered", len(delivered))
+        return len(tickets)
+
+    def stop(self, timeout=5.0):
+        with self._lock:
+            thread = self._thread
+            self._thread = None
+        self._stop.set()
+        if thread is not None and thread.is_alive():
+            thread.join(timeout)
+
+delivery_worker = TicketDeliveryWorker()
+
+def start_ticket_worker():
+    """Starts background ticket delivery (unless TICKET_WORKER_ENABLED=0). Call after init_db."""
+    if TICKET_WORKER_ENABLED:
+        delivery_worker.start()
+
+def stop_ticket_worker():
+    ticket_writer.shutdown()
+    delivery_worker.stop()
@@ -1,112 +1,514 @@
 import os
+import json
+import time
 import uuid
-from datetime import datetime
-from pinecone import Pinecone, ServerlessSpec
-from langchain_huggingface import HuggingFaceEmbeddings
+import asyncio
+import hashlib
+import threading
+from collections import OrderedDict
+from urllib.parse import quote
+import numpy as np
+
+from metrics import span, record_startup
+from db import get_messages_by_ids
+from embedding_engine import EmbeddingEngine, embedding_model_kwargs, EMBEDDING_BACKEND
+
+# HuggingFace Embeddings (all-MiniLM-L6-v2) outputs 384 dimensions
+EMBEDDING_MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
+EMBEDDING_DIMENSION = 384
+
+# Embedding cache: bounded in-process LRU, optionally backed by a directory of .npy files
+EMBEDDING_CACHE_SIZE = int(os.getenv("EMBEDDING_CACHE_SIZE", "2048"))
+EMBEDDING_CACHE_DIR = os.getenv("EMBEDDING_CACHE_DIR")
+
+# Pinecone accepts at most 1000 ids per delete request
+VECTOR_DELETE_BATCH_SIZE = int(os.getenv("VECTOR_DELETE_BATCH_SIZE", "1000"))
+
+# When to load the embedding model (sentence-transformers + torch take seconds to import):
+# "background" (default) on a daemon thread started by init_pinecone, "eager" inside init_pinecone,
+# "lazy" on the first embedding. Callers that need it before it is ready wait for the load.
+EMBEDDING_WARMUP = os.getenv("EMBEDDING_WARMUP", "background").lower()
 
 # Globals
 pc = None
 index = None
 embeddings = None
+_embeddings_pending = False
+_embeddings_lock = threading.Lock()
+_engine = None
+_engine_lock = threading.Lock()
+_embedding_cache = OrderedDict()
+_embedding_cache_lock = threading.Lock()
+
+class _LocalNamespace:
+    """
+    One namespace of the local index: a memory-mapped float32 matrix of
+    unit-normalized vectors plus a JSONL sidecar mapping rows to ids/metadata.
+    Deleted rows are tombstoned in the sidecar and masked out of queries.
+    Records appended by another process (archive.py's deletes) are replayed
+    before each query, so archived ids stop being served without a restart.
+    """
+    def __init__(self, directory, name, dimension):
+        file_stem = os.path.join(directory, quote(name or "_default", safe=""))
+        self.vectors_path = file_stem + ".f32"
+        self.meta_path = file_stem + ".jsonl"
+        self.dimension = dimension
+        self.rows = {}
+        self.entries = []
+        self.deleted = set()
+        self.matrix = None
+        self.capacity = 0
+        # Bytes of the sidecar already applied
+        self.meta_offset = 0
+        self.refresh()
+        if self.matrix is None:
+            self._map()
+
+    def _map(self):
+        if os.path.exists(self.vectors_path):
+            self.capacity = os.path.getsize(self.vectors_path) // (4 * self.dimension)
+        if self.capacity:
+            self.matrix = np.memmap(self.vectors_path, dtype=np.float32, mode="r+", shape=(self.capacity, self.dimension))
+
+    def refresh(self):
+        """Applies the sidecar records appended since the last read, by this process or another."""
+        if not os.path.exists(self.meta_path) or os.path.getsize(self.meta_path) <= self.meta_offset:
+            return
+        with open(self.meta_path, "rb") as f:
+            f.seek(self.meta_offset)
+            data = f.read()
+        # A line still being written by another process is picked up next time
+        complete = data.rfind(b"\n") + 1
+        self.meta_offset += complete
+        for line in data[:complete].splitlines():
+            record = json.loads(line)
+            row = record["row"]
+            if record.get("deleted"):
+                self.rows.pop(record["id"], None)
+                self.deleted.add(row)
+                continue
+            self.rows[record["id"]] = row
+            if row == len(self.entries):
+                self.entries.append(None)
+            self.entries[row] = (record["id"], record.get("metadata", {}))
+
+        if len(self.entries) > self.capacity:
+            self._map()
+
+    def _grow(self, needed):
+        new_capacity = max(64, self.capacity)
+        while new_capacity < needed:
+            new_capacity *= 2
+        if self.matrix is not None:
+            self.matrix.flush()
+            self.matrix = None
+        with open(self.vectors_path, "ab") as f:
+            f.truncate(new_capacity * self.dimension * 4)
+        self.capacity = new_capacity
+        self.matrix = np.memmap(self.vectors_path, dtype=np.float32, mode="r+", shape=(self.capacity, self.dimension))
+
+    def upsert(self, vectors):
+        new_rows = sum(1 for v in vectors if v["id"] not in self.rows)
+        if len(self.entries) + new_rows > self.capacity:
+            self._grow(len(self.entries) + new_rows)
+
+        with open(self.meta_path, "a", encoding="utf-8") as f:
+            for v in vectors:
+                values = np.asarray(v["values"], dtype=np.float32)
+                norm = np.linalg.norm(values)
+                if norm:
+                    values = values / norm
+
+                row = self.rows.get(v["id"])
+                if row is None:
+                    row = len(self.entries)
+                    self.rows[v["id"]] = row
+                    self.entries.append(None)
+                metadata = v.get("metadata", {})
+                self.entries[row] = (v["id"], metadata)
+                self.matrix[row] = values
+                f.write(json.dumps({"id": v["id"], "row": row, "metadata": metadata}) + "\n")
+        self.matrix.flush()
+
+    def delete(self, ids):
+        rows = [(vector_id, self.rows.pop(vector_id)) for vector_id in ids if vector_id in self.rows]
+        if not rows:
+            return
+        with open(self.meta_path, "a", encoding="utf-8") as f:
+            for vector_id, row in rows:
+                self.deleted.add(row)
+                f.write(json.dumps({"id": vector_id, "row": row, "deleted": True}) + "\n")
+
+    def query(self, vector, top_k, include_metadata):
+        self.refresh()
+        count = len(self.entries)
+        live = count - len(self.deleted)
+        if live <= 0:
+            return []
+
+        query_vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(query_vector)
+        if norm:
+            query_vector = query_vector / norm
+
+        scores = self.matrix[:count] @ query_vector
+        if self.deleted:
+            scores[list(self.deleted)] = -np.inf
+        k = min(top_k, live)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+
+        matches = []
+        for row in top:
+            vector_id, metadata = self.entries[row]
+            match = {"id": vector_id, "score": float(scores[row])}
+            if include_metadata:
+                match["metadata"] = metadata
+            matches.append(match)
+        return matches
+
+class LocalIndex:
+    """
+    Local, on-disk alternative to a Pinecone index for single-node deployments.
+    Implements the subset of the Pinecone Index API used by this module
+    (namespaced upsert and query), so both backends are interchangeable.
+    Similarity is cosine, computed as a dot product over normalized vectors.
+    """
+    def __init__(self, directory, dimension=EMBEDDING_DIMENSION):
+        self.directory = directory
+        self.dimension = dimension
+        self._namespaces = {}
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _namespace(self, namespace):
+        if namespace not in self._namespaces:
+            self._namespaces[namespace] = _LocalNamespace(self.directory, namespace, self.dimension)
+        return self._namespaces[namespace]
+
+    def upsert(self, vectors, namespace=""):
+        with self._lock:
+            self._namespace(namespace).upsert(vectors)
+        return {"upserted_count": len(vectors)}
+
+    def query(self, namespace="", vector=None, top_k=3, include_metadata=False):
+        with self._lock:
+            matches = self._namespace(namespace).query(vector, top_k, include_metadata)
+        return {"matches": matches, "namespace": namespace}
+
+    def delete(self, ids, namespace=""):
+        with self._lock:
+            self._namespace(namespace).delete(ids)
+        return {}
 
 def init_pinecone():
-    """Initializes Pinecone client and creates the index if it doesn't exist."""
-    global pc, index, embeddings
-    
+    """
+    Initializes the vector backend selected by VECTOR_BACKEND and the embedding model.
+    'pinecone' (default) uses the hosted index; 'local' keeps namespaces on disk.
+    """
+    global pc, index
+
+    backend = os.getenv("VECTOR_BACKEND", "pinecone").lower()
+    if backend == "local":
+        try:
+            index_dir = os.getenv("LOCAL_VECTOR_DIR", "vector_data")
+            print(f" [SYSTEM] Initializing local vector index at '{index_dir}'...")
+            index = LocalIndex(index_dir, dimension=EMBEDDING_DIMENSION)
+            init_embeddings()
+            print(" [SYSTEM] Local vector index initialized successfully.")
+        except Exception as e:
+            print(f" [ERROR] Error initializing local vector index: {e}")
+        return
+
     api_key = os.getenv("PINECONE_API_KEY")
     if not api_key:
         print(" [WARNING] PINECONE_API_KEY not set. Semantic memory will be disabled.")
         return
-        
+
     index_name = os.getenv("PINECONE_INDEX_NAME", "chatbot-memory")
-    
+
     try:
         print(" [SYSTEM] Initializing Pinecone...")
+        from pinecone import Pinecone, ServerlessSpec
         pc = Pinecone(api_key=api_key)
-        
-        # HuggingFace Embeddings (all-MiniLM-L6-v2) outputs 384 dimensions
-        dimension = 384 
-        
+
         if index_name not in pc.list_indexes().names():
             print(f" [SYSTEM] Creating Pinecone index '{index_name}'...")
             pc.create_index(
                 name=index_name,
-                dimension=dimension,
+                dimension=EMBEDDING_DIMENSION,
                 metric="cosine",
                 spec=ServerlessSpec(
                     cloud="aws",
                     region="us-east-1"
                 )
             )
-        
+
         index = pc.Index(index_name)
-        embeddings = HuggingFaceEmbeddings(model_name="sentence-transformers/all-MiniLM-L6-v2")
+        init_embeddings()
         print(" [SYSTEM] Pinecone initialized successfully.")
     except Exception as e:
         print(f" [ERROR] Error initializing Pinecone: {e}")
 
-def store_embedding(user_id, message_id, content, role):
-    """Generates and stores an embedding for a message in Pinecone."""
-    if not index or not embeddings:
+def init_embeddings():
+    """Schedules loading of the embedding model according to EMBEDDING_WARMUP."""
+    global _embeddings_pending
+    if embeddings is not None:
         return
-        
+    _embeddings_pending = True
+    if EMBEDDING_WARMUP == "eager":
+        get_embeddings()
+    elif EMBEDDING_WARMUP != "lazy":
+        threading.Thread(target=get_embeddings, name="embedding-warmup", daemon=True).start()
+
+def get_embeddings():
+    """
+    Returns the embedding model, loading it on first use. Concurrent callers
+    block on the lock until the (single) load finishes. Returns None if
+    semantic memory is disabled or the model failed to load.
+    """
+    global embeddings, _embeddings_pending
+    if embeddings is None and _embeddings_pending:
+        with _embeddings_lock:
+            if embeddings is None and _embeddings_pending:
+                try:
+                    start = time.perf_counter()
+                    from langchain_huggingface import HuggingFaceEmbeddings
+                    model = HuggingFaceEmbeddings(model_name=EMBEDDING_MODEL_NAME, model_kwargs=embedding_model_kwargs())
+                    # Also warms the model up; an ONNX export must match the index dimension
+                    dimension = len(model.embed_query("warm-up"))
+                    if dimension != EMBEDDING_DIMENSION:
+                        raise ValueError(f"{EMBEDDING_BACKEND} embedding model returned {dimension} dimensions, expected {EMBEDDING_DIMENSION}")
+                    embeddings = model
+                    record_startup("embedding_model", time.perf_counter() - start)
+                    print(" [SYSTEM] Embedding model loaded.")
+                except Exception as e:
+                    print(f" [ERROR] Error loading embedding model: {e}")
+                finally:
+                    _embeddings_pending = False
+    return embeddings
+
+def embeddings_enabled():
+    """True if an embedding model is loaded or scheduled to load."""
+    return embeddings is not None or _embeddings_pending
+
+def _content_hash(text):
+    return hashlib.sha256(f"{EMBEDDING_MODEL_NAME}\0{text}".encode("utf-8")).hexdigest()
+
+def _cache_path(key):
+    return os.path.join(EMBEDDING_CACHE_DIR, f"{key}.npy") if EMBEDDING_CACHE_DIR else None
+
+def _cached_embedding(key):
+    """Looks a vector up in the in-process LRU, then in the optional on-disk tier."""
+    with _embedding_cache_lock:
+        if key in _embedding_cache:
+            _embedding_cache.move_to_end(key)
+            return _embedding_cache[key]
+
+    cache_path = _cache_path(key)
+    if cache_path and os.path.exists(cache_path):
+        try:
+            vector = np.load(cache_path).tolist()
+            _cache_embedding(key, vector, persist=False)
+            return vector
+        except Exception as e:
+            print(f" [ERROR] Error reading cached embedding: {e}")
+    return None
+
+def _cache_embedding(key, vector, persist=True):
+    cache_path = _cache_path(key)
+    if persist and cache_path:
+        try:
+            os.makedirs(EMBEDDING_CACHE_DIR, exist_ok=True)
+            tmp_path = f"{cache_path}.{uuid.uuid4().hex}.tmp"
+            with open(tmp_path, "wb") as f:
+                np.save(f, np.asarray(vector, dtype=np.float32))
+            os.replace(tmp_path, cache_path)
+        except Exception as e:
+            print(f" [ERROR] Error writing cached embedding: {e}")
+
+    with _embedding_cache_lock:
+        _embedding_cache[key] = vector
+        _embedding_cache.move_to_end(key)
+        while len(_embedding_cache) > EMBEDDING_CACHE_SIZE:
+            _embedding_cache.popitem(last=False)
+
+def _get_engine():
+    global _engine
+    model = get_embeddings()
+    if model is None:
+        raise RuntimeError("Embedding model is not available")
+    with _engine_lock:
+        # Rebuilt if the model object is swapped out (e.g. by the benchmark's fakes)
+        if _engine is None or _engine.model is not model:
+            if _engine is not None:
+                _engine.shutdown()
+            _engine = EmbeddingEngine(model)
+        return _engine
+
+def embed_texts(texts):
+    """
+    Returns embeddings for several texts, computing each at most once per
+    content hash. Lookups go through the in-process LRU, then the optional
+    on-disk tier (EMBEDDING_CACHE_DIR); the misses are sent to the embedding
+    engine together, which batches them with other concurrent requests.
+    """
+    keys = [_content_hash(text) for text in texts]
+    vectors = [_cached_embedding(key) for key in keys]
+
+    missing = {}
+    for i, vector in enumerate(vectors):
+        if vector is None:
+            missing.setdefault(keys[i], []).append(i)
+    if missing:
+        miss_texts = [texts[positions[0]] for positions in missing.values()]
+        with span("embedding.embed_query", texts=len(miss_texts)):
+            computed = _get_engine().embed_many(miss_texts)
+        for (key, positions), vector in zip(missing.items(), computed):
+            _cache_embedding(key, vector)
+            for i in positions:
+                vectors[i] = vector
+    return vectors
+
+def embed_text(text):
+    """Returns the embedding for a piece of text (see embed_texts)."""
+    return embed_texts([text])[0]
+
+def store_embedding(user_id, message_id, content, role):
+    """
+    Generates and stores an embedding for a message in the vector index.
+    Returns the vector so callers can reuse it, or None if semantic memory is disabled.
+    """
+    if not index or not embeddings_enabled():
+        return None
+
     try:
-        # Generate embedding
-        vector = embeddings.embed_query(content)
-        
-        # Prepare metadata
+        # Generate embedding (cached by content hash)
+        vector = embed_text(content)
+
+        # Metadata holds ids only; content is hydrated from PostgreSQL at retrieval
         metadata = {
-            "user_id": user_id,
             "message_id": message_id,
-            "role": role,
-            "content": content,
-            "timestamp": str(datetime.now())
+            "role": role
         }
-        
-        # Upsert to Pinecone
-        index.upsert(
-            vectors=[{
-                "id": message_id,
+
+        # Upsert to the index
+        with span("vector.upsert"):
+            index.upsert(
+                vectors=[{
+                    "id": message_id,
+                    "values": vector,
+                    "metadata": metadata
+                }],
+                namespace=user_id  # Use namespace to isolate user data
+            )
+        return vector
+    except Exception as e:
+        print(f" [ERROR] Error storing embedding: {e}")
+        return None
+
+def store_embeddings(items):
+    """
+    Generates and stores embeddings for a batch of messages, issuing one upsert
+    per user namespace. Each item is a dict with user_id, message_id, content and role.
+    """
+    if not index or not embeddings_enabled() or not items:
+        return
+
+    try:
+        by_namespace = {}
+        vectors_by_item = embed_texts([item["content"] for item in items])
+        for item, vector in zip(items, vectors_by_item):
+            metadata = {
+                "message_id": item["message_id"],
+                "role": item["role"]
+            }
+            by_namespace.setdefault(item["user_id"], []).append({
+                "id": item["message_id"],
                 "values": vector,
                 "metadata": metadata
-            }],
-            namespace=user_id  # Use namespace to isolate user data
-        )
+            })
+
+        for namespace, vectors in by_namespace.items():
+            with span("vector.upsert", vectors=len(vectors)):
+                index.upsert(vectors=vectors, namespace=namespace)
     except Exception as e:
-        print(f" [ERROR] Error storing embedding in Pinecone: {e}")
+        print(f" [ERROR] Error storing embedding batch: {e}")
 
-def retrieve_similar_context(user_id, query, top_k=3):
-    """Retrieves semantically similar past messages for a user based on a query."""
-    if not index or not embeddings:
+def delete_vectors(user_id, message_ids):
+    """
+    Deletes the vectors of the given messages from the user's namespace,
+    VECTOR_DELETE_BATCH_SIZE ids per request. Returns how many ids were sent.
+    """
+    if not index or not message_ids:
+        return 0
+
+    message_ids = list(message_ids)
+    for start in range(0, len(message_ids), VECTOR_DELETE_BATCH_SIZE):
+        batch = message_ids[start:start + VECTOR_DELETE_BATCH_SIZE]
+        with span("vector.delete", vectors=len(batch)):
+            index.delete(ids=batch, namespace=user_id)
+    return len(message_ids)
+
+def retrieve_similar_context(user_id, query, top_k=3, query_vector=None):
+    """
+    Retrieves semantically similar past messages for a user based on a query.
+    Pass query_vector to reuse an embedding already computed for the same text.
+    """
+    if not index or not embeddings_enabled():
         return []
-        
+
     try:
-        # Generate embedding for the query
-        query_vector = embeddings.embed_query(query)
-        
-        # Search Pinecone in the user's namespace
-        results = index.query(
-            namespace=user_id,
-            vector=query_vector,
-            top_k=top_k,
-            include_metadata=True
-        )
-        
-        # Extract the content from the matches
+        # Embed the query unless the caller already has its vector
+        if query_vector is None:
+            query_vector = embed_text(query)
+
+        # Search the user's namespace
+        with span("vector.query"):
+            results = index.query(
+                namespace=user_id,
+                vector=query_vector,
+                top_k=top_k,
+                include_metadata=True
+            )
+
+        matches = [match for match in results.get("matches", []) if "metadata" in match]
+
+        # Hydrate the content of the matched ids in one batch (older vectors still carry it inline)
+        ids = [match["metadata"].get("message_id", match.get("id")) for match in matches
+               if "content" not in match["metadata"]]
+        rows = get_messages_by_ids(user_id, ids) if ids else {}
+
         context_docs = []
-        for match in results.get("matches", []):
-            if "metadata" in match and "content" in match["metadata"]:
-                # Optionally prepend role (User/Assistant) to context
-                role_str = str(match["metadata"].get("role", "unknown")).capitalize()
-                content_str = match["metadata"]["content"]
-                # E.g., User (past): ... or MakTek (past): ...
-                context_docs.append(f"{role_str} (past): {content_str}")
-                
+        for match in matches:
+            metadata = match["metadata"]
+            content_str = metadata.get("content")
+            if content_str is None:
+                row = rows.get(metadata.get("message_id", match.get("id")))
+                if row is None:
+                    continue
+                content_str = row["content"]
+            # Optionally prepend role (User/Assistant) to context
+            role_str = str(metadata.get("role", "unknown")).capitalize()
+            # E.g., User (past): ... or MakTek (past): ...
+            context_docs.append(f"{role_str} (past): {content_str}")
+
         return context_docs
     except Exception as e:
-        print(f" [ERROR] Error retrieving from Pinecone: {e}")
+        print(f" [ERROR] Error retrieving similar context: {e}")
         return []
 
+# Async API: embedding is CPU-bound and the Pinecone client is blocking,
+# so both run in the default executor instead of on the event loop.
+
+async def astore_embedding(user_id, message_id, content, role):
+    """Async counterpart of store_embedding."""
+    return await asyncio.to_thread(store_embedding, user_id, message_id, content, role)
+
+async def aretrieve_similar_context(user_id, query, top_k=3, query_vector=None):
+    """Async counterpart of retrieve_similar_context."""
+    return await asyncio.to_thread(retrieve_similar_context, user_id, query, top_k, query_vector)
+
 # Legacy wrapper so Retriever node doesn't completely break if it calls get_retriever()
 # However, we will modify the Retriever node to use the new functions directly.
 def get_retriever():
@@ -0,0 +1,501 @@
+import os
+import sys
+import time
+import uuid
+import bisect
+import random
+import asyncio
+import hashlib
+import argparse
+import threading
+import multiprocessing
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+# Worker processes; each owns its graph, model clients and embedding engine
+WORKER_COUNT = int(os.getenv("WORKER_COUNT", str(os.cpu_count() or 2)))
+# Points per worker on the hash ring; more points spread threads more evenly
+WORKER_VIRTUAL_NODES = int(os.getenv("WORKER_VIRTUAL_NODES", "64"))
+# Turns a worker runs at once (on threads; turns of one thread_id always run one at a time, in order)
+WORKER_TURN_CONCURRENCY = int(os.getenv("WORKER_TURN_CONCURRENCY", "8"))
+WORKER_HEALTH_TIMEOUT = float(os.getenv("WORKER_HEALTH_TIMEOUT", "5"))
+WORKER_START_TIMEOUT = float(os.getenv("WORKER_START_TIMEOUT", "120"))
+# Threads whose last worker is remembered, so their caches can be released when they move
+WORKER_AFFINITY_THREADS = int(os.getenv("WORKER_AFFINITY_THREADS", "100000"))
+
+DEFAULT_MODEL = "llama-3.1-8b-instant"
+
+def _hash(key):
+    return int.from_bytes(hashlib.md5(key.encode("utf-8")).digest()[:8], "big")
+
+class HashRing:
+    """
+    Consistent hash ring of worker ids. Adding or removing a worker only
+    moves the threads on its arcs (about 1/N of them), so the other workers
+    keep their warm caches.
+    """
+    def __init__(self, virtual_nodes=WORKER_VIRTUAL_NODES):
+        self.virtual_nodes = virtual_nodes
+        self._points = []
+        self._owners = []
+
+    def add(self, worker_id):
+        for i in range(self.virtual_nodes):
+            point = _hash(f"worker-{worker_id}#{i}")
+            position = bisect.bisect(self._points, point)
+            self._points.insert(position, point)
+            self._owners.insert(position, worker_id)
+
+    def remove(self, worker_id):
+        kept = [(p, o) for p, o in zip(self._points, self._owners) if o != worker_id]
+        self._points = [p for p, _ in kept]
+        self._owners = [o for _, o in kept]
+
+    def lookup(self, key):
+        if not self._points:
+            raise RuntimeError("No workers available")
+        position = bisect.bisect(self._points, _hash(key)) % len(self._points)
+        return self._owners[position]
+
+    def __contains__(self, worker_id):
+        return worker_id in self._owners
+
+# --- worker process ---
+
+class _TurnRunner:
+    """
+    Runs a worker's turns on a thread pool. Turns of the same thread_id run
+    one at a time in arrival order; different threads run concurrently.
+    """
+    def __init__(self, run, workers=WORKER_TURN_CONCURRENCY):
+        self._run_turn = run
+        self._pool = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="turn")
+        # thread_id -> turns waiting behind the one running; a key exists while the thread is busy
+        self._queues = {}
+        self._idle = threading.Condition()
+
+    def submit(self, thread_id, request_id, payload):
+        with self._idle:
+            queued = self._queues.get(thread_id)
+            if queued is not None:
+                queued.append((request_id, payload))
+                return
+            self._queues[thread_id] = deque()
+        self._pool.submit(self._run, thread_id, request_id, payload)
+
+    def _run(self, thread_id, request_id, payload):
+        while True:
+            self._run_turn(request_id, payload)
+            with self._idle:
+                queued = self._queues[thread_id]
+                if not queued:
+                    del self._queues[thread_id]
+                    self._idle.notify_all()
+                    return
+                request_id, payload = queued.popleft()
+
+    def wait_idle(self, thread_ids):
+        """Blocks until none of the given threads has a turn running or queued."""
+        with self._idle:
+            self._idle.wait_for(lambda: not any(t in self._queues for t in thread_ids))
+
+    def shutdown(self):
+        """Waits for every submitted turn to finish."""
+        self._pool.shutdown(wait=True)
+
+def _release_threads(thread_ids):
+    """Flushes pending writes and forgets cached state of threads that moved to another worker."""
+    import graph
+    import db
+    from persistence import flush as flush_persistence
+
+    flush_persistence()
+    for thread_id in thread_ids:
+        if hasattr(graph.memory, "evict"):
+            graph.memory.evict(thread_id)
+        db.evict_thread(thread_id)
+
+def _worker_main(worker_id, inbox, outbox, init_backends):
+    """
+    Worker process loop: runs turns with main.process_turn until told to stop.
+    This loop only dispatches, so pings are answered even while turns are running.
+    """
+    from main import process_turn
+    from persistence import shutdown as shutdown_persistence
+    from tickets import ticket_writer
+    if init_backends:
+        from db import init_db
+        from vector_store import init_pinecone
+        from tickets import start_ticket_worker
+        from archive import start_partition_maintenance
+        init_db()
+        init_pinecone()
+        # Every worker polls the outbox; claims skip rows another worker holds
+        start_ticket_worker()
+        # Idempotent, and serialized in Postgres, so every worker may run it
+        start_partition_maintenance()
+    outbox.put(("ready", worker_id, None, os.getpid()))
+
+    def run_turn(request_id, payload):
+        try:
+            user_id, thread_id, user_input, model = payload
+            config = {"configurable": {"thread_id": thread_id, "model": model}}
+            outbox.put(("done", worker_id, request_id, process_turn(user_id, thread_id, user_input, config)))
+        except Exception as e:
+            outbox.put(("error", worker_id, request_id, f"{type(e).__name__}: {e}"))
+
+    def release(request_id, thread_ids):
+        # Turns of these threads queued before the release finish (and their writes flush) first
+        try:
+            runner.wait_idle(thread_ids)
+            _release_threads(thread_ids)
+            outbox.put(("done", worker_id, request_id, len(thread_ids)))
+        except Exception as e:
+            outbox.put(("error", worker_id, request_id, f"{type(e).__name__}: {e}"))
+
+    runner = _TurnRunner(run_turn)
+    while True:
+        kind, request_id, payload = inbox.get()
+        if kind == "stop":
+            break
+        if kind == "ping":
+            outbox.put(("done", worker_id, request_id, os.getpid()))
+        elif kind == "release":
+            threading.Thread(target=release, args=(request_id, payload), daemon=True).start()
+        else:
+            runner.submit(payload[1], request_id, payload)
+
+    runner.shutdown()
+    # Drain: everything queued before the stop has been answered; flush pending writes
+    shutdown_persistence()
+    ticket_writer.shutdown()
+    outbox.put(("stopped", worker_id, None, None))
+
+# --- dispatcher ---
+
+class _Worker:
+    def __init__(self, worker_id, process, inbox):
+        self.worker_id = worker_id
+        self.process = process
+        self.inbox = inbox
+        self.ready = threading.Event()
+        self.stopped = threading.Event()
+        self.draining = False
+        self.inflight = 0
+        self.served = 0
+
+class WorkerPool:
+    """
+    Runs the chatbot in N worker processes and dispatches each turn to the
+    worker that owns its thread_id on a consistent hash ring, so a thread's
+    checkpoint, history and caches stay warm in one process.
+
+    Workers are spawned (not forked: torch and the DB pools are not fork-safe).
+    A worker joins the ring once it is ready; draining one takes it off the
+    ring first, so new turns go elsewhere while its queued turns finish.
+    Threads that move when the ring changes are released on their old worker
+    (running turns finished, pending writes flushed, caches evicted); their
+    new turns are held until the old worker confirms, so a thread never runs
+    in two processes at once. For graph state to follow a moved thread use the
+    PostgreSQL checkpointer (CHECKPOINT_BACKEND=postgres).
+
+    The local vector index (VECTOR_BACKEND=local) is a single-process store,
+    so a pool using it is limited to one worker.
+    """
+    def __init__(self, workers=WORKER_COUNT, init_backends=True, virtual_nodes=WORKER_VIRTUAL_NODES,
+                 start_timeout=WORKER_START_TIMEOUT):
+        self.init_backends = init_backends
+        self._local_vectors = init_backends and os.getenv("VECTOR_BACKEND", "pinecone").lower() == "local"
+        if self._local_vectors and workers > 1:
+            raise RuntimeError("VECTOR_BACKEND=local cannot be shared between worker processes; "
+                               "use Pinecone or a single worker")
+        self._context = multiprocessing.get_context("spawn")
+        self._outbox = self._context.Queue()
+        self._ring = HashRing(virtual_nodes)
+        self._workers = {}
+        self._requests = {}
+        # thread_id -> worker that last served it
+        self._affinity = OrderedDict()
+        # thread_id -> turns held while the thread's previous worker releases it
+        self._moving = {}
+        self._lock = threading.Lock()
+        self._next_worker_id = 0
+        self._closed = False
+
+        self._collector = threading.Thread(target=self._collect, name="worker-pool-collector", daemon=True)
+        self._collector.start()
+
+        started = [self.add_worker() for _ in range(max(1, workers))]
+        self.wait_ready(started, timeout=start_timeout)
+
+    # --- workers ---
+
+    def add_worker(self):
+        """Spawns a worker; it joins the hash ring (and threads rebalance onto it) once ready."""
+        with self._lock:
+            if self._local_vectors and any(not w.draining for w in self._workers.values()):
+                raise RuntimeError("VECTOR_BACKEND=local cannot be shared between worker processes; "
+                                   "use Pinecone or a single worker")
+            worker_id = self._next_worker_id
+            self._next_worker_id += 1
+            inbox = self._context.Queue()
+            process = self._context.Process(
+                target=_worker_main, args=(worker_id, inbox, self._outbox, self.init_backends),
+                name=f"chatbot-worker-{worker_id}", daemon=True
+            )
+            self._workers[worker_id] = _Worker(worker_id, process, inbox)
+        process.start()
+        print(f" [SYSTEM] Started worker {worker_id} (pid {process.pid})")
+        return worker_id
+
+    def wait_ready(self, worker_ids, timeout=WORKER_START_TIMEOUT):
+        deadline = time.monotonic() + timeout
+        for worker_id in worker_ids:
+            worker = self._workers.get(worker_id)
+            while worker is not None and not worker.ready.wait(0.5):
+                if not worker.process.is_alive():
+                    self._remove_worker(worker_id, "Worker exited")
+                    raise RuntimeError(f"Worker {worker_id} exited during start-up (exit code {worker.process.exitcode})")
+                if time.monotonic() > deadline:
+                    raise TimeoutError(f"Worker {worker_id} did not start within {timeout}s")
+
+    def _join_ring(self, worker_id):
+        with self._lock:
+            worker = self._workers.get(worker_id)
+            if worker is None or worker.draining:
+                return
+            self._ring.add(worker_id)
+            self._rebalance_locked()
+        worker.ready.set()
+
+    def _leave_ring_locked(self, worker_id):
+        if worker_id in self._ring:
+            self._ring.remove(worker_id)
+
+    def _rebalance_locked(self):
+        """Releases threads whose owner changed on their previous worker."""
+        moved = {}
+        for thread_id, owner in list(self._affinity.items()):
+            if self._ring.lookup(thread_id) != owner:
+                del self._affinity[thread_id]
+                worker = self._workers.get(owner)
+                if worker is not None and not worker.draining:
+                    moved.setdefault(owner, []).append(thread_id)
+        for owner, thread_ids in moved.items():
+            for thread_id in thread_ids:
+                self._moving.setdefault(thread_id, [])
+            future = self._send_locked(owner, "release", thread_ids, Future())
+            # Also runs if the release fails (e.g. the old worker died), so held turns never get stuck
+            future.add_done_callback(lambda _, thread_ids=thread_ids: self._release_held(thread_ids))
+        if moved:
+            print(f" [SYSTEM] Rebalanced {sum(len(t) for t in moved.values())} threads")
+
+    def drain(self, worker_id, timeout=60.0):
+        """Stops routing to a worker, lets its queued turns finish and stops the process."""
+        with self._lock:
+            worker = self._workers.get(worker_id)
+            if worker is None:
+                return
+            worker.draining = True
+            self._leave_ring_locked(worker_id)
+            # Its threads' new turns wait until it has finished their queued ones
+            moved = [t for t, owner in self._affinity.items() if owner == worker_id]
+            for thread_id in moved:
+                del self._affinity[thread_id]
+                self._moving.setdefault(thread_id, [])
+            worker.inbox.put(("stop", None, None))
+
+        if not worker.stopped.wait(timeout):
+            print(f" [ERROR] Worker {worker_id} did not drain within {timeout}s; terminating")
+            worker.process.terminate()
+        worker.process.join(5)
+        self._remove_worker(worker_id, "Worker drained")
+        self._release_held(moved)
+        print(f" [SYSTEM] Drained worker {worker_id}")
+
+    def resize(self, workers, timeout=WORKER_START_TIMEOUT):
+        """Grows or shrinks the pool to `workers` processes."""
+        with self._lock:
+            active = [w for w, worker in self._workers.items() if not worker.draining]
+        if workers > len(active):
+            started = [self.add_worker() for _ in range(workers - len(active))]
+            self.wait_ready(started, timeout=timeout)
+        for worker_id in sorted(active, reverse=True)[:max(0, len(active) - workers)]:
+            self.drain(worker_id)
+
+    def _remove_worker(self, worker_id, reason):
+        """Forgets a worker, failing any requests it never answered."""
+        with self._lock:
+            self._leave_ring_locked(worker_id)
+            self._workers.pop(worker_id, None)
+            orphaned = [(request_id, entry) for request_id, entry in self._requests.items() if entry[1] == worker_id]
+            for request_id, _ in orphaned:
+                del self._requests[request_id]
+        for _, (future, _, _) in orphaned:
+            if not future.done():
+                future.set_exception(RuntimeError(f"{reason} before answering (worker {worker_id})"))
+
+    def health_check(self, timeout=WORKER_HEALTH_TIMEOUT, restart=True):
+        """
+        Pings every worker. Dead or unresponsive workers are replaced when
+        restart=True. Returns {worker_id: {"pid", "healthy", "latency_ms", "inflight", "served"}}.
+        """
+        with self._lock:
+            workers = [w for w in self._workers.values() if w.ready.is_set() and not w.draining]
+            pings = {w.worker_id: (time.perf_counter(), self._send_locked(w.worker_id, "ping", None, Future()))
+                     for w in workers if w.process.is_alive()}
+
+        report = {}
+        deadline = time.monotonic() + timeout
+        for worker in workers:
+            healthy, latency = False, None
+            if worker.worker_id in pings:
+                sent, future = pings[worker.worker_id]
+                try:
+                    future.result(timeout=max(0.0, deadline - time.monotonic()))
+                    healthy, latency = True, (time.perf_counter() - sent) * 1000
+                except Exception:
+                    pass
+            report[worker.worker_id] = {
+                "pid": worker.process.pid,
+                "healthy": healthy,
+                "latency_ms": latency,
+                "inflight": worker.inflight,
+                "served": worker.served,
+            }
+            if not healthy and restart:
+                print(f" [ERROR] Worker {worker.worker_id} failed its health check; replacing it")
+                if worker.process.is_alive():
+                    worker.process.terminate()
+                worker.process.join(5)
+                self._remove_worker(worker.worker_id, "Worker failed its health check")
+                self.add_worker()
+        return report
+
+    # --- requests ---
+
+    def _send_locked(self, worker_id, kind, payload, future):
+        request_id = uuid.uuid4().hex
+        self._requests[request_id] = (future, worker_id, kind)
+        self._workers[worker_id].inflight += 1
+        self._workers[worker_id].inbox.put((kind, request_id, payload))
+        return future
+
+    def submit(self, user_id, thread_id, user_input, model=DEFAULT_MODEL):
+        """Queues a turn on the worker owning thread_id. Returns a Future for the answer."""
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("Worker pool is shut down")
+            payload = (user_id, thread_id, user_input, model)
+            held = self._moving.get(thread_id)
+            if held is not None:
+                future = Future()
+                held.append((payload, future))
+                return future
+            return self._dispatch_locked(payload, Future())
+
+    def _dispatch_locked(self, payload, future):
+        thread_id = payload[1]
+        worker_id = self._ring.lookup(thread_id)
+        self._affinity[thread_id] = worker_id
+        self._affinity.move_to_end(thread_id)
+        while len(self._affinity) > WORKER_AFFINITY_THREADS:
+            self._affinity.popitem(last=False)
+        return self._send_locked(worker_id, "turn", payload, future)
+
+    def _release_held(self, thread_ids):
+        """Sends the turns held for moved threads to their new owners, in order."""
+        with self._lock:
+            for thread_id in thread_ids:
+                for payload, future in self._moving.pop(thread_id, []):
+                    try:
+                        self._dispatch_locked(payload, future)
+                    except Exception as e:
+                        future.set_exception(e)
+
+    def run_turn(self, user_id, thread_id, user_input, model=DEFAULT_MODEL, timeout=None):
+        return self.submit(user_id, thread_id, user_input, model).result(timeout)
+
+    async def arun_turn(self, user_id, thread_id, user_input, model=DEFAULT_MODEL):
+        return await asyncio.wrap_future(self.submit(user_id, thread_id, user_input, model))
+
+    def _collect(self):
+        while True:
+            kind, worker_id, request_id, value = self._outbox.get()
+            if kind == "ready":
+                print(f" [SYSTEM] Worker {worker_id} ready (pid {value})")
+                self._join_ring(worker_id)
+                continue
+            if kind == "stopped":
+                worker = self._workers.get(worker_id)
+                if worker is not None:
+                    worker.stopped.set()
+                continue
+            if kind == "closed":
+                return
+
+            with self._lock:
+                entry = self._requests.pop(request_id, None)
+                worker = self._workers.get(worker_id)
+                if worker is not None:
+                    worker.inflight -= 1
+                    if entry is not None and entry[2] == "turn":
+                        worker.served += 1
+            if entry is None:
+                continue
+            future = entry[0]
+            if kind == "done":
+                future.set_result(value)
+            else:
+                future.set_exception(RuntimeError(value))
+
+    def stats(self):
+        with self._lock:
+            return {
+                worker_id: {"pid": w.process.pid, "ready": w.ready.is_set(), "draining": w.draining,
+                            "inflight": w.inflight, "served": w.served}
+                for worker_id, w in self._workers.items()
+            }
+
+    def shutdown(self, timeout=60.0):
+        """Drains every worker and stops the dispatcher."""
+        with self._lock:
+            self._closed = True
+            worker_ids = list(self._workers)
+        for worker_id in worker_ids:
+            self.drain(worker_id, timeout=timeout)
+        self._outbox.put(("closed", None, None, None))
+        self._collector.join(5)
+
+def _demo(args):
+    """Drives the pool with synthetic sessions, resizing it halfway through."""
+    pool = WorkerPool(workers=args.workers, init_backends=not args.no_init)
+    rng = random.Random(7)
+    messages = ["hi", "My order is late", "How do I reset my router?", "What is your refund policy?"]
+    try:
+        start = time.perf_counter()
+        for turn in range(args.turns):
+            if args.rebalance and turn == args.turns // 2:
+                pool.resize(args.workers + 1)
+            futures = [
+                pool.submit(f"user_{i}", f"thread_{i}", rng.choice(messages), model=args.model)
+                for i in range(args.sessions)
+            ]
+            for future in futures:
+                future.result()
+        elapsed = time.perf_counter() - start
+        print(f"\n{args.sessions * args.turns} turns in {elapsed:.2f}s")
+        print(f"Health: {pool.health_check()}")
+        print(f"Turns per worker: { {w: s['served'] for w, s in pool.stats().items()} }")
+    finally:
+        pool.shutdown()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the chatbot on a pool of worker processes")
+    parser.add_argument("--workers", type=int, default=WORKER_COUNT)
+    parser.add_argument("--sessions", type=int, default=20)
+    parser.add_argument("--turns", type=int, default=4)
+    parser.add_argument("--model", default="fake:0.05:0.005")
+    parser.add_argument("--rebalance", action="store_true", help="add a worker halfway through")
+    parser.add_argument("--no-init", action="store_true", help="skip DB/vector store initialization in the workers")
+    sys.exit(_demo(parser.parse_args()))